@@ -1,21 +1,149 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from os import environ, getenv
 from os.path import join
-from typing import Dict, Iterator, List, TypeVar, Union
+from time import perf_counter, sleep
+from typing import AsyncIterator, Dict, Iterator, List, Tuple, Union
+from uuid import uuid4
 
 from box.box import Box
-from dotenv import load_dotenv
-from openai import AzureOpenAI, OpenAI
-from openai._streaming import Stream
-from openai.types.chat import ChatCompletion
+from openai import (
+    APIConnectionError,
+    AsyncAzureOpenAI,
+    AsyncOpenAI,
+    AzureOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+from openai._streaming import AsyncStream, Stream
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from endpoint_router import (
+    AsyncPrefetchedStream,
+    Endpoint,
+    EndpointRouter,
+    PrefetchedStream,
+    aprefetch_stream,
+    get_endpoint_router,
+    prefetch_stream,
+)
+from metrics import get_metrics
+from rate_limiter import RateLimiter, backoff_s, get_rate_limiter
+from response_cache import (
+    ReplayStream,
+    ResponseCache,
+    build_cached_completion,
+    get_response_cache,
+    make_cache_key,
+)
+from semantic_cache import SemanticCache, get_semantic_cache
+from usage_ledger import PriceTable, UsageLedger, get_usage_ledger
 from utils import (
+    TokenLedger,
     detect_is_work_device,
     get_src_dir_path,
-    num_tokens_from_messages,
-    num_tokens_from_string,
-    read_yaml,
+    load_dotenv_once,
+    read_yaml_cached,
 )
 
+# Answers of async clients are written to the response caches (SQLite, chromadb) on a background
+# writer, so that finishing a stream does not block the event loop
+_CACHE_WRITE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="response-cache-writer"
+)
+
+
+class TrackedStream:
+    """
+    Wraps an OpenAI chat completion stream and accounts for the call's tokens and cost as chunks
+    arrive.
+
+    Output tokens are counted per chunk, and the server-side usage block is used instead when the
+    backend sends one. Usage is recorded on the owning OAIClient exactly once: when the stream
+    finishes (`stop`, `length`, ...), or when it is closed or abandoned part way through.
+    """
+
+    def __init__(
+        self,
+        stream: Stream,
+        oai_client: "OAIClient",
+        messages: List[Dict[str, str]],
+        model: str,
+        expect_usage: bool = False,
+        started_at: float = None,
+        cache_keys: Dict = None,
+    ) -> None:
+        self._stream = stream
+        self._started_at = started_at if started_at is not None else perf_counter()
+        self._oai_client = oai_client
+        self._model = model
+        self._expect_usage = expect_usage
+        self._token_ledger = oai_client.get_token_ledger(model=model)
+        tokenization_started_at = perf_counter()
+        self.input_tokens = self._token_ledger.count_messages(messages)
+        self.output_tokens = 0
+        self.cost = 0.0
+        # Time spent counting tokens (so it can be told apart from provider latency)
+        self.tokenization_s = perf_counter() - tokenization_started_at
+        self.finish_reason = None
+        self._finalized = False
+        # Answer text is only kept if it will be written to the response caches
+        self._cache_keys = cache_keys
+        self._content_pieces: List[str] = []
+
+    def __iter__(self) -> Iterator[ChatCompletionChunk]:
+        try:
+            for chunk in self._stream:
+                self._on_chunk(chunk)
+                yield chunk
+        finally:
+            # No-op if the stream already finished, otherwise releases the connection.
+            self.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+    def close(self) -> None:
+        """Close the underlying stream and record usage for what was received so far."""
+        self._stream.close()
+        self._finalize()
+
+    def _on_chunk(self, chunk: ChatCompletionChunk) -> None:
+        if self._finalized:
+            return
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.delta is not None and choice.delta.content:
+                tokenization_started_at = perf_counter()
+                self.output_tokens += self._token_ledger.count_string(choice.delta.content)
+                self.tokenization_s += perf_counter() - tokenization_started_at
+                if self._cache_keys:
+                    self._content_pieces.append(choice.delta.content)
+            if choice.finish_reason is not None:
+                self.finish_reason = choice.finish_reason
+                if not self._expect_usage:
+                    self._finalize()
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            self.input_tokens, self.output_tokens = usage.prompt_tokens, usage.completion_tokens
+            self._finalize()
+
+    def _finalize(self) -> None:
+        if self._finalized:
+            return
+        self._finalized = True
+        self.cost = self._oai_client._record_usage(
+            model=self._model,
+            input_tokens=self.input_tokens,
+            output_tokens=self.output_tokens,
+            latency_s=perf_counter() - self._started_at,
+        )
+        if self._cache_keys and self.finish_reason == "stop":
+            self._oai_client._store_cached_response(
+                cache_keys=self._cache_keys, content="".join(self._content_pieces)
+            )
+
 
 class OAIClient:
     # Default params (will be overwritten if param is specified in config file!)
@@ -23,35 +151,86 @@ class OAIClient:
     TEMPERATURE: float = 0.2
     SEED: int = 12345
     TOP_P: float = 1.0
-    _POSTPROCESS_STREAM: bool = False
+    # Model used for token counting and pricing, if MODEL is a deployment name (e.g. on Azure)
+    ACCOUNTING_MODEL: str = None
+    _POSTPROCESS_STREAM: bool = True
+    # Ask the backend to append a usage block to streams (not supported by older Azure API versions)
+    _STREAM_INCLUDE_USAGE: bool = False
+    _STREAM_TYPE = Stream
+    _TRACKED_STREAM_TYPE = TrackedStream
+    # Opt-in cache of answers for identical requests (see response_cache.py for its config)
+    RESPONSE_CACHE: bool = False
+    # Opt-in cache of answers for near-duplicate questions (see semantic_cache.py for its config)
+    SEMANTIC_CACHE: bool = False
+    # Calls wait their turn in a process-wide RPM/TPM limiter (see rate_limiter.py, and the
+    # RATE_LIMITS of the config file). Lanes take turns, so batch jobs cannot starve chat sessions.
+    RATE_LIMIT_LANE: str = "interactive"
+    RATE_LIMIT_MAX_RETRIES: int = 4
+    # Output tokens assumed when estimating the size of a request without max_tokens
+    RATE_LIMIT_OUTPUT_TOKENS: int = 256
 
     # Session state params
     input_tokens_used: int = 0
     output_tokens_used: int = 0
     pricing_cost: float = 0.0
     num_calls: int = 0
-
-    # Hardcoded
-    # Cost of model calls (per 1000 tokens) (input, output costs)
-    cost_mapping = {
-        "gpt-3.5-turbo-1106": (0.0010, 0.0020),
-        "gpt-3.5-turbo-0613": (0.0015, 0.0020),
-        "gpt-3.5-turbo-16k-0613": (0.0030, 0.0040),
-    }
+    num_cache_hits: int = 0
 
     def __init__(
         self,
         config_file: Box = None,
         client: OpenAI = None,
+        usage_ledger: UsageLedger = None,
+        session_id: str = None,
+        response_cache: ResponseCache = None,
+        semantic_cache: SemanticCache = None,
+        router: EndpointRouter = None,
         **kwargs,
     ) -> None:
         """
+        If the config file lists `ENDPOINTS`, calls are routed across them (see endpoint_router.py),
+        unless a `client` is given.
+
         Models list: https://platform.openai.com/docs/models
         Models pricing: https://openai.com/pricing // https://platform.openai.com/docs/deprecations/2023-11-06-chat-model-updates
         Nice costcalculating library: https://www.reddit.com/r/Python/comments/12lec2s/openai_pricing_logger_a_python_package_to_easily/
         """
         self._parse_config(config_path=config_file)
+        self.price_table = PriceTable.from_config(self.config)
+        self.usage_ledger = (
+            usage_ledger if usage_ledger is not None else get_usage_ledger(config=self.config)
+        )
+        self.session_id = session_id if session_id is not None else uuid4().hex
+        self.response_cache = (
+            response_cache
+            if response_cache is not None
+            else (get_response_cache(config=self.config) if self.RESPONSE_CACHE else None)
+        )
+        self.semantic_cache = (
+            semantic_cache
+            if semantic_cache is not None
+            else (
+                get_semantic_cache(
+                    config=self.config,
+                    # Embeddings are requested synchronously, so always use a sync client
+                    openai_client_factory=lambda: OAIClient._init_client(
+                        self, **{k: v for k, v in kwargs.items() if k != "http_client"}
+                    ),
+                )
+                if self.SEMANTIC_CACHE
+                else None
+            )
+        )
+        self._token_ledgers: Dict[str, TokenLedger] = dict()
+        self.router = router
+        if self.router is None and client is None and self.config and self.config.get("ENDPOINTS"):
+            self.router = get_endpoint_router(
+                config=self.config, async_client=self._STREAM_TYPE is AsyncStream
+            )
+        if client is None and self.router is not None:
+            client = self.router.endpoints[0].client
         self.client = client if client else self._init_client(**kwargs)
+        self._request_client, self._request_client_of = None, None
 
     def __call__(self, *args, **kwargs):
         return self.query(*args, **kwargs)
@@ -67,14 +246,8 @@ class OAIClient:
         return_raw_response: bool = False,
         stream: bool = False,
         **kwargs,
-    ) -> Union[str, ChatCompletion]:
-        # Defaults
-        model = model if model is not None else self.MODEL
-        temperature = temperature if temperature is not None else self.TEMPERATURE
-        seed = seed if seed is not None else self.SEED
-        top_p = top_p if top_p is not None else self.TOP_P
-
-        response = self.client.chat.completions.create(
+    ) -> Union[str, ChatCompletion, TrackedStream]:
+        request = self._build_request(
             messages=messages,
             model=model,
             temperature=temperature,
@@ -84,89 +257,336 @@ class OAIClient:
             stream=stream,
             **kwargs,
         )
-        # Update state
-        # TODO: Put in postprocessing step
+        cache_keys, cached_content = self._lookup_cached_response(request=request)
+        if cached_content is not None:
+            return self._replay_cached_response(
+                request=request, content=cached_content, return_raw_response=return_raw_response
+            )
+        started_at = perf_counter()
+        response = self._create(request=request)
+        return self._handle_response(
+            request=request,
+            response=response,
+            started_at=started_at,
+            return_raw_response=return_raw_response,
+            cache_keys=cache_keys,
+        )
+
+    def _build_request(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = None,
+        temperature: float = None,
+        seed: int = None,
+        top_p: float = None,
+        max_tokens: int = None,
+        stream: bool = False,
+        **kwargs,
+    ) -> Dict:
+        """Build chat completion request params, filling in defaults."""
+        if stream and self._POSTPROCESS_STREAM and self._STREAM_INCLUDE_USAGE:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        return dict(
+            messages=messages,
+            model=model if model is not None else self.MODEL,
+            temperature=temperature if temperature is not None else self.TEMPERATURE,
+            seed=seed if seed is not None else self.SEED,
+            top_p=top_p if top_p is not None else self.TOP_P,
+            max_tokens=max_tokens,
+            stream=stream,
+            **kwargs,
+        )
+
+    def _create(self, request: Dict) -> Union[ChatCompletion, Stream]:
+        """Send a request once the rate limiter allows, retrying 429s and transient errors."""
+        if self.router is not None:
+            return self._create_routed(request=request)
+        rate_limiter = self.get_rate_limiter(model=request["model"])
+        estimated_tokens = self._estimate_request_tokens(request=request)
+        for attempt in range(self.RATE_LIMIT_MAX_RETRIES + 1):
+            get_metrics().observe(
+                "rate_limit_wait",
+                rate_limiter.acquire(tokens=estimated_tokens, lane=self.RATE_LIMIT_LANE),
+            )
+            try:
+                raw_response = self._get_request_client().chat.completions.with_raw_response.create(
+                    **request
+                )
+            except RateLimitError as e:
+                rate_limiter.penalize(headers=e.response.headers)
+                if attempt == self.RATE_LIMIT_MAX_RETRIES:
+                    raise
+            except (APIConnectionError, InternalServerError):
+                if attempt == self.RATE_LIMIT_MAX_RETRIES:
+                    raise
+                sleep(backoff_s(attempt=attempt))
+            else:
+                rate_limiter.update_from_headers(headers=raw_response.headers)
+                return raw_response.parse()
+
+    def _create_routed(self, request: Dict) -> Union[ChatCompletion, PrefetchedStream]:
+        """Send a request to the best endpoint, failing over to the next ones on errors."""
+        estimated_tokens = self._estimate_request_tokens(request=request)
+        tried: List[Endpoint] = []
+        for attempt in range(self.RATE_LIMIT_MAX_RETRIES + 1):
+            endpoint = self.router.rank(exclude=tried)[0]
+            if endpoint in tried:
+                # Every endpoint failed this request already, so back off before another round
+                sleep(backoff_s(attempt=attempt))
+                tried = []
+            try:
+                return self._send_to_endpoint(
+                    request=request, endpoint=endpoint, estimated_tokens=estimated_tokens
+                )
+            except (RateLimitError, APIConnectionError, InternalServerError):
+                if attempt == self.RATE_LIMIT_MAX_RETRIES:
+                    raise
+                tried.append(endpoint)
+
+    def _send_to_endpoint(
+        self, request: Dict, endpoint: Endpoint, estimated_tokens: int
+    ) -> Union[ChatCompletion, PrefetchedStream]:
+        """Send a request to an endpoint, and update its stats (streams: on their first chunk)."""
+        rate_limiter = get_rate_limiter(key=endpoint.name, config=self.config)
+        get_metrics().observe(
+            "rate_limit_wait",
+            rate_limiter.acquire(tokens=estimated_tokens, lane=self.RATE_LIMIT_LANE),
+        )
+        self.router.on_start(endpoint=endpoint)
+        started_at, handed_off = perf_counter(), False
+        try:
+            raw_response = endpoint.client.chat.completions.with_raw_response.create(
+                **endpoint.prepare(request)
+            )
+            rate_limiter.update_from_headers(headers=raw_response.headers)
+            response = raw_response.parse()
+            if request["stream"]:
+                # The endpoint stays loaded until the stream is closed
+                response = prefetch_stream(
+                    stream=response, on_close=lambda: self.router.on_end(endpoint=endpoint)
+                )
+                handed_off = True
+                self.router.record_success(endpoint=endpoint, ttft_s=perf_counter() - started_at)
+            else:
+                self.router.record_success(endpoint=endpoint, latency_s=perf_counter() - started_at)
+            return response
+        except RateLimitError as e:
+            retry_after_s = rate_limiter.penalize(headers=e.response.headers)
+            self.router.record_failure(endpoint=endpoint, cooldown_s=retry_after_s)
+            raise
+        except (APIConnectionError, InternalServerError):
+            self.router.record_failure(endpoint=endpoint)
+            raise
+        finally:
+            if not handed_off:
+                self.router.on_end(endpoint=endpoint)
+
+    def _estimate_request_tokens(self, request: Dict) -> int:
+        """Estimate the tokens a request counts against a TPM limit (prompt + max output)."""
+        token_ledger = self.get_token_ledger(model=request["model"])
+        max_tokens = request.get("max_tokens", None)
+        return token_ledger.count_messages(request["messages"]) + (
+            max_tokens if max_tokens is not None else self.RATE_LIMIT_OUTPUT_TOKENS
+        )
+
+    def _get_request_client(self) -> Union[OpenAI, AsyncOpenAI]:
+        """
+        Return the client requests are sent with: `client`, with its own retries turned off, as
+        retries go through the shared rate limiter instead of each session backing off alone.
+        """
+        if self._request_client_of is not self.client:
+            self._request_client = self.client.with_options(max_retries=0)
+            self._request_client_of = self.client
+        return self._request_client
+
+    def get_rate_limiter(self, model: str = None) -> RateLimiter:
+        """Return the process-wide rate limiter of a model/deployment."""
+        return get_rate_limiter(key=model if model is not None else self.MODEL, config=self.config)
+
+    def _handle_response(
+        self,
+        request: Dict,
+        response: Union[ChatCompletion, Stream, AsyncStream],
+        started_at: float,
+        return_raw_response: bool = False,
+        cache_keys: Dict = None,
+    ) -> Union[str, ChatCompletion, TrackedStream]:
+        """Update session state from a response, wrapping streams so they are tracked."""
+        messages, model, stream = request["messages"], request["model"], request["stream"]
         self.num_calls += 1
-        if stream and not isinstance(response, Stream):
-            raise ValueError("Response is streamed, but not an OpenAI.Stream object!")
+        if stream and not isinstance(response, (self._STREAM_TYPE, PrefetchedStream)):
+            raise ValueError(
+                f"Response is streamed, but not an OpenAI.{self._STREAM_TYPE.__name__} object!"
+            )
         if stream and self._POSTPROCESS_STREAM:
-            # TODO: Implement postprocessing for stream (MODIFY STREAM OBJECT to count tokens etc.)
-            # self._postprocess_stream(messages=messages, model=model, response=response)
-            pass
+            response = self._postprocess_stream(
+                messages=messages,
+                model=model,
+                stream=response,
+                started_at=started_at,
+                cache_keys=cache_keys,
+            )
         elif not stream:
-            self._postprocess(messages=messages, model=model, response=response)
+            self._postprocess(
+                messages=messages,
+                model=model,
+                response=response,
+                latency_s=perf_counter() - started_at,
+            )
+            if cache_keys and response.choices[0].finish_reason == "stop":
+                self._store_cached_response(
+                    cache_keys=cache_keys, content=response.choices[0].message.content
+                )
         else:
             print("WARNING: Streaming response so skipping postprocessing step!")
 
-        if return_raw_response:
+        if return_raw_response or stream:
             return response
         else:
             return response.choices[0].message.content
 
+    def _lookup_cached_response(self, request: Dict) -> Tuple[Dict, str]:
+        """
+        Look a request up in the response caches (exact first, then semantic).
+        Returns the keys to store its answer under once it completes, and the cached answer (or
+        None on a miss). Keys are computed up front, as callers may mutate `messages` afterwards.
+        """
+        cache_keys = dict()
+        if self.response_cache is not None:
+            cache_key = make_cache_key(request=request)
+            if cache_key is not None:
+                cache_keys["exact"] = cache_key
+                cached_content = self.response_cache.get(key=cache_key)
+                if cached_content is not None:
+                    return cache_keys, cached_content
+        if self.semantic_cache is not None:
+            probe = self.semantic_cache.probe(messages=request["messages"], model=request["model"])
+            if probe is not None:
+                cached_content = self.semantic_cache.lookup(probe=probe)
+                if cached_content is not None:
+                    # Promote to the exact cache so repeats of this exact request skip embedding
+                    self._store_cached_response(cache_keys=cache_keys, content=cached_content)
+                    return cache_keys, cached_content
+                cache_keys["semantic"] = probe
+        return cache_keys, None
+
+    def _store_cached_response(self, cache_keys: Dict, content: str) -> None:
+        if content is None:
+            return
+        if "exact" in cache_keys:
+            self.response_cache.put(key=cache_keys["exact"], content=content)
+        if "semantic" in cache_keys:
+            self.semantic_cache.store(probe=cache_keys["semantic"], answer=content)
+
+    def _replay_cached_response(
+        self, request: Dict, content: str, return_raw_response: bool = False
+    ) -> Union[str, ChatCompletion, ReplayStream]:
+        """Serve a cached answer in the same shape as a live response (nothing is billed)."""
+        self.num_cache_hits += 1
+        if request["stream"]:
+            return ReplayStream(content=content, model=request["model"])
+        if return_raw_response:
+            return build_cached_completion(content=content, model=request["model"])
+        return content
+
     def _postprocess(
         self,
         messages: List[Dict[str, str]],
         model: str,
         response: Union[ChatCompletion, str],
+        latency_s: float = 0.0,
     ) -> None:
         """Postprocess response."""
-        self._track_tokens_used_in_call(messages=messages, model=model, response=response)
-        self._track_cost_of_call(model=model)
-
-    def _postprocess_stream(self, stream: Stream) -> None:
-        """
-        Postprocess response as stream.
-
-        Replace method of existing object: https://stackoverflow.com/a/2982/10002593
-        (USE ATTRIBUTE INSTEAD!) Passing parameters to the __iter__ method: https://stackoverflow.com/a/54395995/10002593
-        """
-
-        def newiterfunc(self) -> Iterator[TypeVar("_T")]:
-            """
-            Taken from: https://github.com/openai/openai-python/blob/main/src/openai/_streaming.py#L21
-            """
-            for item in self._iterator:
-                yield item
-            # TODO: Do something with self.OAI_CLIENT
+        model = self._get_accounting_model(model)
+        input_tokens, output_tokens = self._count_tokens_used_in_call(
+            messages=messages, model=model, response=response
+        )
+        self._record_usage(
+            model=model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            latency_s=latency_s,
+        )
 
-        stream.OAI_CLIENT = self
-        stream.__iter__ = newiterfunc.__get__(stream)
+    def _postprocess_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        stream: Stream,
+        started_at: float = None,
+        cache_keys: Dict = None,
+    ) -> TrackedStream:
+        """Postprocess response as stream (tokens and cost are tracked as it is consumed)."""
+        return self._TRACKED_STREAM_TYPE(
+            stream=stream,
+            oai_client=self,
+            messages=messages,
+            model=self._get_accounting_model(model),
+            expect_usage=self._STREAM_INCLUDE_USAGE,
+            started_at=started_at,
+            cache_keys=cache_keys,
+        )
 
-    def _track_cost_of_call(self, model: str) -> None:
+    def _record_usage(
+        self, model: str, input_tokens: int, output_tokens: int, latency_s: float = 0.0
+    ) -> float:
         """
-        Calculate cost of call.
+        Update session state with the tokens and cost of a call, and log it to the ledger.
+        Returns the call's cost.
         """
-        input_token_cost, output_token_cost = self.cost_mapping[model]  # per 1000 token
-        self.pricing_cost += input_token_cost * (
-            self.input_tokens_used / 1000
-        ) + output_token_cost * (self.output_tokens_used / 1000)
+        cost = self.price_table.cost(
+            model=model, input_tokens=input_tokens, output_tokens=output_tokens
+        )
+        self.input_tokens_used += input_tokens
+        self.output_tokens_used += output_tokens
+        self.pricing_cost += cost
+        metrics = get_metrics()
+        metrics.inc("input_tokens", input_tokens, model=model)
+        metrics.inc("output_tokens", output_tokens, model=model)
+        metrics.inc("cost_usd", cost, model=model)
+        self.usage_ledger.record(
+            model=model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cost=cost,
+            latency_s=latency_s,
+            session=self.session_id,
+        )
+        return cost
 
-    def _track_tokens_used_in_call(
+    def _count_tokens_used_in_call(
         self,
         messages: List[Dict[str, str]],
         model: str,
         response: Union[ChatCompletion, str],
         manual_calculation: bool = False,
-    ):
-        """Calculate number of tokens used in call."""
+    ) -> Tuple[int, int]:
+        """Calculate number of (input, output) tokens used in call."""
         response_content = (
             response if isinstance(response, str) else response.choices[0].message.content
         )
         manual_calculation = True if isinstance(response, str) else manual_calculation
-        self.output_tokens_used += (
-            num_tokens_from_string(string=response_content, model=model)
-            if manual_calculation
-            else response.usage.completion_tokens
-        )
-        self.input_tokens_used += (
-            num_tokens_from_messages(messages=messages, model=model)
-            if manual_calculation
-            else response.usage.prompt_tokens
-        )
+        if not manual_calculation:
+            return response.usage.prompt_tokens, response.usage.completion_tokens
+        token_ledger = self.get_token_ledger(model=model)
+        return token_ledger.count_messages(messages), token_ledger.count_string(response_content)
+
+    def _get_accounting_model(self, model: str) -> str:
+        """Return the model used for token counting and pricing."""
+        if model == self.MODEL and self.ACCOUNTING_MODEL is not None:
+            return self.ACCOUNTING_MODEL
+        return model
+
+    def get_token_ledger(self, model: str = None) -> TokenLedger:
+        """Return this session's token ledger for a model (message token counts are cached)."""
+        model = self._get_accounting_model(model if model is not None else self.MODEL)
+        if model not in self._token_ledgers:
+            self._token_ledgers[model] = TokenLedger(model=model)
+        return self._token_ledgers[model]
 
     def _test_connection(self, print_output: bool = False) -> bool:
         try:
-            response = self.client.query(
+            response = self.query(
                 messages=[
                     {
                         "role": "user",
@@ -185,12 +605,12 @@ class OAIClient:
 
     def _close_client(self) -> None:
         """Close OpenAI client."""
-        if not self.client.is_closed:
+        if not self.client.is_closed():
             self.client.close()
 
     def _parse_config(self, config_path: str) -> None:
         """Parse config file from input path."""
-        self.config = read_yaml(input_path=config_path) if config_path is not None else None
+        self.config = read_yaml_cached(input_path=config_path) if config_path is not None else None
         if config_path is not None:
             for key, value in self.config.items():
                 if key in OAIClient.__dict__.keys():
@@ -201,8 +621,16 @@ class OAIClient:
         **kwargs,
     ) -> OpenAI:
         """Initialize OpenAI client."""
+        if detect_is_work_device():
+            client = AzureOpenAI
+        else:
+            client = OpenAI
+        return client(**self._get_client_kwargs(**kwargs))
+
+    def _get_client_kwargs(self, **kwargs) -> Dict:
+        """Resolve OpenAI client params (and pass through an `http_client`, if given)."""
         try:
-            load_dotenv()
+            load_dotenv_once()
         except Exception as e:
             pass
 
@@ -217,15 +645,302 @@ class OAIClient:
             if input_param in kwargs.keys():
                 kwargs_subset.update({input_param: kwargs[input_param]})
             elif hasattr(self, config_param):
-                kwargs_subset.update({input_param: self.config_param})
+                kwargs_subset.update({input_param: getattr(self, config_param)})
             elif config_param in environ:
                 kwargs_subset.update({input_param: getenv(config_param)})
+        if kwargs.get("http_client") is not None:
+            kwargs_subset.update({"http_client": kwargs["http_client"]})
+        return kwargs_subset
+
+
+class AsyncTrackedStream(TrackedStream):
+    """TrackedStream for an OpenAI AsyncStream (iterate with `async for`)."""
+
+    def __iter__(self):
+        raise TypeError("AsyncTrackedStream must be iterated with `async for`.")
+
+    async def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        try:
+            async for chunk in self._stream:
+                self._on_chunk(chunk)
+                yield chunk
+        finally:
+            await self.aclose()
+
+    def close(self) -> None:
+        raise TypeError("AsyncTrackedStream must be closed with `await stream.aclose()`.")
+
+    async def aclose(self) -> None:
+        """Close the underlying stream and record usage for what was received so far."""
+        await self._stream.close()
+        self._finalize()
+
+
+class AsyncOAIClient(OAIClient):
+    """
+    OAIClient built on AsyncOpenAI/AsyncAzureOpenAI. `query` (and calling the client) must be
+    awaited, and streamed responses are iterated with `async for`.
+    """
+
+    _STREAM_TYPE = AsyncStream
+    _TRACKED_STREAM_TYPE = AsyncTrackedStream
+
+    def _store_cached_response(self, cache_keys: Dict, content: str) -> None:
+        if content is None or not cache_keys:
+            return
+
+        def store() -> None:
+            try:
+                OAIClient._store_cached_response(self, cache_keys=cache_keys, content=content)
+            except Exception as e:
+                print(f"Warning: Could not cache response ({type(e).__name__}: {e}).")
+
+        _CACHE_WRITE_EXECUTOR.submit(store)
 
+    async def query(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = None,
+        temperature: float = None,
+        seed: int = None,
+        top_p: float = None,
+        max_tokens: int = None,
+        return_raw_response: bool = False,
+        stream: bool = False,
+        **kwargs,
+    ) -> Union[str, ChatCompletion, AsyncTrackedStream]:
+        request = self._build_request(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            seed=seed,
+            top_p=top_p,
+            max_tokens=max_tokens,
+            stream=stream,
+            **kwargs,
+        )
+        if self.response_cache is not None or self.semantic_cache is not None:
+            # Reading the SQLite tier (on an LRU miss), embedding the request and the vector search
+            # would block the event loop
+            cache_keys, cached_content = await asyncio.to_thread(
+                self._lookup_cached_response, request=request
+            )
+        else:
+            cache_keys, cached_content = self._lookup_cached_response(request=request)
+        if cached_content is not None:
+            return self._replay_cached_response(
+                request=request, content=cached_content, return_raw_response=return_raw_response
+            )
+        started_at = perf_counter()
+        response = await self._create(request=request)
+        return self._handle_response(
+            request=request,
+            response=response,
+            started_at=started_at,
+            return_raw_response=return_raw_response,
+            cache_keys=cache_keys,
+        )
+
+    async def _create(self, request: Dict) -> Union[ChatCompletion, AsyncStream]:
+        """Send a request once the rate limiter allows, retrying 429s and transient errors."""
+        if self.router is not None:
+            return await self._create_routed(request=request)
+        rate_limiter = self.get_rate_limiter(model=request["model"])
+        estimated_tokens = self._estimate_request_tokens(request=request)
+        for attempt in range(self.RATE_LIMIT_MAX_RETRIES + 1):
+            get_metrics().observe(
+                "rate_limit_wait",
+                await rate_limiter.aacquire(tokens=estimated_tokens, lane=self.RATE_LIMIT_LANE),
+            )
+            try:
+                raw_response = (
+                    await self._get_request_client().chat.completions.with_raw_response.create(
+                        **request
+                    )
+                )
+            except RateLimitError as e:
+                rate_limiter.penalize(headers=e.response.headers)
+                if attempt == self.RATE_LIMIT_MAX_RETRIES:
+                    raise
+            except (APIConnectionError, InternalServerError):
+                if attempt == self.RATE_LIMIT_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(backoff_s(attempt=attempt))
+            else:
+                rate_limiter.update_from_headers(headers=raw_response.headers)
+                return raw_response.parse()
+
+    async def _create_routed(self, request: Dict) -> Union[ChatCompletion, AsyncPrefetchedStream]:
+        """
+        Send a request to the best endpoint, failing over to the next ones on errors. Streams are
+        hedged on the second best endpoint if the router has a `hedge_after_s`.
+        """
+        estimated_tokens = self._estimate_request_tokens(request=request)
+        tried: List[Endpoint] = []
+        for attempt in range(self.RATE_LIMIT_MAX_RETRIES + 1):
+            ranked_endpoints = self.router.rank(exclude=tried)
+            if ranked_endpoints[0] in tried:
+                # Every endpoint failed this request already, so back off before another round
+                await asyncio.sleep(backoff_s(attempt=attempt))
+                tried = []
+            hedge_endpoint = None
+            if (
+                request["stream"]
+                and self.router.hedge_after_s is not None
+                and len(ranked_endpoints) > 1
+                and ranked_endpoints[1] not in tried
+            ):
+                hedge_endpoint = ranked_endpoints[1]
+            try:
+                return await self._race_endpoints(
+                    request=request,
+                    endpoint=ranked_endpoints[0],
+                    hedge_endpoint=hedge_endpoint,
+                    estimated_tokens=estimated_tokens,
+                )
+            except (RateLimitError, APIConnectionError, InternalServerError):
+                if attempt == self.RATE_LIMIT_MAX_RETRIES:
+                    raise
+                tried.append(ranked_endpoints[0])
+
+    async def _race_endpoints(
+        self,
+        request: Dict,
+        endpoint: Endpoint,
+        hedge_endpoint: Endpoint = None,
+        estimated_tokens: int = 0,
+    ) -> Union[ChatCompletion, AsyncPrefetchedStream]:
+        """
+        Send a request to an endpoint and, if its first token is later than the router's
+        `hedge_after_s`, to `hedge_endpoint` too. The first to answer wins, the other is cancelled.
+        """
+        if hedge_endpoint is None:
+            return await self._send_to_endpoint(
+                request=request, endpoint=endpoint, estimated_tokens=estimated_tokens
+            )
+        started_at = perf_counter()
+        primary = asyncio.ensure_future(
+            self._send_to_endpoint(
+                request=request, endpoint=endpoint, estimated_tokens=estimated_tokens
+            )
+        )
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.router.hedge_after_s)
+            if not done:
+                self.router.metrics["hedges"] += 1
+                hedge = asyncio.ensure_future(
+                    self._send_to_endpoint(
+                        request=request, endpoint=hedge_endpoint, estimated_tokens=estimated_tokens
+                    )
+                )
+                pending.add(hedge)
+            error = None
+            while done or pending:
+                if not done:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        # Both produced a first token at once, so drop the second stream
+                        await task.result().close()
+                if winner is not None:
+                    if winner is not primary:
+                        self.router.metrics["hedges_won"] += 1
+                        # The cancelled call took at least this long, so it stops ranking first
+                        self.router.observe_ttft(
+                            endpoint=endpoint, ttft_s=perf_counter() - started_at
+                        )
+                    return winner.result()
+                done = set()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            # Awaited, so the cancelled calls are done (and their errors retrieved) before this
+            # returns. One that finished before it could be cancelled still has a stream to close
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, AsyncPrefetchedStream):
+                    await result.close()
+
+    async def _send_to_endpoint(
+        self, request: Dict, endpoint: Endpoint, estimated_tokens: int
+    ) -> Union[ChatCompletion, AsyncPrefetchedStream]:
+        """Send a request to an endpoint, and update its stats (streams: on their first chunk)."""
+        rate_limiter = get_rate_limiter(key=endpoint.name, config=self.config)
+        get_metrics().observe(
+            "rate_limit_wait",
+            await rate_limiter.aacquire(tokens=estimated_tokens, lane=self.RATE_LIMIT_LANE),
+        )
+        self.router.on_start(endpoint=endpoint)
+        started_at, handed_off = perf_counter(), False
+        try:
+            raw_response = await endpoint.client.chat.completions.with_raw_response.create(
+                **endpoint.prepare(request)
+            )
+            rate_limiter.update_from_headers(headers=raw_response.headers)
+            response = raw_response.parse()
+            if request["stream"]:
+                # The endpoint stays loaded until the stream is closed
+                response = await aprefetch_stream(
+                    stream=response, on_close=lambda: self.router.on_end(endpoint=endpoint)
+                )
+                handed_off = True
+                self.router.record_success(endpoint=endpoint, ttft_s=perf_counter() - started_at)
+            else:
+                self.router.record_success(endpoint=endpoint, latency_s=perf_counter() - started_at)
+            return response
+        except RateLimitError as e:
+            retry_after_s = rate_limiter.penalize(headers=e.response.headers)
+            self.router.record_failure(endpoint=endpoint, cooldown_s=retry_after_s)
+            raise
+        except (APIConnectionError, InternalServerError):
+            self.router.record_failure(endpoint=endpoint)
+            raise
+        finally:
+            if not handed_off:
+                self.router.on_end(endpoint=endpoint)
+
+    async def _test_connection(self, print_output: bool = False) -> bool:
+        try:
+            response = await self.query(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": "say hi",
+                    },
+                ],
+                return_raw_response=True,
+            )
+            if print_output:
+                print(response)
+                print(response.choices[0].message.content)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    async def _close_client(self) -> None:
+        """Close OpenAI client."""
+        if not self.client.is_closed():
+            await self.client.close()
+
+    def _init_client(
+        self,
+        **kwargs,
+    ) -> AsyncOpenAI:
+        """Initialize AsyncOpenAI client."""
         if detect_is_work_device():
-            client = AzureOpenAI
+            client = AsyncAzureOpenAI
         else:
-            client = OpenAI
-        return client(**kwargs_subset)
+            client = AsyncOpenAI
+        return client(**self._get_client_kwargs(**kwargs))
 
 
 if __name__ == "__main__":
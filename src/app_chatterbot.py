@@ -1,19 +1,43 @@
 # Inspired from: https://www.gradio.app/guides/creating-a-custom-chatbot-with-blocks#adding-markdown-images-audio-or-videos
 
-import random
+import asyncio
 import time
+from os import environ
 from os.path import join
 
 import gradio as gr
-from pandas import DataFrame
 
-from api_client import OAIClient
-from utils import get_root_dir_path, get_src_dir_path
+from api_client import AsyncOAIClient, OAIClient
+from client_pool import get_session_client
+from context_window import ContextWindowManager, make_oai_summarizer
+from conversation import Conversation, to_messages
+from conversation_store import TURN_COLUMNS, ConversationStore, get_conversation_store
+from document_parsing import SUPPORTED_SUFFIXES
+from image_input import ImagePreprocessor, build_image_message, get_image_preprocessor
+from metrics import RequestTrace, get_metrics, start_metrics_server
+from prompts import DEFAULT_SYSTEM_PROMPT, TRANSLATOR_SYSTEM_PROMPT
+from rag_ingest import DocumentIngestor, IngestProgress, get_document_ingestor
+from retrieval import get_retriever, pack_context
+from session_store import SessionStore, get_session_store, restore_session, snapshot_session
+from speech import SpeechPipeline
+from stream_emitter import CoalescingEmitter, Ticker
+from utils import get_root_dir_path, get_src_dir_path, read_yaml_cached
+from warmup import StartupTimer, WarmUp, set_app_tiktoken_cache_dir
 
 TEXT_BLOCKING_MODE = True
-MOCK_PREDICT_MODE = False
-DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant."
-TRANSLATOR_SYSTEM_PROMPT = "You are a translater helping a client translate his english questions to Indonesian. Translate all the questions and statements provided by the client, and output his statement back in Indonesian"
+# Serve chat completions from a local mock backend (see mock_backend.py) instead of the API. Read
+# from the environment (e.g. set by load_test.py), as the warm-up starts when the app is imported.
+MOCK_PREDICT_MODE = environ.get("CHATBOT_MOCK_PREDICT", "0") == "1"
+# Streamed text is pushed to the UI at most every STREAM_FLUSH_INTERVAL_S seconds, or once
+# STREAM_FLUSH_CHARS new characters are buffered. The cost table refreshes every
+# COST_REFRESH_INTERVAL_S seconds while streaming, and at the end of each response.
+STREAM_FLUSH_INTERVAL_S = 0.05
+STREAM_FLUSH_CHARS = 64
+COST_REFRESH_INTERVAL_S = 1.0
+# Rows per page of the tables of the stats tab
+STATS_PAGE_SIZE = 50
+# Document ingestion progress refreshes at most every RAG_PROGRESS_INTERVAL_S seconds
+RAG_PROGRESS_INTERVAL_S = 0.5
 
 css = """
 #warning {background-color: #FFCCCB !important}
@@ -21,10 +45,6 @@ css = """
 """
 
 
-def say_hello():
-    print("hello")
-
-
 def add_text(user_message, chat_history):
     if TEXT_BLOCKING_MODE:
         return_msg = gr.Textbox(
@@ -34,98 +54,406 @@ def add_text(user_message, chat_history):
         )
     else:
         return_msg = ""
-    return return_msg, chat_history + [[user_message, None]]
-
-
-def bot_predict(
-    global_oai_client: OAIClient, system_prompt: str, chat_history: list, oai_messages_history: list
+    # Submission time, so bot_predict can tell how long the request waited in the queue
+    return return_msg, chat_history + [[user_message, None]], time.perf_counter()
+
+
+async def bot_predict(
+    global_oai_client: AsyncOAIClient,
+    context_window: ContextWindowManager,
+    system_prompt: str,
+    chat_history: list,
+    conversation: Conversation,
+    submitted_at: float = None,
+    use_rag: bool = False,
+    session_id: str = None,
+    pending_images: list = None,
+    use_voice: bool = False,
 ):
     global DEFAULT_SYSTEM_PROMPT
+    # Timings of each stage of the request are recorded as metrics (see metrics.py)
+    trace = RequestTrace(metrics=get_metrics())
+    if submitted_at is not None:
+        trace.add("queue_wait", trace.started_at - submitted_at)
     user_input = chat_history[-1][0]
 
     system_prompt = DEFAULT_SYSTEM_PROMPT if system_prompt in [None, ""] else system_prompt
-    global_oai_client = (
-        OAIClient(config_file=join(get_src_dir_path(), "config.yaml"))
-        if global_oai_client is None
-        else global_oai_client
+    session_store = get_app_session_store()
+    with trace.span("client_init"):
+        if global_oai_client is None:
+            # First request of the session handled by this process: its state (if any) is loaded
+            # from the session store, by the session id kept by the browser
+            global_oai_client = get_session_client(
+                config_file=join(get_src_dir_path(), "config.yaml"),
+                session_id=session_id or None,
+                mock=MOCK_PREDICT_MODE,
+            )
+            if session_store is not None and session_id and conversation is None:
+                state = await asyncio.to_thread(session_store.get, session_id)
+                if state is not None:
+                    conversation = restore_session(global_oai_client, state)
+        context_window = (
+            ContextWindowManager.from_config(
+                config=global_oai_client.config,
+                token_ledger=global_oai_client.get_token_ledger(),
+                summarizer=make_oai_summarizer(global_oai_client),
+            )
+            if context_window is None
+            else context_window
+        )
+    trace.attributes.update(session=global_oai_client.session_id, model=global_oai_client.MODEL)
+    # The conversation is kept once (the chat shown is a view of it). Without one, e.g. if its
+    # state was lost, it is rebuilt from the chat shown in the browser.
+    if conversation is None:
+        conversation = Conversation.from_chat_history(chat_history[:-1])
+    conversation.set_system_prompt(system_prompt)
+    # Images uploaded since the last message are sent with this one. The conversation only notes
+    # them, so they are not sent (nor stored) again with every later message.
+    images = []
+    if pending_images:
+        with trace.span("image_preprocess"):
+            images = await asyncio.to_thread(get_app_images, pending_images)
+    conversation.add("user", text=user_input, images=tuple(pending_images or ()))
+
+    # Excerpts of the uploaded documents, sent (but not kept in the history) before the question
+    rag_message = None
+    if use_rag:
+        with trace.span("retrieval"):
+            rag_message = await asyncio.to_thread(get_rag_message, user_input)
+
+    # Full history is kept, but only what fits the model's token budget is sent (the images' tokens
+    # are estimated from their size)
+    with trace.span("context_fit"):
+        reserved_tokens = sum(image.num_tokens for image in images)
+        if rag_message is not None:
+            reserved_tokens += context_window.token_ledger.count_message(rag_message)
+        messages = to_messages(context_window.fit(conversation, reserved_tokens=reserved_tokens))
+        if images:
+            messages = messages[:-1] + [build_image_message(user_input, images)]
+        if rag_message is not None:
+            messages = messages[:-1] + [rag_message] + messages[-1:]
+
+    # Sentences are read aloud as soon as they are complete, while the rest streams in
+    speech = (
+        SpeechPipeline.from_config(config=global_oai_client.config, oai_client=global_oai_client)
+        if use_voice
+        else None
     )
-    oai_messages_history = (
-        [
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
+    stream, outcome = None, "ok"
+    emitter = CoalescingEmitter(
+        flush_interval_s=STREAM_FLUSH_INTERVAL_S, flush_chars=STREAM_FLUSH_CHARS
+    )
+    cost_ticker = Ticker(interval_s=COST_REFRESH_INTERVAL_S)
+    try:
+        sent_at = time.perf_counter()
+        with trace.span("request_send"):
+            stream = await global_oai_client(
+                messages=messages,
+                return_raw_response=True,
+                stream=True,
+            )
+
+        # Chunks are buffered in the turn, and only joined when the chat is refreshed
+        reply = conversation.add("assistant", text="")
+        first_token_at = last_chunk_at = None
+        async for chunk in stream:
+            received_at = time.perf_counter()
+            if last_chunk_at is not None:
+                trace.add("inter_chunk", received_at - last_chunk_at)
+            last_chunk_at = received_at
+            if not chunk.choices:
+                # Trailing usage-only chunk
+                continue
+            new_msg_chunk = chunk.choices[0].delta
+            if new_msg_chunk.content and first_token_at is None:
+                first_token_at = received_at
+                trace.add("ttft", first_token_at - sent_at)
+
+            if not new_msg_chunk.content:
+                continue
+            reply.append(new_msg_chunk.content)
+            if speech is not None:
+                speech.feed(new_msg_chunk.content)
+            if emitter.count(len(new_msg_chunk.content)):
+                emitter.mark_flushed()
+                yielded_at = time.perf_counter()
+                yield global_oai_client, context_window, (
+                    get_accrued_costs_df(global_oai_client) if cost_ticker.due() else gr.update()
+                ), conversation.chat_view(), conversation, global_oai_client.session_id, None, (
+                    speech.pop_ready() if speech is not None else None
+                )
+                # Time Gradio took to take the update (before asking for the next one)
+                trace.add("ui_yield", time.perf_counter() - yielded_at)
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        if speech is not None and outcome != "ok":
+            speech.cancel()
+        # Also runs if the user stops the response (this task is cancelled): closing the stream
+        # releases its connection and bills the tokens received so far, and the partial answer
+        # is kept in the (in place updated) conversation
+        if stream is not None:
+            await stream.aclose()
+            reply.close()
+            trace.add("tokenization", getattr(stream, "tokenization_s", 0.0))
+        trace.finish(
+            outcome=outcome,
+            input_tokens=getattr(stream, "input_tokens", 0),
+            output_tokens=getattr(stream, "output_tokens", 0),
+        )
+        conversation_store = get_app_conversation_store()
+        if stream is not None and conversation_store is not None:
+            # Queued, the store writes it in the background
+            conversation_store.append_turn(
+                session=global_oai_client.session_id,
+                model=global_oai_client.MODEL,
+                user_message=user_input,
+                assistant_message=reply.text,
+                input_tokens=stream.input_tokens,
+                output_tokens=stream.output_tokens,
+                cost=stream.cost,
+                latency_s=trace.spans_s["total"],
+                outcome=outcome,
+            )
+        if stream is not None and session_store is not None:
+            # Saved after every turn, so the next request of the session can go to any process
+            await asyncio.to_thread(
+                session_store.put,
+                global_oai_client.session_id,
+                snapshot_session(global_oai_client, conversation),
+            )
+
+    if speech is not None:
+        # Audio of the sentences still being synthesized (the last one, at least)
+        async for audio in speech.remaining():
+            yield global_oai_client, context_window, gr.update(), gr.update(), (
+                conversation
+            ), global_oai_client.session_id, None, audio
+        if speech.first_audio_s is not None:
+            get_metrics().observe("tts_first_audio", speech.first_audio_s)
+
+    # Tokens and cost of the call were recorded (to the metrics and the usage ledger) by the
+    # stream once it finished
+    yield global_oai_client, context_window, get_accrued_costs_df(
+        global_oai_client
+    ), conversation.chat_view(), conversation, global_oai_client.session_id, None, None
+
+
+def get_accrued_costs_df(oai_client: OAIClient = None) -> dict:
+    # A plain table (rather than a pandas DataFrame), as it is refreshed while streaming
+    row = [0.0, 0, 0]
+    if oai_client is not None:
+        row = [
+            round(oai_client.pricing_cost, 2),
+            oai_client.input_tokens_used,
+            oai_client.output_tokens_used,
         ]
-        if oai_messages_history is None
-        else oai_messages_history
+    return {"headers": ["Cost (USD)", "Tokens (In)", "Tokens (Out)"], "data": [row]}
+
+
+def get_app_conversation_store() -> ConversationStore:
+    """Return the conversation store, or None if CONVERSATION_STORE is off in the config."""
+    config = read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+    if not config.get("CONVERSATION_STORE", False):
+        return None
+    return get_conversation_store(config=config)
+
+
+def get_app_session_store() -> SessionStore:
+    """
+    Return the session store selected by SESSION_STORE in the config, or None for the in-process
+    one: sessions already live in this process' gr.State, so a copy there would only double them.
+    """
+    config = read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+    if config.get("SESSION_STORE", "memory") == "memory":
+        return None
+    return get_session_store(config=config)
+
+
+def _to_stats_df(rows: list, columns: list):
+    # pandas is only imported once the stats tab is used (it is slow to import)
+    from pandas import DataFrame, to_datetime
+
+    df = DataFrame(rows, columns=columns)
+    for column in ("timestamp", "first_at", "last_at"):
+        if column in df.columns:
+            df[column] = to_datetime(df[column], unit="s").dt.strftime("%Y-%m-%d %H:%M:%S")
+    if "cost" in df.columns:
+        df["cost"] = df["cost"].round(4)
+    return df
+
+
+def get_usage_dfs():
+    """Return usage by model and by day (last 30 days), from the store's aggregates."""
+    conversation_store = get_app_conversation_store()
+    if conversation_store is None:
+        message = {"headers": ["Info"], "data": [["Set CONVERSATION_STORE: true in config.yaml"]]}
+        return message, message
+    columns = ["turns", "input_tokens", "output_tokens", "cost"]
+    since_day = time.strftime("%Y-%m-%d", time.gmtime(time.time() - 30 * 24 * 60 * 60))
+    return (
+        _to_stats_df(conversation_store.usage(by="model"), ["model"] + columns),
+        _to_stats_df(conversation_store.usage(by="day", since_day=since_day), ["day"] + columns),
     )
-    oai_messages_history[0] = {"role": "system", "content": system_prompt}
-    oai_messages_history.append({"role": "user", "content": user_input})
 
-    stream = global_oai_client(
-        messages=oai_messages_history,
-        return_raw_response=True,
-        stream=True,
+
+def get_sessions_page(page_state, direction: str = "first"):
+    """
+    Return a page of sessions (most recent first) and the new page state: the cursors of the
+    pages shown so far, and the cursor of the next (older) page, if any.
+    """
+    conversation_store = get_app_conversation_store()
+    columns = ["session", "first_at", "last_at", "turns", "input_tokens", "output_tokens", "cost"]
+    if conversation_store is None:
+        return _to_stats_df([], columns), None
+    page_cursors, next_cursor = page_state if page_state else ([None], None)
+    if direction == "older" and next_cursor is not None:
+        page_cursors = page_cursors + [next_cursor]
+    elif direction == "newer" and len(page_cursors) > 1:
+        page_cursors = page_cursors[:-1]
+    elif direction == "first":
+        page_cursors = [None]
+    rows = conversation_store.list_sessions(limit=STATS_PAGE_SIZE, before=page_cursors[-1])
+    next_cursor = (
+        (rows[-1]["last_at"], rows[-1]["session"]) if len(rows) == STATS_PAGE_SIZE else None
     )
+    return _to_stats_df(rows, columns), (page_cursors, next_cursor)
+
+
+def get_session_turns(session_id: str, turns_df=None, more: bool = False):
+    """Return the turns of a session, or with `more`, the next page appended to `turns_df`."""
+    conversation_store = get_app_conversation_store()
+    columns = ["id", *TURN_COLUMNS[1:]]
+    if conversation_store is None or not session_id:
+        return _to_stats_df([], columns)
+    after_id = 0
+    if more and turns_df is not None and len(turns_df):
+        after_id = int(turns_df["id"].iloc[-1])
+    rows = conversation_store.get_turns(
+        session=session_id.strip(), limit=STATS_PAGE_SIZE, after_id=after_id
+    )
+    df = _to_stats_df(rows, columns)
+    if after_id:
+        from pandas import concat
 
-    chat_history[-1][1] = ""
-    oai_messages_history.append({"role": "assistant", "content": None})
-    for chunk in stream:
-        new_msg_chunk = chunk.choices[0].delta
-        finish_flag = chunk.choices[0].finish_reason
-
-        # TODO: Consider incorporating this as part of stream object. WIP in api_client.py as well.
-        if finish_flag == "stop":
-            finished_response = chat_history[-1][1]
-            global_oai_client._postprocess(
-                messages=oai_messages_history,
-                model="gpt-3.5-turbo-1106"
-                if global_oai_client.MODEL == "zeroshot-exploration"
-                else global_oai_client.MODEL,  # TODO: Special work flag
-                response=finished_response,
-            )
-            print(f"INPUT tokens used: {global_oai_client.input_tokens_used}")
-            print(f"OUTPUT tokens used: {global_oai_client.output_tokens_used}")
-            print(f"Cumulative cost so far: $ {global_oai_client.pricing_cost}")
-
-        if new_msg_chunk.content is not None:
-            chat_history[-1][1] += new_msg_chunk.content
-            oai_messages_history[-1]["content"] = chat_history[-1][1]
-
-            time.sleep(0.02)
-            df_accrued_costs = DataFrame(
-                {
-                    "Cost (USD)": [round(global_oai_client.pricing_cost, 2)],
-                    "Tokens (In)": [global_oai_client.input_tokens_used],
-                    "Tokens (Out)": [global_oai_client.output_tokens_used],
-                }
-            )
-            yield global_oai_client, df_accrued_costs, chat_history, oai_messages_history
+        df = concat([turns_df, df], ignore_index=True)
+    return df
 
 
-def bot_mock_predict(chat_history, progress=gr.Progress()):
-    repeat_num = random.choice(range(3, 6))
-    bot_message = f"{repeat_num}: " + ("A repeating sentence. " * repeat_num)
-    chat_history[-1][1] = ""
-    for ind, character in enumerate(bot_message):
-        # progress(progress=0.05 * ind, desc="Processing")
-        chat_history[-1][1] += character
-        time.sleep(0.05)
-        yield chat_history
+def select_session_id(sessions_df, event: gr.SelectData) -> str:
+    return sessions_df["session"].iloc[event.index[0]]
 
 
-def add_file(history, file):
-    history = history + [((file.name,), None)]
-    return history
+def load_stats_tab(page_state):
+    return *get_usage_dfs(), *get_sessions_page(page_state, direction="first")
+
+
+def get_app_document_ingestor() -> DocumentIngestor:
+    config_file = join(get_src_dir_path(), "config.yaml")
+    return get_document_ingestor(
+        config=read_yaml_cached(input_path=config_file),
+        # Embeddings are requested synchronously, so use a sync client
+        openai_client_factory=lambda: OAIClient(config_file=config_file).client,
+    )
+
 
+def get_rag_message(query: str) -> dict:
+    """Return a system message with the document excerpts most relevant to a query, or None."""
+    config = read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+    retriever = get_retriever(config=config, ingestor=get_app_document_ingestor())
+    context = pack_context(
+        retriever.retrieve(query), max_tokens=config.get("RAG_CONTEXT_TOKENS", 2000)
+    )
+    return {"role": "system", "content": context} if context is not None else None
+
+
+def format_ingest_progress(progress: IngestProgress = None) -> str:
+    stats = get_app_document_ingestor().stats()
+    lines = [f"**Collection:** {stats['documents']} documents, {stats['chunks']} chunks"]
+    if progress is not None:
+        lines.append(
+            f"**Files:** {progress.files_done}/{progress.files_total} "
+            f"({progress.indexed} indexed, {progress.skipped} unchanged, "
+            f"{progress.failed} failed), {progress.chunks_added} chunks added "
+            f"in {progress.elapsed_s:.1f}s"
+        )
+        if progress.current is not None:
+            lines.append(f"Processed: `{progress.current}`")
+        lines += [f"- ⚠️ {error}" for error in progress.errors[-10:]]
+    return "\n\n".join(lines)
+
+
+def ingest_documents(file_paths: list):
+    """Ingest uploaded files into the RAG collection, streaming progress to the UI."""
+    if not file_paths:
+        yield format_ingest_progress()
+        return
+    ingestor = get_app_document_ingestor()
+    ticker = Ticker(interval_s=RAG_PROGRESS_INTERVAL_S)
+    for progress in ingestor.ingest(file_paths):
+        if progress.current is None or ticker.due():
+            yield format_ingest_progress(progress)
+
+
+def get_app_image_preprocessor() -> ImagePreprocessor:
+    """Return the image preprocessor, configured by the IMAGE_* keys of the config."""
+    config = read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+    return get_image_preprocessor(config=config)
+
+
+def get_app_images(paths: list) -> list:
+    """Return images prepared for the detail level of the config (IMAGE_DETAIL)."""
+    config = read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+    return get_app_image_preprocessor().prepare_many(
+        paths, detail=config.get("IMAGE_DETAIL", "high")
+    )
 
-def print_vote(data: gr.LikeData):
-    print(data.index, data.value, data.liked)
 
+def add_file(history, file, pending_images):
+    # Prepared in the background now, so it is (likely) cached by the time the message is sent
+    config = read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+    get_app_image_preprocessor().submit([file.name], detail=config.get("IMAGE_DETAIL", "high"))
+    history = history + [((file.name,), None)]
+    return history, (pending_images or []) + [file.name]
+
+
+def record_vote(data: gr.LikeData):
+    get_metrics().inc("votes", liked=str(data.liked))
+
+
+# The process-wide metrics are built by their first caller (here, the startup timer), so build
+# them from the config first (e.g. for METRICS_TRACE_LOG)
+get_metrics(config=read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml")))
+# Startup phases are timed (see warmup.py). What the first request would otherwise wait for
+# (tokenizer, shared client) is warmed up in the background while the UI is built.
+STARTUP_TIMER = StartupTimer()
+set_app_tiktoken_cache_dir(
+    config=read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml"))
+)
+app_warm_up = WarmUp.from_config(
+    config=read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml")),
+    config_file=join(get_src_dir_path(), "config.yaml"),
+    mock=MOCK_PREDICT_MODE,
+    timer=STARTUP_TIMER,
+)
+if read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml")).get("WARMUP", True):
+    app_warm_up.start()
 
 with gr.Blocks() as demo:
-    oai_messages_state = gr.State()
+    # The conversation (see conversation.py), of which the chatbot shows a view
+    conversation_state = gr.State()
     global_oai_client = gr.State()
+    context_window_state = gr.State()
+    submitted_at_state = gr.State()
+    # Images uploaded since the last message (sent with the next one)
+    pending_images_state = gr.State()
+    # Unlike gr.State (kept by the server process), the browser sends this with every request, so
+    # any app process can load the session's state from the session store
+    chat_session_id = gr.Textbox(visible=False)
     f_textbox_normal = lambda: gr.Textbox(
         value="",
         interactive=True,
@@ -135,12 +463,15 @@ with gr.Blocks() as demo:
         visible=True,
         container=False,
     )
-    f_button_running_disabled = lambda: gr.Button(
-        value="RUNNING...", size="lg", variant="stop", interactive=False
-    )
     f_button_submit = lambda: gr.Button(
-        value="Submit", size="lg", variant="primary", interactive=True
+        value="Submit", size="lg", variant="primary", interactive=True, visible=True
+    )
+    f_button_stop = lambda: gr.Button(
+        value="⏹️ Stop", size="lg", variant="stop", interactive=True, visible=False
     )
+    # While a response streams, the submit button is swapped for the stop button
+    f_buttons_running = lambda: (gr.Button(visible=False), gr.Button(visible=True))
+    f_buttons_idle = lambda: (f_button_submit(), f_button_stop())
 
     with gr.Tab(label="🤖 Chatterbot Demo", id="text2text"):
         with gr.Row():
@@ -165,22 +496,31 @@ with gr.Blocks() as demo:
                         interactive=True,
                         visible=True,
                     )
-                # TODO: This should be refreshed at end of predict action, instead of as part of the yield line.
+                    rag_checkbox = gr.Checkbox(
+                        label="📚 Answer from the documents (upload them in the RAG tab)",
+                        value=False,
+                        interactive=True,
+                    )
+                    voice_checkbox = gr.Checkbox(
+                        label="🔊 Read answers aloud", value=False, interactive=True
+                    )
+                    # Audio of each sentence is appended to the stream as soon as it is synthesized
+                    voice_output = gr.Audio(
+                        streaming=True,
+                        autoplay=True,
+                        show_label=False,
+                        interactive=False,
+                        format="mp3",
+                    )
                 accrued_cost_display = gr.DataFrame(
-                    value=DataFrame(
-                        {
-                            "Cost (USD)": [0.0],
-                            "Tokens (In)": [0.0],
-                            "Tokens (Out)": [0.0],
-                        }
-                    ),
+                    value=get_accrued_costs_df(),
                     label="Accrued costs",
                     show_label="hidden",
                     interactive=False,
                     visible=True,
                 )
                 media_upload_btn = gr.UploadButton(
-                    "📁", file_types=["image", "video", "audio"], interactive=False ,size="sm"
+                    "📁", file_types=["image"], interactive=True, size="sm"
                 )
 
             with gr.Column(scale=2):
@@ -198,6 +538,7 @@ with gr.Blocks() as demo:
                         txt = f_textbox_normal()
                     with gr.Column(scale=1):
                         submit_btn = f_button_submit()
+                        stop_btn = f_button_stop()
 
         with gr.Row():
             with gr.Column(scale=4):
@@ -224,68 +565,196 @@ with gr.Blocks() as demo:
                 inputs=[system_prompt_display],
             )
 
-    with gr.Tab(label="📚 Chatterbot Demo (w Rag!)", id="text2textwrag"):
-        gr.Markdown(value="# 🔨 Under construction 🚧")
+    with gr.Tab(label="📚 Chatterbot Demo (w Rag!)", id="text2textwrag") as rag_tab:
+        gr.Markdown(value="# 📚 Documents\nUpload documents to ingest them into the RAG collection.")
+        with gr.Row():
+            with gr.Column(scale=2):
+                rag_files = gr.File(
+                    label="Documents (text, markdown, html, pdf)",
+                    file_count="multiple",
+                    file_types=list(SUPPORTED_SUFFIXES),
+                )
+                rag_ingest_btn = gr.Button(value="📥 Ingest", variant="primary")
+            with gr.Column(scale=1):
+                rag_ingest_status = gr.Markdown()
 
-    with gr.Tab(label="📊 Chat history and stats", id="chatstats"):
-        gr.Markdown(value="# 🔨 Under construction 🚧")
+    with gr.Tab(label="📊 Chat history and stats", id="chatstats") as stats_tab:
+        sessions_page_state = gr.State()
+        with gr.Row():
+            gr.Markdown(value="# Chat history and stats")
+            stats_refresh_btn = gr.Button(value="🔄 Refresh", size="sm")
+        with gr.Row():
+            usage_by_model_display = gr.DataFrame(label="Usage by model", interactive=False)
+            usage_by_day_display = gr.DataFrame(label="Usage by day (UTC)", interactive=False)
+        sessions_display = gr.DataFrame(label="Sessions (most recent first)", interactive=False)
+        with gr.Row():
+            sessions_newer_btn = gr.Button(value="⬅️ Newer", size="sm")
+            sessions_older_btn = gr.Button(value="Older ➡️", size="sm")
+        with gr.Row():
+            session_id_txt = gr.Textbox(
+                show_label=False, placeholder="Session id (from the table above)", container=False
+            )
+            session_turns_btn = gr.Button(value="Show turns", size="sm")
+            session_turns_more_btn = gr.Button(value="More turns", size="sm")
+        session_turns_display = gr.DataFrame(label="Turns", interactive=False, wrap=True)
 
-    txt_msg = (
-        txt.submit(add_text, [txt, chatbot], [txt, chatbot], queue=False)
-        .then(f_button_running_disabled, None, submit_btn)
+    txt_msg_predict = (
+        txt.submit(add_text, [txt, chatbot], [txt, chatbot, submitted_at_state], queue=False)
+        .then(f_buttons_running, None, [submit_btn, stop_btn])
         .then(
             bot_predict,
-            [global_oai_client, system_prompt_display, chatbot, oai_messages_state],
             [
                 global_oai_client,
+                context_window_state,
+                system_prompt_display,
+                chatbot,
+                conversation_state,
+                submitted_at_state,
+                rag_checkbox,
+                chat_session_id,
+                pending_images_state,
+                voice_checkbox,
+            ],
+            [
+                global_oai_client,
+                context_window_state,
                 accrued_cost_display,
                 chatbot,
-                oai_messages_state,
+                conversation_state,
+                chat_session_id,
+                pending_images_state,
+                voice_output,
             ],
             api_name="bot_response",
             show_progress="hidden",
+            # Async, so streams wait on the network inside the event loop rather than each
+            # holding a worker thread
+            concurrency_limit=None,
         )
-        .then(f_button_submit, None, submit_btn)
     )
+    txt_msg = txt_msg_predict.then(f_buttons_idle, None, [submit_btn, stop_btn])
     # Need to reset button function as it's blocked during processing of user input
     txt_msg.then(f_textbox_normal, None, [txt], queue=False)
-    submit_btn_msg = (
-        submit_btn.click(add_text, [txt, chatbot], [txt, chatbot], queue=False)
-        .then(f_button_running_disabled, None, submit_btn)
+    submit_btn_msg_predict = (
+        submit_btn.click(add_text, [txt, chatbot], [txt, chatbot, submitted_at_state], queue=False)
+        .then(f_buttons_running, None, [submit_btn, stop_btn])
         .then(
             bot_predict,
-            [global_oai_client, system_prompt_display, chatbot, oai_messages_state],
             [
                 global_oai_client,
+                context_window_state,
+                system_prompt_display,
+                chatbot,
+                conversation_state,
+                submitted_at_state,
+                rag_checkbox,
+                chat_session_id,
+                pending_images_state,
+                voice_checkbox,
+            ],
+            [
+                global_oai_client,
+                context_window_state,
                 accrued_cost_display,
                 chatbot,
-                oai_messages_state,
+                conversation_state,
+                chat_session_id,
+                pending_images_state,
+                voice_output,
             ],
             api_name="bot_response",
+            concurrency_limit=None,
         )
-        .then(f_button_submit, None, submit_btn)
     )
+    submit_btn_msg = submit_btn_msg_predict.then(f_buttons_idle, None, [submit_btn, stop_btn])
     # Need to reset button function as it's blocked during processing of user input
     submit_btn_msg.then(f_textbox_normal, None, [txt], queue=False)
+    # Cancelling bot_predict closes its upstream stream (see its `finally`). Events chained after
+    # a cancelled one do not run, so the buttons and textbox are reset here.
+    stop_btn.click(
+        lambda: (*f_buttons_idle(), f_textbox_normal()),
+        None,
+        [submit_btn, stop_btn, txt],
+        cancels=[txt_msg_predict, submit_btn_msg_predict],
+        queue=False,
+    )
 
+    # A new session id is assigned on the next message
     system_prompt_btn.click(
-        lambda: (None, None, None),
+        lambda: (None, None, None, None, "", None),
         None,
-        [global_oai_client, chatbot, oai_messages_state],
+        [
+            global_oai_client,
+            context_window_state,
+            chatbot,
+            conversation_state,
+            chat_session_id,
+            pending_images_state,
+        ],
         queue=False,
     )
     clear_btn.click(
-        lambda: (None, None, None, None),
+        lambda: (None, None, None, None, None, "", None),
         None,
-        [global_oai_client, chatbot, oai_messages_state, system_prompt_display],
+        [
+            global_oai_client,
+            context_window_state,
+            chatbot,
+            conversation_state,
+            system_prompt_display,
+            chat_session_id,
+            pending_images_state,
+        ],
         queue=False,
     )
+    # Images are sent with the next message
     file_msg = media_upload_btn.upload(
-        add_file, [chatbot, media_upload_btn], [chatbot], queue=False
-    ).then(bot_mock_predict, chatbot, chatbot)
+        add_file,
+        [chatbot, media_upload_btn, pending_images_state],
+        [chatbot, pending_images_state],
+        queue=False,
+    )
+
+    chatbot.like(record_vote, None, None)
+
+    # Stats are only read from the store when the tab is opened (or refreshed)
+    stats_tab_outputs = [
+        usage_by_model_display,
+        usage_by_day_display,
+        sessions_display,
+        sessions_page_state,
+    ]
+    rag_tab.select(format_ingest_progress, None, rag_ingest_status)
+    rag_ingest_btn.click(
+        ingest_documents, [rag_files], [rag_ingest_status], show_progress="minimal"
+    )
+    stats_tab.select(load_stats_tab, [sessions_page_state], stats_tab_outputs)
+    stats_refresh_btn.click(load_stats_tab, [sessions_page_state], stats_tab_outputs)
+    sessions_newer_btn.click(
+        lambda page_state: get_sessions_page(page_state, direction="newer"),
+        [sessions_page_state],
+        [sessions_display, sessions_page_state],
+    )
+    sessions_older_btn.click(
+        lambda page_state: get_sessions_page(page_state, direction="older"),
+        [sessions_page_state],
+        [sessions_display, sessions_page_state],
+    )
+    sessions_display.select(select_session_id, [sessions_display], session_id_txt)
+    session_turns_btn.click(get_session_turns, [session_id_txt], [session_turns_display])
+    session_turns_more_btn.click(
+        lambda session_id, turns_df: get_session_turns(session_id, turns_df, more=True),
+        [session_id_txt, session_turns_display],
+        [session_turns_display],
+    )
 
-    chatbot.like(print_vote, None, None)
+    # Connections to the API are opened from the server's event loop, so on the first page load
+    demo.load(app_warm_up.open_connections, None, None, queue=False)
 
+STARTUP_TIMER.mark("ui_build")
+STARTUP_TIMER.log()
 demo.queue()
+# Serves Prometheus metrics if METRICS_PORT is set in the config
+start_metrics_server(config=read_yaml_cached(input_path=join(get_src_dir_path(), "config.yaml")))
 if __name__ == "__main__":
     demo.launch(share=False)
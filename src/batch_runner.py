@@ -0,0 +1,246 @@
+"""
+Offline batch inference over a JSONL file of chat requests.
+
+Requests are streamed from disk and run concurrently (with bounded parallelism) through an
+AsyncOAIClient. Results are appended to an output JSONL as they complete, so a crashed or
+interrupted run can be resumed: requests whose id already has a result in the output are skipped,
+and those that failed are run again (their error rows are removed from the output first). A usage
+and cost summary is printed at the end.
+
+The client already retries 429s and transient errors (through the rate limiter, see
+rate_limiter.py), so a request is only retried here, a few times (`--max-retries`), once those
+retries are used up. Other errors (e.g. an invalid request) are not retried. Rate limits are only
+shared with the other clients of this process: a batch run started alongside the app spends its own
+RATE_LIMITS quota, so configure them for its share.
+
+Each input line is a JSON object with an id field (`--id-field`, default "request_id") and either:
+- "messages": a list of OpenAI chat messages, used as-is, or
+- the text field(s) given by `--prompt-fields` (joined by a blank line), sent as the user message
+  after the `--system-prompt`.
+
+Usage:
+
+    python src/batch_runner.py requests.jsonl results.jsonl --concurrency 32
+    python src/batch_runner.py requests.jsonl results.jsonl --system-prompt translator \
+        --prompt-fields title,body
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from os.path import exists, join
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from api_client import AsyncOAIClient
+from client_pool import get_session_client
+from prompts import DEFAULT_SYSTEM_PROMPT, TRANSLATOR_SYSTEM_PROMPT
+from rate_limiter import backoff_s
+from utils import get_src_dir_path
+
+SYSTEM_PROMPT_PRESETS = {
+    "default": DEFAULT_SYSTEM_PROMPT,
+    "translator": TRANSLATOR_SYSTEM_PROMPT,
+}
+
+
+def read_completed_ids(output_path: str, id_field: str) -> Set[str]:
+    """
+    Return ids with a successful result in an output file. The output is rewritten without its
+    other rows (errors, which will be run again, duplicates and a torn last line), if any.
+    """
+    completed = set()
+    if not exists(output_path):
+        return completed
+    kept_lines, num_lines = [], 0
+    with open(output_path, "r") as file:
+        for line in file:
+            num_lines += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            request_id = str(record[id_field])
+            if record.get("error") is None and request_id not in completed:
+                completed.add(request_id)
+                kept_lines.append(line if line.endswith("\n") else line + "\n")
+    if len(kept_lines) < num_lines:
+        # Written next to the output, then swapped in, so a crash leaves either file whole
+        temp_path = f"{output_path}.tmp"
+        with open(temp_path, "w") as file:
+            file.writelines(kept_lines)
+        os.replace(temp_path, output_path)
+    return completed
+
+
+def iter_requests(
+    input_path: str,
+    id_field: str,
+    prompt_fields: List[str],
+    system_prompt: str,
+    skip_ids: Set[str],
+) -> Iterator[Tuple[str, List[Dict[str, str]], Dict]]:
+    """Lazily yield (id, messages, request params) for each pending request of an input file."""
+    with open(input_path, "r") as file:
+        for line_idx, line in enumerate(file):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            request_id = str(record.get(id_field, line_idx))
+            if request_id in skip_ids:
+                continue
+            messages = record.get("messages")
+            if messages is None:
+                prompt = "\n\n".join(str(record[field]) for field in prompt_fields if field in record)
+                messages = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt},
+                ]
+            params = {
+                key: record[key]
+                for key in ("model", "temperature", "seed", "top_p", "max_tokens")
+                if key in record
+            }
+            yield request_id, messages, params
+
+
+async def run_request(
+    oai_client: AsyncOAIClient,
+    messages: List[Dict[str, str]],
+    params: Dict,
+    max_retries: int,
+) -> Dict:
+    """
+    Run one request, retrying 429s and transient errors (once the client's own retries are used
+    up) with exponential backoff. Returns its result fields.
+    """
+    for attempt in range(max_retries + 1):
+        started_at = time.perf_counter()
+        try:
+            response = await oai_client.query(
+                messages=messages, return_raw_response=True, **params
+            )
+            usage = getattr(response, "usage", None)
+            return {
+                "response": response.choices[0].message.content,
+                "finish_reason": response.choices[0].finish_reason,
+                "model": response.model,
+                "usage": usage.model_dump() if usage is not None else None,
+                "latency_s": round(time.perf_counter() - started_at, 3),
+                "attempts": attempt + 1,
+            }
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            error = f"{type(e).__name__}: {e}"
+            if attempt < max_retries:
+                await asyncio.sleep(backoff_s(attempt=attempt, base_s=2.0, max_s=30.0))
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}", "attempts": attempt + 1}
+    return {"error": error, "attempts": max_retries + 1}
+
+
+async def run_batch(
+    oai_client: AsyncOAIClient,
+    requests: Iterator[Tuple[str, List[Dict[str, str]], Dict]],
+    output_path: str,
+    id_field: str,
+    concurrency: int,
+    max_retries: int,
+) -> Dict[str, int]:
+    """Run requests with at most `concurrency` in flight, appending results as they complete."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * concurrency)
+    counts = {"succeeded": 0, "failed": 0}
+
+    with open(output_path, "a") as output_file:
+
+        async def worker() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                request_id, messages, params = item
+                result = await run_request(
+                    oai_client=oai_client, messages=messages, params=params, max_retries=max_retries
+                )
+                output_file.write(json.dumps({id_field: request_id, **result}) + "\n")
+                output_file.flush()
+                counts["failed" if "error" in result else "succeeded"] += 1
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        # Reading the input is paced by the queue, so large files are never fully in memory
+        for item in requests:
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    return counts
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input_path", help="JSONL file of requests")
+    parser.add_argument("output_path", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max requests in flight")
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=1,
+        help="Retries per request, once the client's retries of 429s and transient errors fail",
+    )
+    parser.add_argument("--id-field", default="request_id", help="Field holding request ids")
+    parser.add_argument(
+        "--prompt-fields", default="prompt", help="Comma separated fields making up the prompt"
+    )
+    parser.add_argument(
+        "--system-prompt",
+        default="default",
+        help=f"System prompt, or one of the presets: {', '.join(SYSTEM_PROMPT_PRESETS)}",
+    )
+    parser.add_argument("--config-file", default=join(get_src_dir_path(), "config.yaml"))
+    parser.add_argument("--mock", action="store_true", help="Use the mock backend (no API calls)")
+    args = parser.parse_args(args)
+
+    completed_ids = read_completed_ids(output_path=args.output_path, id_field=args.id_field)
+    requests = iter_requests(
+        input_path=args.input_path,
+        id_field=args.id_field,
+        prompt_fields=args.prompt_fields.split(","),
+        system_prompt=SYSTEM_PROMPT_PRESETS.get(args.system_prompt, args.system_prompt),
+        skip_ids=completed_ids,
+    )
+    oai_client = get_session_client(
+        config_file=args.config_file, session_id=f"batch-{int(time.time())}", mock=args.mock
+    )
+    # Waits its turn behind interactive calls of this process (the limits are per process, see
+    # the module docstring)
+    oai_client.RATE_LIMIT_LANE = "batch"
+
+    started_at = time.perf_counter()
+    counts = asyncio.run(
+        run_batch(
+            oai_client=oai_client,
+            requests=requests,
+            output_path=args.output_path,
+            id_field=args.id_field,
+            concurrency=args.concurrency,
+            max_retries=args.max_retries,
+        )
+    )
+    wall_time_s = time.perf_counter() - started_at
+    summary = {
+        "skipped (already completed)": len(completed_ids),
+        **counts,
+        "wall_time_s": round(wall_time_s, 2),
+        "requests_per_s": round((counts["succeeded"] + counts["failed"]) / wall_time_s, 2),
+        "input_tokens": oai_client.input_tokens_used,
+        "output_tokens": oai_client.output_tokens_used,
+        "cost_usd": round(oai_client.pricing_cost, 4),
+        "by_model": oai_client.usage_ledger.aggregate(by="model"),
+    }
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+from importlib.util import find_spec
+from os.path import join
+from threading import Lock
+from typing import Dict, Tuple, Type, Union
+
+import httpx
+from box.box import Box
+from openai import AsyncOpenAI, OpenAI
+
+from api_client import AsyncOAIClient, OAIClient
+from endpoint_router import get_endpoint_router
+from mock_backend import MockChatBackend, build_mock_openai_client
+from utils import get_src_dir_path, read_yaml_cached
+
+DEFAULT_CONFIG_FILE_PATH = join(get_src_dir_path(), "config.yaml")
+
+# Default HTTP pool params (will be overwritten if param is specified in config file!)
+HTTP_POOL_DEFAULTS = {
+    "HTTP_MAX_CONNECTIONS": 100,
+    "HTTP_MAX_KEEPALIVE_CONNECTIONS": 20,
+    "HTTP_KEEPALIVE_EXPIRY": 60.0,  # seconds
+    "HTTP_TIMEOUT": 600.0,  # seconds
+    "HTTP2": True,
+}
+
+# One OpenAI transport (and so one HTTP connection pool) per (OAIClient type, config file, mock)
+_SHARED_CLIENTS: Dict[Tuple[Type[OAIClient], str, bool], Union[OpenAI, AsyncOpenAI]] = dict()
+_SHARED_CLIENTS_LOCK = Lock()
+
+
+def get_http_pool_params(config: Box = None) -> Dict:
+    """Resolve HTTP pool params from config, falling back to defaults."""
+    params = dict(HTTP_POOL_DEFAULTS)
+    if config is not None:
+        params.update({key: config[key] for key in HTTP_POOL_DEFAULTS if key in config})
+    if params["HTTP2"] and find_spec("h2") is None:
+        print("Warning: HTTP2 requested but `h2` is not installed (pip install httpx[http2]).")
+        params["HTTP2"] = False
+    return params
+
+
+def build_http_client(
+    config: Box = None, async_client: bool = True
+) -> Union[httpx.Client, httpx.AsyncClient]:
+    """Build a keep-alive HTTP client with the pool limits from config."""
+    params = get_http_pool_params(config=config)
+    http_client_type = httpx.AsyncClient if async_client else httpx.Client
+    return http_client_type(
+        limits=httpx.Limits(
+            max_connections=params["HTTP_MAX_CONNECTIONS"],
+            max_keepalive_connections=params["HTTP_MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=params["HTTP_KEEPALIVE_EXPIRY"],
+        ),
+        timeout=httpx.Timeout(params["HTTP_TIMEOUT"], connect=5.0),
+        http2=params["HTTP2"],
+        follow_redirects=True,
+    )
+
+
+def get_shared_client(
+    oai_client_type: Type[OAIClient] = AsyncOAIClient,
+    config_file: str = DEFAULT_CONFIG_FILE_PATH,
+    mock: bool = False,
+) -> Union[OpenAI, AsyncOpenAI]:
+    """
+    Return the process-wide OpenAI transport for an OAIClient type, creating it on first use.
+    All sessions share its HTTP connection pool, so warm (keep-alive) connections are reused
+    across sessions instead of every session paying for its own TLS handshakes.
+    If `mock`, requests are served by a local mock backend (see mock_backend.py) instead.
+    """
+    key = (oai_client_type, config_file, mock)
+    client = _SHARED_CLIENTS.get(key)
+    if client is None:
+        with _SHARED_CLIENTS_LOCK:
+            client = _SHARED_CLIENTS.get(key)
+            if client is None:
+                config = read_yaml_cached(input_path=config_file) if config_file else None
+                async_client = issubclass(oai_client_type, AsyncOAIClient)
+                if mock:
+                    client = build_mock_openai_client(
+                        backend=MockChatBackend.from_config(config=config),
+                        async_client=async_client,
+                    )
+                else:
+                    http_client = build_http_client(config=config, async_client=async_client)
+                    # Build a throwaway OAIClient to resolve the client params the usual way
+                    client = oai_client_type(
+                        config_file=config_file, http_client=http_client
+                    ).client
+                _SHARED_CLIENTS[key] = client
+    return client
+
+
+def get_session_client(
+    oai_client_type: Type[OAIClient] = AsyncOAIClient,
+    config_file: str = DEFAULT_CONFIG_FILE_PATH,
+    session_id: str = None,
+    mock: bool = False,
+) -> OAIClient:
+    """
+    Return a new OAIClient for a session, on top of the shared transport.
+    The OAIClient only holds per-session state (token counters, ledgers), so it is cheap to build.
+    If the config lists `ENDPOINTS`, the session is routed across them by the shared router.
+    """
+    config = read_yaml_cached(input_path=config_file) if config_file else None
+    if not mock and config is not None and config.get("ENDPOINTS"):
+        async_client = issubclass(oai_client_type, AsyncOAIClient)
+        router = get_endpoint_router(
+            config=config,
+            async_client=async_client,
+            http_client_factory=lambda: build_http_client(config=config, async_client=async_client),
+        )
+        return oai_client_type(config_file=config_file, router=router, session_id=session_id)
+    return oai_client_type(
+        config_file=config_file,
+        client=get_shared_client(
+            oai_client_type=oai_client_type, config_file=config_file, mock=mock
+        ),
+        session_id=session_id,
+    )
@@ -0,0 +1,206 @@
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from box.box import Box
+
+from conversation import Turn
+from utils import TokenLedger
+
+# Context window sizes (in tokens) of models. Overridable from the config file.
+# https://platform.openai.com/docs/models
+DEFAULT_CONTEXT_WINDOW_TOKENS: Dict[str, int] = {
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k-0613": 16385,
+    "gpt-4-0613": 8192,
+    "gpt-4-32k-0613": 32768,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-vision-preview": 128000,
+}
+FALLBACK_CONTEXT_WINDOW_TOKENS = 4096
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in at most 150 words. Keep facts, names, numbers, decisions "
+    "and the user's stated preferences; drop pleasantries. Write it as notes for yourself."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+Summarizer = Callable[[List[Dict[str, str]]], Union[str, Awaitable[str]]]
+
+# Summaries run off the request path, on a single background worker
+_SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-summary")
+
+
+class ContextWindowManager:
+    """
+    Picks which messages of a conversation to send so the request fits a token budget.
+
+    Policies:
+    - "sliding_window": the most recent messages that fit (the system prompt may be dropped).
+    - "pinned_system": the leading system message(s), plus the most recent messages that fit.
+    - "summarize": like "pinned_system", but the dropped older messages are summarized in the
+      background and the summary is sent in their place once it is ready.
+
+    Token counts come from the session's TokenLedger, so each message is only tokenized once.
+    """
+
+    POLICIES = ("sliding_window", "pinned_system", "summarize")
+
+    def __init__(
+        self,
+        token_ledger: TokenLedger,
+        max_input_tokens: int,
+        policy: str = "pinned_system",
+        summarizer: Summarizer = None,
+    ) -> None:
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown context window policy: {policy}. Expected {self.POLICIES}")
+        if policy == "summarize" and summarizer is None:
+            raise ValueError("The summarize policy requires a summarizer.")
+        self.token_ledger = token_ledger
+        self.max_input_tokens = max_input_tokens
+        self.policy = policy
+        self.summarizer = summarizer
+        # Summary of the first `_num_summarized` non-system messages of the conversation
+        self._summary_message: Optional[Dict[str, str]] = None
+        self._num_summarized = 0
+        self._pending_summary = None
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Optional[Box],
+        token_ledger: TokenLedger,
+        summarizer: Summarizer = None,
+    ) -> "ContextWindowManager":
+        """Build manager from the `CONTEXT_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        context_window_tokens = dict(DEFAULT_CONTEXT_WINDOW_TOKENS)
+        context_window_tokens.update(config.get("CONTEXT_WINDOW_TOKENS", None) or {})
+        max_input_tokens = config.get("CONTEXT_MAX_INPUT_TOKENS", None)
+        if max_input_tokens is None:
+            max_input_tokens = context_window_tokens.get(
+                token_ledger.model, FALLBACK_CONTEXT_WINDOW_TOKENS
+            ) - config.get("CONTEXT_RESERVED_OUTPUT_TOKENS", 1024)
+        return cls(
+            token_ledger=token_ledger,
+            max_input_tokens=max_input_tokens,
+            policy=config.get("CONTEXT_WINDOW_POLICY", "pinned_system"),
+            summarizer=summarizer,
+        )
+
+    def fit(
+        self, messages: List[Dict[str, str]], reserved_tokens: int = 0
+    ) -> List[Dict[str, str]]:
+        """
+        Return the messages to send (the input list is not modified), leaving `reserved_tokens`
+        of the budget for messages added afterwards (e.g. retrieved documents). Messages may also
+        be a conversation.Conversation, whose turns are then returned (see to_messages).
+        """
+        if self.policy == "sliding_window":
+            return self._fit_recent(pinned=[], messages=messages, reserved_tokens=reserved_tokens)
+
+        num_pinned = 0
+        while num_pinned < len(messages) and messages[num_pinned]["role"] == "system":
+            num_pinned += 1
+        pinned, history = messages[:num_pinned], messages[num_pinned:]
+        if self.policy == "summarize" and self._summary_message is not None:
+            pinned = pinned + [self._summary_message]
+            history = history[self._num_summarized :]
+
+        fitted = self._fit_recent(pinned=pinned, messages=history, reserved_tokens=reserved_tokens)
+        num_dropped = len(history) - (len(fitted) - len(pinned))
+        if self.policy == "summarize" and num_dropped > 0:
+            self._schedule_summary(history=messages[num_pinned:], num_dropped=num_dropped)
+        return fitted
+
+    def _fit_recent(
+        self, pinned: List[Dict[str, str]], messages: List[Dict[str, str]], reserved_tokens: int = 0
+    ) -> List[Dict[str, str]]:
+        """Return pinned messages plus the longest suffix of messages that fits the budget."""
+        # +3: every reply is primed with <|start|>assistant<|message|>
+        budget = (
+            self.max_input_tokens
+            - reserved_tokens
+            - sum(self._count(message) for message in pinned)
+            - 3
+        )
+        start = len(messages)
+        while start > 0:
+            num_tokens = self._count(messages[start - 1])
+            if num_tokens > budget:
+                break
+            budget -= num_tokens
+            start -= 1
+        # Never send an assistant message without the user message it answers
+        while start < len(messages) and messages[start]["role"] == "assistant":
+            start += 1
+        if start == len(messages) and messages:
+            print("Warning: last message does not fit the context window. Sending it anyway.")
+            start = len(messages) - 1
+        return pinned + messages[start:]
+
+    def _count(self, message: Dict[str, str]) -> int:
+        # Turns of a conversation.Conversation cache their own count
+        if isinstance(message, Turn):
+            return message.count_tokens(self.token_ledger)
+        return self.token_ledger.count_message(message)
+
+    def _schedule_summary(self, history: List[Dict[str, str]], num_dropped: int) -> None:
+        """Summarize (the previous summary plus) newly dropped messages in the background."""
+        if self._pending_summary is not None and not self._pending_summary.done():
+            return
+        num_summarized = self._num_summarized + num_dropped
+        to_summarize = ([self._summary_message] if self._summary_message else []) + history[
+            self._num_summarized : num_summarized
+        ]
+        # Copies, as the live history's last message is still being streamed into
+        to_summarize = [dict(message) for message in to_summarize]
+        summary_messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": "\n".join(f"{m['role']}: {m['content']}" for m in to_summarize),
+            },
+        ]
+
+        def on_summary(summary: str) -> None:
+            if summary:
+                self._summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary}
+                self._num_summarized = num_summarized
+
+        if inspect.iscoroutinefunction(self.summarizer):
+
+            async def summarize() -> None:
+                try:
+                    on_summary(await self.summarizer(summary_messages))
+                except Exception as e:
+                    print(f"Warning: failed to summarize conversation: {e}")
+
+            self._pending_summary = asyncio.get_running_loop().create_task(summarize())
+        else:
+
+            def summarize() -> None:
+                try:
+                    on_summary(self.summarizer(summary_messages))
+                except Exception as e:
+                    print(f"Warning: failed to summarize conversation: {e}")
+
+            self._pending_summary = _SUMMARY_EXECUTOR.submit(summarize)
+
+
+def make_oai_summarizer(oai_client, max_tokens: int = 256) -> Summarizer:
+    """Return a summarizer that queries an OAIClient (or AsyncOAIClient) for the summary."""
+    if inspect.iscoroutinefunction(oai_client.query):
+
+        async def summarize(messages: List[Dict[str, str]]) -> str:
+            return await oai_client.query(messages=messages, max_tokens=max_tokens)
+
+    else:
+
+        def summarize(messages: List[Dict[str, str]]) -> str:
+            return oai_client.query(messages=messages, max_tokens=max_tokens)
+
+    return summarize
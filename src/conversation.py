@@ -0,0 +1,197 @@
+"""
+The conversation of a chat session, kept once.
+
+A Conversation is a list of Turns (system, user and assistant messages), from which both views of
+it are produced on demand: the OpenAI message list (`messages`, or `to_messages` of the turns
+picked by the context window) and the Gradio chatbot's [user, assistant] pairs (`chat_view`). The
+views reference the turns' strings rather than copying them, and the chatbot pairs of the turns
+before the last user message are cached, so refreshing the chat while an answer streams in only
+rebuilds its last pair.
+
+Turns use `__slots__` (no per-instance dict), and read like OpenAI message dicts (`turn["role"]`,
+`turn["content"]`), so they can be passed where messages are expected (e.g. to
+ContextWindowManager.fit). A turn caches its token count, and an assistant turn being streamed
+into buffers its chunks: appending one costs O(chunk), and they are only joined when its content
+is read (e.g. once per UI refresh).
+"""
+
+from collections.abc import Mapping, Sequence
+from os.path import basename
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+MESSAGE_FIELDS = ("role", "content")
+
+
+class Turn(Mapping):
+    """A message of a conversation, with the images sent with it and its cached token count."""
+
+    __slots__ = ("role", "_text", "_chunks", "images", "_num_tokens", "_tokens_model")
+
+    def __init__(self, role: str, text: Optional[str] = None, images: Tuple[str, ...] = ()) -> None:
+        self.role = role
+        self._text = text
+        # Chunks streamed in since the content was last read (None once the turn is complete)
+        self._chunks: Optional[List[str]] = None
+        # Paths of the images sent with a user message (shown in the chat, noted in the content)
+        self.images = images
+        self._num_tokens: Optional[int] = None
+        self._tokens_model: Optional[str] = None
+
+    @property
+    def text(self) -> Optional[str]:
+        """The message as written (without the notes of its images)."""
+        if self._chunks:
+            self._text = (self._text or "") + "".join(self._chunks)
+            self._chunks.clear()
+        return self._text
+
+    @property
+    def content(self) -> Optional[str]:
+        """The message as sent to the model: its text, and a note of each image sent with it."""
+        if not self.images:
+            return self.text
+        return (self.text or "") + "".join(f"\n[image: {basename(path)}]" for path in self.images)
+
+    def append(self, chunk: str) -> None:
+        """Add a streamed chunk of text."""
+        if self._chunks is None:
+            self._chunks = []
+            if self._text is None:
+                self._text = ""
+        self._chunks.append(chunk)
+        self._num_tokens = None
+
+    def close(self) -> None:
+        """Join the streamed chunks, and drop the chunk buffer."""
+        self._text = self.text
+        self._chunks = None
+
+    def count_tokens(self, token_ledger) -> int:
+        """Return the tokens of the message (counted by a utils.TokenLedger once, then cached)."""
+        if self._num_tokens is None or self._tokens_model != token_ledger.model:
+            self._num_tokens = token_ledger.count_message(self.to_message(), cache=False)
+            self._tokens_model = token_ledger.model
+        return self._num_tokens
+
+    def to_message(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+    def __getitem__(self, field: str) -> Optional[str]:
+        if field == "role":
+            return self.role
+        if field == "content":
+            return self.content
+        raise KeyError(field)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(MESSAGE_FIELDS)
+
+    def __len__(self) -> int:
+        return len(MESSAGE_FIELDS)
+
+    def __repr__(self) -> str:
+        return f"Turn(role={self.role!r}, content={self.content!r})"
+
+
+def to_messages(messages: Iterable[Union[Turn, Dict[str, str]]]) -> List[Dict[str, str]]:
+    """Return OpenAI message dicts of turns (messages that are already dicts are kept as is)."""
+    return [message.to_message() if isinstance(message, Turn) else message for message in messages]
+
+
+class Conversation(Sequence):
+    """The turns of a chat session, starting with its system prompt (if any)."""
+
+    __slots__ = ("turns", "_pairs", "_num_cached_turns", "_num_cached_pairs")
+
+    def __init__(self, turns: List[Turn] = None) -> None:
+        self.turns: List[Turn] = turns if turns is not None else []
+        # Chatbot pairs of the first `_num_cached_turns` turns (those before the last user message,
+        # which do not change any more), followed by the pairs of the turns after them
+        self._pairs: List[List] = []
+        self._num_cached_turns = 0
+        self._num_cached_pairs = 0
+
+    @classmethod
+    def from_messages(cls, messages: Iterable[Dict[str, str]]) -> "Conversation":
+        """Build a conversation from OpenAI message dicts."""
+        return cls([Turn(role=message["role"], text=message["content"]) for message in messages])
+
+    @classmethod
+    def from_chat_history(cls, chat_history: Iterable[List]) -> "Conversation":
+        """Build a conversation from Gradio chatbot pairs (images shown in the chat are skipped)."""
+        turns = []
+        for user_message, assistant_message in chat_history:
+            if isinstance(user_message, str):
+                turns.append(Turn(role="user", text=user_message))
+            if isinstance(assistant_message, str):
+                turns.append(Turn(role="assistant", text=assistant_message))
+        return cls(turns)
+
+    @classmethod
+    def from_state(cls, state: List[List]) -> "Conversation":
+        """Build a conversation from its saved state (see to_state)."""
+        return cls(
+            [Turn(role=role, text=text, images=tuple(images)) for role, text, images in state]
+        )
+
+    def to_state(self) -> List[List]:
+        """Return the turns as [role, text, images] lists (JSON serializable)."""
+        return [[turn.role, turn.text, list(turn.images)] for turn in self.turns]
+
+    def set_system_prompt(self, system_prompt: str) -> None:
+        """Set the first turn to the system prompt (inserting it, if there is none)."""
+        if self.turns and self.turns[0].role == "system":
+            if self.turns[0].text != system_prompt:
+                self.turns[0] = Turn(role="system", text=system_prompt)
+        else:
+            self.turns.insert(0, Turn(role="system", text=system_prompt))
+
+    def add(self, role: str, text: Optional[str] = None, images: Tuple[str, ...] = ()) -> Turn:
+        """Append a turn (e.g. an empty assistant turn, to stream the answer into)."""
+        turn = Turn(role=role, text=text, images=images)
+        self.turns.append(turn)
+        return turn
+
+    def messages(self) -> List[Dict[str, str]]:
+        """Return the whole conversation as OpenAI message dicts."""
+        return to_messages(self.turns)
+
+    def chat_view(self) -> List[List]:
+        """
+        Return the conversation as Gradio chatbot pairs: [user message, assistant answer], after a
+        ((image path,), None) pair for each image sent with the user message.
+        Only the pairs from the last user message on are rebuilt (e.g. while an answer streams),
+        the list returned is updated in place by later calls.
+        """
+        if self._num_cached_turns > len(self.turns):
+            # Turns were removed: nothing cached can be trusted
+            self._pairs, self._num_cached_turns, self._num_cached_pairs = [], 0, 0
+        last_user_idx = len(self.turns)
+        while last_user_idx > self._num_cached_turns and (
+            last_user_idx == len(self.turns) or self.turns[last_user_idx].role != "user"
+        ):
+            last_user_idx -= 1
+        del self._pairs[self._num_cached_pairs :]
+        if last_user_idx > self._num_cached_turns:
+            _append_pairs(self._pairs, self.turns[self._num_cached_turns : last_user_idx])
+            self._num_cached_turns, self._num_cached_pairs = last_user_idx, len(self._pairs)
+        _append_pairs(self._pairs, self.turns[self._num_cached_turns :])
+        return self._pairs
+
+    def __getitem__(self, idx):
+        return self.turns[idx]
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+
+def _append_pairs(pairs: List[List], turns: Iterable[Turn]) -> None:
+    for turn in turns:
+        if turn.role == "user":
+            pairs.extend([(path,), None] for path in turn.images)
+            pairs.append([turn.text, None])
+        elif turn.role == "assistant":
+            if pairs and pairs[-1][1] is None and isinstance(pairs[-1][0], str):
+                pairs[-1][1] = turn.text
+            else:
+                pairs.append([None, turn.text])
@@ -0,0 +1,291 @@
+"""
+Append-only store of chat turns (SQLite, WAL mode), backing the "Chat history and stats" tab.
+
+Turns are queued by `append_turn` and written in batches by a background thread, so persisting
+never blocks streaming. Per session and per (day, model) totals are kept up to date in the same
+transactions, so stats never need a scan of the turns table; turns and sessions are read a page
+at a time with keyset pagination (indexes on session, time and model).
+"""
+
+import queue
+import sqlite3
+import time
+from os import makedirs
+from os.path import dirname, join
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from box.box import Box
+
+from utils import get_root_dir_path
+
+TURN_COLUMNS: Tuple[str, ...] = (
+    "session",
+    "timestamp",
+    "model",
+    "user_message",
+    "assistant_message",
+    "input_tokens",
+    "output_tokens",
+    "cost",
+    "latency_s",
+    "outcome",
+)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS turns ("
+    "id INTEGER PRIMARY KEY, session TEXT NOT NULL, timestamp REAL NOT NULL, model TEXT, "
+    "user_message TEXT, assistant_message TEXT, input_tokens INTEGER NOT NULL DEFAULT 0, "
+    "output_tokens INTEGER NOT NULL DEFAULT 0, cost REAL NOT NULL DEFAULT 0, latency_s REAL, "
+    "outcome TEXT)",
+    "CREATE INDEX IF NOT EXISTS idx_turns_session ON turns(session, id)",
+    "CREATE INDEX IF NOT EXISTS idx_turns_timestamp ON turns(timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_turns_model ON turns(model, timestamp)",
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    "session TEXT PRIMARY KEY, first_at REAL NOT NULL, last_at REAL NOT NULL, "
+    "turns INTEGER NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, "
+    "cost REAL NOT NULL, model TEXT)",
+    "CREATE INDEX IF NOT EXISTS idx_sessions_last_at ON sessions(last_at, session)",
+    "CREATE TABLE IF NOT EXISTS daily_usage ("
+    "day TEXT NOT NULL, model TEXT NOT NULL, turns INTEGER NOT NULL, "
+    "input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, cost REAL NOT NULL, "
+    "PRIMARY KEY (day, model))",
+)
+
+_INSERT_TURN = (
+    f"INSERT INTO turns ({', '.join(TURN_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in TURN_COLUMNS)})"
+)
+_UPSERT_SESSION = (
+    "INSERT INTO sessions "
+    "(session, first_at, last_at, turns, input_tokens, output_tokens, cost, model) "
+    "VALUES (?, ?, ?, 1, ?, ?, ?, ?) "
+    "ON CONFLICT(session) DO UPDATE SET last_at = MAX(last_at, excluded.last_at), "
+    "turns = turns + 1, input_tokens = input_tokens + excluded.input_tokens, "
+    "output_tokens = output_tokens + excluded.output_tokens, cost = cost + excluded.cost, "
+    "model = excluded.model"
+)
+_UPSERT_DAILY_USAGE = (
+    "INSERT INTO daily_usage (day, model, turns, input_tokens, output_tokens, cost) "
+    "VALUES (?, ?, 1, ?, ?, ?) "
+    "ON CONFLICT(day, model) DO UPDATE SET turns = turns + 1, "
+    "input_tokens = input_tokens + excluded.input_tokens, "
+    "output_tokens = output_tokens + excluded.output_tokens, cost = cost + excluded.cost"
+)
+
+
+class ConversationStore:
+    """
+    Store of chat turns. Writes go through a background writer thread (call `flush` to wait for
+    them), reads use their own connection, which WAL mode lets run alongside the writer.
+    """
+
+    def __init__(self, db_path: str, max_batch_size: int = 256) -> None:
+        self.db_path = db_path
+        self.max_batch_size = max_batch_size
+        if dirname(db_path):
+            makedirs(dirname(db_path), exist_ok=True)
+        self._write_db = self._connect(db_path)
+        for statement in _SCHEMA:
+            self._write_db.execute(statement)
+        self._read_db = self._connect(db_path)
+        self._read_lock = Lock()
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self.metrics: Dict[str, int] = {"turns_written": 0, "batches_written": 0, "write_errors": 0}
+        self._writer = Thread(
+            target=self._write_loop, name="conversation-store-writer", daemon=True
+        )
+        self._writer.start()
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "ConversationStore":
+        """Build store from the `CONVERSATION_STORE_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        db_path = config.get("CONVERSATION_STORE_DB_PATH", ".local/conversations.sqlite3")
+        return cls(db_path=join(get_root_dir_path(), db_path))
+
+    def append_turn(
+        self,
+        session: str,
+        model: str,
+        user_message: str,
+        assistant_message: str,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        cost: float = 0.0,
+        latency_s: float = None,
+        outcome: str = "ok",
+        timestamp: float = None,
+    ) -> None:
+        """Queue a turn to be written (returns immediately)."""
+        self._queue.put(
+            (
+                session,
+                timestamp if timestamp is not None else time.time(),
+                model,
+                user_message,
+                assistant_message,
+                input_tokens,
+                output_tokens,
+                cost,
+                latency_s,
+                outcome,
+            )
+        )
+
+    def flush(self, timeout_s: float = None) -> bool:
+        """Wait until all turns queued so far are written. Returns False on timeout."""
+        written = Event()
+        self._queue.put(written)
+        return written.wait(timeout=timeout_s)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._writer.join()
+        self._write_db.close()
+        self._read_db.close()
+
+    def list_sessions(self, limit: int = 50, before: Tuple[float, str] = None) -> List[Dict]:
+        """
+        Return a page of sessions, most recently active first. Pass the `(last_at, session)` of
+        the last row of a page as `before` to get the next one.
+        """
+        if before is None:
+            return self._query(
+                "SELECT * FROM sessions ORDER BY last_at DESC, session DESC LIMIT ?", (limit,)
+            )
+        return self._query(
+            "SELECT * FROM sessions WHERE (last_at, session) < (?, ?) "
+            "ORDER BY last_at DESC, session DESC LIMIT ?",
+            (*before, limit),
+        )
+
+    def get_turns(self, session: str, limit: int = 50, after_id: int = 0) -> List[Dict]:
+        """Return a page of a session's turns, oldest first (pass the last `id` as `after_id`)."""
+        return self._query(
+            "SELECT * FROM turns WHERE session = ? AND id > ? ORDER BY id LIMIT ?",
+            (session, after_id, limit),
+        )
+
+    def recent_turns(
+        self, limit: int = 50, before_id: int = None, model: str = None
+    ) -> List[Dict]:
+        """Return a page of turns (of all sessions, or of a model), newest first."""
+        conditions, params = [], []
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if model is not None:
+            conditions.append("model = ?")
+            params.append(model)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        return self._query(
+            f"SELECT * FROM turns {where}ORDER BY id DESC LIMIT ?", (*params, limit)
+        )
+
+    def usage(self, by: str = "model", since_day: str = None) -> List[Dict]:
+        """
+        Return turn, token and cost totals grouped `by` "model", "day" or "total", from the
+        precomputed daily aggregates (optionally from `since_day`, as YYYY-MM-DD, on).
+        """
+        group_by = {"model": "model", "day": "day", "total": None}[by]
+        select = f"{group_by}, " if group_by else ""
+        where, params = ("WHERE day >= ? ", (since_day,)) if since_day else ("", ())
+        return self._query(
+            f"SELECT {select}SUM(turns) AS turns, SUM(input_tokens) AS input_tokens, "
+            f"SUM(output_tokens) AS output_tokens, SUM(cost) AS cost FROM daily_usage {where}"
+            + (f"GROUP BY {group_by} ORDER BY {group_by} DESC" if group_by else ""),
+            params,
+        )
+
+    def _query(self, sql: str, params: Tuple = ()) -> List[Dict]:
+        with self._read_lock:
+            cursor = self._read_db.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch, waiters, stop = [], [], False
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stop or len(batch) >= self.max_batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write_batch(batch)
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+    def _write_batch(self, batch: List[Tuple]) -> None:
+        """Write turns and update the session and daily totals, in one transaction."""
+        turns = [dict(zip(TURN_COLUMNS, row)) for row in batch]
+        try:
+            with self._write_db:
+                self._write_db.executemany(_INSERT_TURN, batch)
+                self._write_db.executemany(
+                    _UPSERT_SESSION,
+                    [
+                        (
+                            turn["session"],
+                            turn["timestamp"],
+                            turn["timestamp"],
+                            turn["input_tokens"],
+                            turn["output_tokens"],
+                            turn["cost"],
+                            turn["model"],
+                        )
+                        for turn in turns
+                    ],
+                )
+                self._write_db.executemany(
+                    _UPSERT_DAILY_USAGE,
+                    [
+                        (
+                            time.strftime("%Y-%m-%d", time.gmtime(turn["timestamp"])),
+                            turn["model"] or "",
+                            turn["input_tokens"],
+                            turn["output_tokens"],
+                            turn["cost"],
+                        )
+                        for turn in turns
+                    ],
+                )
+            self.metrics["turns_written"] += len(batch)
+            self.metrics["batches_written"] += 1
+        except sqlite3.Error as e:
+            self.metrics["write_errors"] += 1
+            print(f"Warning: Could not write {len(batch)} turns to the conversation store ({e}).")
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        # Safe with WAL (a crash can only lose the last transactions, not corrupt the db)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+
+_CONVERSATION_STORE: ConversationStore = None
+_CONVERSATION_STORE_LOCK = Lock()
+
+
+def get_conversation_store(config: Box = None) -> ConversationStore:
+    """Return the process-wide conversation store (built from config on first use)."""
+    global _CONVERSATION_STORE
+    if _CONVERSATION_STORE is None:
+        with _CONVERSATION_STORE_LOCK:
+            if _CONVERSATION_STORE is None:
+                _CONVERSATION_STORE = ConversationStore.from_config(config=config)
+    return _CONVERSATION_STORE
@@ -0,0 +1,174 @@
+"""
+Parsing and chunking of documents for RAG ingestion (see rag_ingest.py).
+
+Everything here runs in ingestion worker processes, so this module is kept light to import (no
+chromadb, gradio or openai).
+"""
+
+import hashlib
+import html
+import re
+from importlib.util import find_spec
+from os.path import basename, splitext
+from typing import List, NamedTuple, Optional, Tuple
+
+from utils import FALLBACK_ENCODING_NAME, get_encoding_by_name
+
+TEXT_SUFFIXES = (".txt", ".md", ".rst", ".csv", ".json", ".py", ".yaml", ".yml", ".log")
+HTML_SUFFIXES = (".html", ".htm")
+PDF_SUFFIXES = (".pdf",)
+SUPPORTED_SUFFIXES = TEXT_SUFFIXES + HTML_SUFFIXES + PDF_SUFFIXES
+
+_HTML_IGNORED_PATTERN = re.compile(r"<(script|style)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_HTML_BREAK_PATTERN = re.compile(r"<\s*(br|/p|/div|/h\d|/li|/tr)\b[^>]*>", re.IGNORECASE)
+_HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+_PARAGRAPH_PATTERN = re.compile(r"\n\s*\n")
+_SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+class ParsedDocument(NamedTuple):
+    """A document's chunks, or `unchanged` if its content hash matched the known one."""
+
+    path: str
+    source: str
+    content_hash: str
+    chunks: List[str]
+    # Token count of each chunk
+    chunk_tokens: List[int]
+    unchanged: bool = False
+
+
+def hash_file(path: str) -> str:
+    """Return the sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_file(path: str) -> str:
+    """Return the text of a file (plain text, markdown, html, pdf, ...)."""
+    suffix = splitext(path)[1].lower()
+    if suffix in PDF_SUFFIXES:
+        if find_spec("pypdf") is None:
+            raise ValueError("Parsing pdfs requires `pypdf` (pip install pypdf).")
+        from pypdf import PdfReader
+
+        return "\n\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        text = file.read()
+    if suffix in HTML_SUFFIXES:
+        text = _HTML_IGNORED_PATTERN.sub(" ", text)
+        text = _HTML_BREAK_PATTERN.sub("\n\n", text)
+        text = html.unescape(_HTML_TAG_PATTERN.sub(" ", text))
+    elif suffix not in TEXT_SUFFIXES:
+        raise ValueError(f"Unsupported file type: {suffix}. Supported: {SUPPORTED_SUFFIXES}")
+    return text
+
+
+def split_text(
+    text: str,
+    chunk_tokens: int = 400,
+    overlap_tokens: int = 50,
+    encoding_name: str = FALLBACK_ENCODING_NAME,
+) -> List[str]:
+    """
+    Split text into chunks of at most about `chunk_tokens` tokens, on paragraph boundaries where
+    possible (then sentences, then words). Consecutive chunks share up to `overlap_tokens` tokens
+    of text, so passages cut at a boundary are still retrievable.
+    """
+    return _split_text_counted(
+        text, chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens, encoding_name=encoding_name
+    )[0]
+
+
+def _split_text_counted(
+    text: str,
+    chunk_tokens: int = 400,
+    overlap_tokens: int = 50,
+    encoding_name: str = FALLBACK_ENCODING_NAME,
+) -> Tuple[List[str], List[int]]:
+    """Like `split_text`, but also returns the (approximate) token count of each chunk."""
+    encoding = get_encoding_by_name(encoding_name)
+    units, unit_tokens = [], []
+    for paragraph in _PARAGRAPH_PATTERN.split(text):
+        paragraph = paragraph.strip()
+        if paragraph:
+            _split_unit(paragraph, chunk_tokens, encoding, units, unit_tokens)
+
+    chunks, counts, current, current_tokens = [], [], [], 0
+    for unit, num_tokens in zip(units, unit_tokens):
+        if current and current_tokens + num_tokens > chunk_tokens:
+            chunks.append("\n".join(text for text, _ in current))
+            counts.append(current_tokens)
+            # Carry the tail of the chunk over into the next one (as far as the next unit fits)
+            overlap, overlap_num_tokens = [], 0
+            for prev_unit in reversed(current):
+                if overlap_num_tokens + prev_unit[1] > overlap_tokens:
+                    break
+                overlap.insert(0, prev_unit)
+                overlap_num_tokens += prev_unit[1]
+            while overlap and overlap_num_tokens + num_tokens > chunk_tokens:
+                overlap_num_tokens -= overlap.pop(0)[1]
+            current, current_tokens = overlap, overlap_num_tokens
+        current.append((unit, num_tokens))
+        current_tokens += num_tokens
+    if current:
+        chunks.append("\n".join(text for text, _ in current))
+        counts.append(current_tokens)
+    return chunks, counts
+
+
+def _split_unit(
+    text: str, chunk_tokens: int, encoding, units: List[str], unit_tokens: List[int]
+) -> None:
+    """Append `text` to units if it fits a chunk, else its sentences (or words) that do."""
+    num_tokens = len(encoding.encode(text))
+    if num_tokens <= chunk_tokens:
+        units.append(text)
+        unit_tokens.append(num_tokens)
+        return
+    sentences = _SENTENCE_PATTERN.split(text)
+    if len(sentences) > 1:
+        for sentence in sentences:
+            _split_unit(sentence, chunk_tokens, encoding, units, unit_tokens)
+        return
+    # A single huge "sentence" (e.g. a table or minified text): cut it by words
+    words = text.split(" ")
+    words_per_part = max(1, len(words) * chunk_tokens // num_tokens)
+    for start in range(0, len(words), words_per_part):
+        part = " ".join(words[start : start + words_per_part])
+        units.append(part)
+        unit_tokens.append(len(encoding.encode(part)))
+
+
+def process_file(
+    path: str,
+    source: str = None,
+    known_hash: Optional[str] = None,
+    chunk_tokens: int = 400,
+    overlap_tokens: int = 50,
+) -> ParsedDocument:
+    """
+    Hash, parse and chunk a file (in a worker process). Files whose content hash equals
+    `known_hash` are not parsed, and come back `unchanged`.
+    """
+    source = source if source is not None else basename(path)
+    content_hash = hash_file(path)
+    if content_hash == known_hash:
+        return ParsedDocument(
+            path=path,
+            source=source,
+            content_hash=content_hash,
+            chunks=[],
+            chunk_tokens=[],
+            unchanged=True,
+        )
+    chunks, counts = _split_text_counted(
+        parse_file(path), chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens
+    )
+    return ParsedDocument(
+        path=path, source=source, content_hash=content_hash, chunks=chunks, chunk_tokens=counts
+    )
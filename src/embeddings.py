@@ -0,0 +1,268 @@
+"""
+Embedding functions, and a micro-batcher that merges concurrent embedding requests.
+
+Embedding-backed features (the semantic cache, RAG retrieval) embed one short text per user message,
+from many sessions at once. The EmbeddingBatcher queues those texts and sends them as batched calls
+to the embedding function: when the backend is idle a request is sent straight away, otherwise
+requests arriving within `max_wait_s` (up to `max_batch_size` texts) share the next call. Each
+caller gets back the embeddings of its own texts. Under load this turns many small API calls into
+a few large ones (lower request overhead, fewer requests counted against rate limits), at the cost
+of at most `max_wait_s` added latency.
+
+Embedding functions follow chromadb's protocol (a callable from a list of texts to a list of
+embeddings); batchers follow it too, so they can be used wherever an embedding function is.
+
+Usage:
+
+    embed = get_embedding_function(config, embedder="openai", model="text-embedding-ada-002")
+    embeddings = embed(["some text"])
+"""
+
+import asyncio
+import queue
+import re
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from box.box import Box
+from openai import OpenAI
+
+from mock_backend import MockChatBackend, build_mock_openai_client
+
+EmbeddingFunction = Callable[[List[str]], List[List[float]]]
+
+EMBEDDERS = ("hashing", "openai", "mock")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddingFunction:
+    """
+    Deterministic, offline embedding function: hashed word unigrams and bigrams, L2 normalised.
+    Good enough to catch near-verbatim paraphrases, and useful for testing without API calls.
+    Follows chromadb's EmbeddingFunction protocol.
+    """
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = dim
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        embeddings = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            words = _WORD_PATTERN.findall(text.lower())
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            for feature in features:
+                digest = zlib.crc32(feature.encode("utf-8"))
+                # Low bits pick the bucket, the next bit its sign (reduces collision bias)
+                embeddings[row, digest % self.dim] += 1.0 if (digest >> 16) & 1 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms == 0, 1.0, norms)
+        return embeddings.tolist()
+
+
+class OpenAIEmbeddingFunction:
+    """Embedding function using the OpenAI embeddings API (follows chromadb's protocol)."""
+
+    def __init__(self, client: OpenAI, model: str = "text-embedding-ada-002") -> None:
+        self.client = client
+        self.model = model
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        response = self.client.embeddings.create(input=input, model=self.model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def build_embedding_function(
+    embedder: str,
+    model: str = "text-embedding-ada-002",
+    openai_client_factory: Callable[[], OpenAI] = None,
+    config: Box = None,
+) -> EmbeddingFunction:
+    """
+    Build an embedding function: "hashing" (local, deterministic), "openai" (embeddings API), or
+    "mock" (the embeddings API of the local mock backend, see mock_backend.py).
+    """
+    if embedder == "hashing":
+        return HashingEmbeddingFunction()
+    if embedder == "openai":
+        return OpenAIEmbeddingFunction(client=openai_client_factory(), model=model)
+    if embedder == "mock":
+        client = build_mock_openai_client(
+            backend=MockChatBackend.from_config(config=config), async_client=False
+        )
+        return OpenAIEmbeddingFunction(client=client, model=model)
+    raise ValueError(f"Unknown embedder: {embedder}. Expected one of {EMBEDDERS}")
+
+
+class EmbeddingBatcher:
+    """
+    Merges concurrent embedding requests into batched calls of an embedding function (from a
+    background thread, with up to `max_in_flight` calls at a time).
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        max_batch_size: int = 64,
+        max_wait_s: float = 0.005,
+        max_in_flight: int = 4,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self.max_in_flight = max_in_flight
+        self.metrics: Dict[str, int] = {"requests": 0, "texts": 0, "batches": 0, "errors": 0}
+        self._queue: "queue.SimpleQueue[Tuple[str, Future]]" = queue.SimpleQueue()
+        self._num_in_flight = 0
+        self._in_flight_changed = Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="embedding-batch"
+        )
+        self._worker: Thread = None
+        self._worker_lock = Lock()
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[Box], embedding_function: EmbeddingFunction
+    ) -> "EmbeddingBatcher":
+        """Build batcher from the `EMBEDDING_BATCH_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            embedding_function=embedding_function,
+            max_batch_size=config.get("EMBEDDING_BATCH_MAX_SIZE", 64),
+            max_wait_s=config.get("EMBEDDING_BATCH_MAX_WAIT_S", 0.005),
+            max_in_flight=config.get("EMBEDDING_BATCH_MAX_IN_FLIGHT", 4),
+        )
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        """Embed texts (blocks until their batch is done)."""
+        if len(input) >= self.max_batch_size:
+            # Already a full batch (e.g. document ingestion)
+            self.metrics["batches"] += 1
+            self.metrics["texts"] += len(input)
+            return self.embedding_function(input)
+        return [future.result() for future in self.submit(input)]
+
+    async def aembed(self, input: List[str]) -> List[List[float]]:
+        """Embed texts, without blocking the event loop."""
+        return list(
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in self.submit(input)))
+        )
+
+    def submit(self, input: List[str]) -> List[Future]:
+        """Queue texts, returning a future of each text's embedding."""
+        self._ensure_worker()
+        self.metrics["requests"] += 1
+        futures = []
+        for text in input:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return futures
+
+    def stats(self) -> Dict[str, float]:
+        stats = dict(self.metrics)
+        stats["mean_batch_size"] = stats["texts"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = Thread(
+                        target=self._collect_loop, name="embedding-batcher", daemon=True
+                    )
+                    self._worker.start()
+
+    def _collect_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_s
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                # Nothing to wait for if the backend is idle, so send what there is
+                remaining_s = deadline - time.monotonic()
+                if self._num_in_flight == 0 or remaining_s <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining_s))
+                except queue.Empty:
+                    break
+            with self._in_flight_changed:
+                while self._num_in_flight >= self.max_in_flight:
+                    self._in_flight_changed.wait()
+                self._num_in_flight += 1
+            # Top up with what arrived while waiting for a free slot
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._executor.submit(self._embed_batch, batch)
+
+    def _embed_batch(self, batch: List[Tuple[str, Future]]) -> None:
+        try:
+            # Skip texts whose callers gave up
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            # Identical texts (e.g. the same question from several sessions) are embedded once
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            if not texts:
+                return
+            try:
+                embeddings = dict(zip(texts, self.embedding_function(texts)))
+            except Exception as e:
+                self.metrics["errors"] += 1
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            self.metrics["batches"] += 1
+            self.metrics["texts"] += len(texts)
+            for text, future in batch:
+                future.set_result(embeddings[text])
+        finally:
+            with self._in_flight_changed:
+                self._num_in_flight -= 1
+                self._in_flight_changed.notify()
+
+
+# One batcher per embedder and model, shared by every feature of the process
+_EMBEDDING_FUNCTIONS: Dict[Tuple[str, str], EmbeddingFunction] = dict()
+_EMBEDDING_FUNCTIONS_LOCK = Lock()
+
+
+def get_embedding_function(
+    config: Box = None,
+    embedder: str = "hashing",
+    model: str = "text-embedding-ada-002",
+    openai_client_factory: Callable[[], OpenAI] = None,
+) -> EmbeddingFunction:
+    """
+    Return the process-wide embedding function of an embedder and model (built on first use),
+    behind an EmbeddingBatcher unless `EMBEDDING_BATCH` is off in the config.
+    """
+    key = (embedder, model)
+    embedding_function = _EMBEDDING_FUNCTIONS.get(key)
+    if embedding_function is None:
+        with _EMBEDDING_FUNCTIONS_LOCK:
+            embedding_function = _EMBEDDING_FUNCTIONS.get(key)
+            if embedding_function is None:
+                embedding_function = build_embedding_function(
+                    embedder=embedder,
+                    model=model,
+                    openai_client_factory=openai_client_factory,
+                    config=config,
+                )
+                if config is None or config.get("EMBEDDING_BATCH", True):
+                    embedding_function = EmbeddingBatcher.from_config(
+                        config=config, embedding_function=embedding_function
+                    )
+                _EMBEDDING_FUNCTIONS[key] = embedding_function
+    return embedding_function
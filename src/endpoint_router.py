@@ -0,0 +1,399 @@
+"""
+Routing of chat completion calls across several OpenAI/Azure OpenAI endpoints.
+
+Endpoints are listed under `ENDPOINTS` in the config file, and share one process-wide
+EndpointRouter (so all sessions share their connection pools and latency stats). Each call goes
+to the best healthy endpoint, either the one with the lowest moving average time to first token
+(`fastest`, measured on streams, with the latency of non-streamed calls kept apart as a tie
+breaker) or with the fewest calls in flight (`least_loaded`). An endpoint that errors (or
+rate limits) is taken out of rotation for a cooldown, and the call fails over to the next one.
+
+Streams are only handed to the caller once their first chunk arrived, so failover also covers
+streams that break before producing any output. On the async path, a call can also be hedged:
+if no first token arrived after `ROUTING_HEDGE_AFTER_S`, the same request is sent to the next
+best endpoint too, the first to produce a token wins and the other is cancelled. Note that tokens
+the cancelled request used upstream are not accounted for.
+
+Endpoints are health checked (by listing models) every `ROUTING_HEALTH_CHECK_INTERVAL_S`, in the
+background of the calls routed.
+"""
+
+import asyncio
+import time
+from os import getenv
+from threading import Lock, Thread
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import httpx
+from box.box import Box
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
+from openai._streaming import AsyncStream, Stream
+from openai.types.chat import ChatCompletionChunk
+
+from utils import load_dotenv_once
+
+ROUTING_POLICIES = ("fastest", "least_loaded")
+
+_CLIENT_TYPES = {
+    # (async, azure)
+    (False, False): OpenAI,
+    (False, True): AzureOpenAI,
+    (True, False): AsyncOpenAI,
+    (True, True): AsyncAzureOpenAI,
+}
+
+
+class Endpoint:
+    """One OpenAI/Azure OpenAI backend, and its health and latency stats."""
+
+    def __init__(
+        self, name: str, client: Union[OpenAI, AsyncOpenAI], deployment: str = None
+    ) -> None:
+        self.name = name
+        self.client = client
+        # Model (or Azure deployment) name sent to this endpoint, instead of the requested one
+        self.deployment = deployment
+        self.ewma_ttft_s: Optional[float] = None
+        # Of whole non-streamed calls (which say little about their time to first token)
+        self.ewma_latency_s: Optional[float] = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.metrics: Dict[str, int] = {"calls": 0, "failures": 0}
+
+    def prepare(self, request: Dict) -> Dict:
+        """Return the request to send to this endpoint."""
+        if self.deployment is None:
+            return request
+        return {**request, "model": self.deployment}
+
+    def is_healthy(self, now: float = None) -> bool:
+        return self.unhealthy_until <= (now if now is not None else time.monotonic())
+
+    def stats(self) -> Dict:
+        return {
+            "ewma_ttft_s": self.ewma_ttft_s,
+            "ewma_latency_s": self.ewma_latency_s,
+            "in_flight": self.in_flight,
+            "healthy": self.is_healthy(),
+            **self.metrics,
+        }
+
+
+class EndpointRouter:
+    """Picks an endpoint per call, and keeps their health and latency stats up to date."""
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        policy: str = "fastest",
+        hedge_after_s: float = None,
+        ewma_alpha: float = 0.2,
+        failure_cooldown_s: float = 30.0,
+        health_check_interval_s: float = 60.0,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("EndpointRouter needs at least one endpoint!")
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy: {policy}. Options: {ROUTING_POLICIES}")
+        self.endpoints = endpoints
+        self.policy = policy
+        self.hedge_after_s = hedge_after_s
+        self.ewma_alpha = ewma_alpha
+        self.failure_cooldown_s = failure_cooldown_s
+        self.health_check_interval_s = health_check_interval_s
+        self._lock = Lock()
+        self._last_health_check_at = time.monotonic()
+        self._health_check_running = False
+        self.metrics: Dict[str, int] = {"hedges": 0, "hedges_won": 0}
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Box,
+        async_client: bool,
+        http_client_factory: Callable[[], Union[httpx.Client, httpx.AsyncClient]] = None,
+    ) -> "EndpointRouter":
+        """Build router from the `ENDPOINTS` and `ROUTING_*` keys of a config file."""
+        endpoints = [
+            Endpoint(
+                name=params["NAME"],
+                client=build_endpoint_client(
+                    params=params,
+                    async_client=async_client,
+                    http_client=http_client_factory() if http_client_factory else None,
+                ),
+                deployment=params.get("DEPLOYMENT", None),
+            )
+            for params in config["ENDPOINTS"]
+        ]
+        return cls(
+            endpoints=endpoints,
+            policy=config.get("ROUTING_POLICY", "fastest"),
+            hedge_after_s=config.get("ROUTING_HEDGE_AFTER_S", None),
+            ewma_alpha=config.get("ROUTING_EWMA_ALPHA", 0.2),
+            failure_cooldown_s=config.get("ROUTING_FAILURE_COOLDOWN_S", 30.0),
+            health_check_interval_s=config.get("ROUTING_HEALTH_CHECK_INTERVAL_S", 60.0),
+        )
+
+    def rank(self, exclude: List[Endpoint] = ()) -> List[Endpoint]:
+        """
+        Return endpoints best first: healthy ones by policy, then unhealthy ones by when they
+        come back. Endpoints in `exclude` (e.g. already tried) go last.
+        """
+        self._maybe_schedule_health_check()
+        now = time.monotonic()
+        with self._lock:
+
+            def sort_key(endpoint: Endpoint) -> Tuple:
+                # Endpoints without a TTFT (or latency) yet are tried first, to get one
+                ttft_s = endpoint.ewma_ttft_s if endpoint.ewma_ttft_s is not None else 0.0
+                latency_s = endpoint.ewma_latency_s if endpoint.ewma_latency_s is not None else 0.0
+                by_policy = (
+                    (ttft_s, latency_s, endpoint.in_flight)
+                    if self.policy == "fastest"
+                    else (endpoint.in_flight, ttft_s, latency_s)
+                )
+                healthy = endpoint.is_healthy(now=now)
+                return (
+                    endpoint in exclude,
+                    not healthy,
+                    by_policy if healthy else endpoint.unhealthy_until,
+                )
+
+            return sorted(self.endpoints, key=sort_key)
+
+    def on_start(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.in_flight += 1
+            endpoint.metrics["calls"] += 1
+
+    def on_end(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def record_success(
+        self, endpoint: Endpoint, ttft_s: float = None, latency_s: float = None
+    ) -> None:
+        """Put an endpoint back in rotation, with the TTFT of a stream or latency of a call."""
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.unhealthy_until = 0.0
+        if ttft_s is not None:
+            self.observe_ttft(endpoint=endpoint, ttft_s=ttft_s)
+        if latency_s is not None:
+            self.observe_latency(endpoint=endpoint, latency_s=latency_s)
+
+    def observe_ttft(self, endpoint: Endpoint, ttft_s: float) -> None:
+        """Update the moving average TTFT of an endpoint (also with a lower bound of one)."""
+        with self._lock:
+            endpoint.ewma_ttft_s = self._ewma(endpoint.ewma_ttft_s, ttft_s)
+
+    def observe_latency(self, endpoint: Endpoint, latency_s: float) -> None:
+        """Update the moving average latency of an endpoint's non-streamed calls."""
+        with self._lock:
+            endpoint.ewma_latency_s = self._ewma(endpoint.ewma_latency_s, latency_s)
+
+    def _ewma(self, average: Optional[float], value: float) -> float:
+        return value if average is None else average + self.ewma_alpha * (value - average)
+
+    def record_failure(self, endpoint: Endpoint, cooldown_s: float = None) -> None:
+        """Take an endpoint out of rotation (for longer after repeated failures)."""
+        with self._lock:
+            endpoint.consecutive_failures += 1
+            endpoint.metrics["failures"] += 1
+            if cooldown_s is None:
+                cooldown_s = self.failure_cooldown_s * min(
+                    2 ** (endpoint.consecutive_failures - 1), 8
+                )
+            endpoint.unhealthy_until = max(
+                endpoint.unhealthy_until, time.monotonic() + cooldown_s
+            )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self.metrics,
+                "endpoints": {endpoint.name: endpoint.stats() for endpoint in self.endpoints},
+            }
+
+    def check_health(self) -> None:
+        """Probe every endpoint (sync clients)."""
+        try:
+            for endpoint in self.endpoints:
+                try:
+                    endpoint.client.models.list()
+                    self._on_health_check(endpoint=endpoint, healthy=True)
+                except Exception:
+                    self._on_health_check(endpoint=endpoint, healthy=False)
+        finally:
+            self._health_check_running = False
+
+    async def acheck_health(self) -> None:
+        """Probe every endpoint (async clients)."""
+        try:
+
+            async def probe(endpoint: Endpoint) -> None:
+                try:
+                    await endpoint.client.models.list()
+                    self._on_health_check(endpoint=endpoint, healthy=True)
+                except Exception:
+                    self._on_health_check(endpoint=endpoint, healthy=False)
+
+            await asyncio.gather(*[probe(endpoint) for endpoint in self.endpoints])
+        finally:
+            self._health_check_running = False
+
+    def _on_health_check(self, endpoint: Endpoint, healthy: bool) -> None:
+        if healthy:
+            with self._lock:
+                endpoint.consecutive_failures = 0
+                endpoint.unhealthy_until = 0.0
+        else:
+            self.record_failure(endpoint=endpoint)
+
+    def _maybe_schedule_health_check(self) -> None:
+        """Start a health check in the background if one is due."""
+        if self.health_check_interval_s is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if (
+                self._health_check_running
+                or now - self._last_health_check_at < self.health_check_interval_s
+            ):
+                return
+            self._health_check_running = True
+            self._last_health_check_at = now
+        if isinstance(self.endpoints[0].client, AsyncOpenAI):
+            asyncio.get_running_loop().create_task(self.acheck_health())
+        else:
+            Thread(target=self.check_health, daemon=True).start()
+
+
+class PrefetchedStream:
+    """
+    A Stream whose first chunk was already received (to time it, and to fail over streams that
+    break before it). Iterating yields that chunk first, then the rest of the stream.
+    """
+
+    def __init__(
+        self, first_chunk: Optional[ChatCompletionChunk], stream: Stream, on_close: Callable = None
+    ) -> None:
+        self._first_chunk = first_chunk
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self) -> Iterator[ChatCompletionChunk]:
+        if self._first_chunk is not None:
+            yield self._first_chunk
+        yield from self._stream
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+    def close(self) -> None:
+        self._stream.close()
+        self._run_on_close()
+
+    def _run_on_close(self) -> None:
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+
+class AsyncPrefetchedStream(PrefetchedStream):
+    """PrefetchedStream of an AsyncStream (iterate with `async for`)."""
+
+    def __iter__(self):
+        raise TypeError("AsyncPrefetchedStream must be iterated with `async for`.")
+
+    async def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        if self._first_chunk is not None:
+            yield self._first_chunk
+        async for chunk in self._stream:
+            yield chunk
+
+    async def close(self) -> None:
+        await self._stream.close()
+        self._run_on_close()
+
+
+def prefetch_stream(stream: Stream, on_close: Callable = None) -> PrefetchedStream:
+    """Wait for the first chunk of a stream."""
+    try:
+        first_chunk = next(iter(stream))
+    except StopIteration:
+        first_chunk = None
+    except BaseException:
+        stream.close()
+        raise
+    return PrefetchedStream(first_chunk=first_chunk, stream=stream, on_close=on_close)
+
+
+async def aprefetch_stream(stream: AsyncStream, on_close: Callable = None) -> AsyncPrefetchedStream:
+    """Wait for the first chunk of an async stream."""
+    try:
+        first_chunk = await stream.__aiter__().__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except BaseException:
+        # Also closes the stream of a cancelled (e.g. hedged) request
+        await stream.close()
+        raise
+    return AsyncPrefetchedStream(first_chunk=first_chunk, stream=stream, on_close=on_close)
+
+
+def build_endpoint_client(
+    params: Dict, async_client: bool, http_client: Union[httpx.Client, httpx.AsyncClient] = None
+) -> Union[OpenAI, AsyncOpenAI]:
+    """
+    Build the client of an `ENDPOINTS` entry of a config file. The API key is read from the
+    environment variable named by its `API_KEY_ENV` (default OPENAI_API_KEY).
+    Retries are left to OAIClient (see OAIClient._create), so the client itself does not retry.
+    """
+    try:
+        load_dotenv_once()
+    except Exception as e:
+        pass
+    azure = params.get("TYPE", "openai") == "azure"
+    client_kwargs = dict(
+        api_key=getenv(params.get("API_KEY_ENV", "OPENAI_API_KEY")),
+        max_retries=0,
+    )
+    if azure:
+        client_kwargs.update(
+            azure_endpoint=params["AZURE_ENDPOINT"],
+            api_version=params.get("API_VERSION", getenv("OPENAI_API_VERSION")),
+        )
+    elif params.get("BASE_URL", None) is not None:
+        client_kwargs.update(base_url=params["BASE_URL"])
+    if http_client is not None:
+        client_kwargs.update(http_client=http_client)
+    return _CLIENT_TYPES[(async_client, azure)](**client_kwargs)
+
+
+# One router per (sync/async, endpoint list), shared by every OAIClient of the process
+_ENDPOINT_ROUTERS: Dict[Tuple[bool, Tuple[str, ...]], EndpointRouter] = dict()
+_ENDPOINT_ROUTERS_LOCK = Lock()
+
+
+def get_endpoint_router(
+    config: Box,
+    async_client: bool,
+    http_client_factory: Callable[[], Union[httpx.Client, httpx.AsyncClient]] = None,
+) -> EndpointRouter:
+    """Return the process-wide router of the `ENDPOINTS` of a config (built on first use)."""
+    key = (async_client, tuple(params["NAME"] for params in config["ENDPOINTS"]))
+    router = _ENDPOINT_ROUTERS.get(key)
+    if router is None:
+        with _ENDPOINT_ROUTERS_LOCK:
+            router = _ENDPOINT_ROUTERS.get(key)
+            if router is None:
+                router = EndpointRouter.from_config(
+                    config=config,
+                    async_client=async_client,
+                    http_client_factory=http_client_factory,
+                )
+                _ENDPOINT_ROUTERS[key] = router
+    return router
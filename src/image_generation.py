@@ -0,0 +1,351 @@
+"""
+Image generation (DALL-E) jobs, run concurrently within a rate limit, with persistent results.
+
+dall-e-3 only generates one image per call (`n=1`), so several variants of a prompt take several
+calls. ImageGenerationService runs them as concurrent asyncio jobs: at most `max_concurrency` at
+a time, each waiting its turn in the process-wide rate limiter of the model (RATE_LIMITS in the
+config, e.g. `dall-e-3: {RPM: 7}`), with 429s and transient errors retried.
+
+Generated images are downloaded as soon as they are returned (their signed URLs expire after an
+hour or so) into a content-addressed store (`<store_dir>/<sha256[:2]>/<sha256>.png`). A SQLite
+index maps each request (model, prompt, size, quality, style and variant number) to its image,
+so a repeated request is answered from disk without an API call, also after a restart; identical
+requests in flight at the same time share one API call.
+
+Usage:
+
+    service = get_image_generation_service(config)
+    images = await service.generate_variants("a wooden king chess piece", num_variants=3)
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from base64 import b64decode
+from os.path import exists, join
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+from box.box import Box
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from api_client import AsyncOAIClient
+from client_pool import get_session_client
+from metrics import get_metrics
+from rate_limiter import backoff_s
+from utils import get_root_dir_path
+
+IMAGE_SIZES = ("1024x1024", "1024x1792", "1792x1024", "512x512", "256x256")
+IMAGE_QUALITIES = ("standard", "hd")
+# Cost (USD) per image, by (model, quality, size). See https://openai.com/pricing
+IMAGE_PRICES: Dict[str, float] = {
+    "dall-e-3/standard/1024x1024": 0.04,
+    "dall-e-3/standard/1024x1792": 0.08,
+    "dall-e-3/standard/1792x1024": 0.08,
+    "dall-e-3/hd/1024x1024": 0.08,
+    "dall-e-3/hd/1024x1792": 0.12,
+    "dall-e-3/hd/1792x1024": 0.12,
+    "dall-e-2/standard/1024x1024": 0.02,
+    "dall-e-2/standard/512x512": 0.018,
+    "dall-e-2/standard/256x256": 0.016,
+}
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS images ("
+    "key TEXT PRIMARY KEY, content_hash TEXT NOT NULL, request TEXT NOT NULL, "
+    "revised_prompt TEXT, created_at REAL NOT NULL)"
+)
+
+
+class GeneratedImage(NamedTuple):
+    """A generated image, stored locally at `path`."""
+
+    path: str
+    prompt: str
+    revised_prompt: Optional[str]
+    model: str
+    size: str
+    quality: str
+    variant: int
+    content_hash: str
+    cached: bool
+
+
+class ImageGenerationService:
+    """Runs image generation jobs through an AsyncOAIClient, and stores their results."""
+
+    def __init__(
+        self,
+        oai_client: AsyncOAIClient,
+        store_dir: str,
+        model: str = "dall-e-3",
+        max_concurrency: int = 4,
+        response_format: str = "url",
+        download_timeout_s: float = 60.0,
+    ) -> None:
+        self.oai_client = oai_client
+        self.store_dir = store_dir
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.response_format = response_format
+        self.download_timeout_s = download_timeout_s
+        self.metrics: Dict[str, float] = {
+            "generated": 0,
+            "hits": 0,
+            "joined": 0,
+            "errors": 0,
+            "cost": 0.0,
+        }
+        os.makedirs(store_dir, exist_ok=True)
+        self._db = sqlite3.connect(
+            join(store_dir, "index.sqlite3"), check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(_SCHEMA)
+        self._db_lock = Lock()
+        # Jobs in flight, by request key (identical requests share one job)
+        self._jobs: Dict[str, asyncio.Task] = dict()
+        self._semaphore: asyncio.Semaphore = None
+        self._http_client: httpx.AsyncClient = None
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[Box], oai_client: AsyncOAIClient
+    ) -> "ImageGenerationService":
+        """Build service from the `IMAGE_GENERATION_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            oai_client=oai_client,
+            store_dir=join(
+                get_root_dir_path(),
+                config.get("IMAGE_GENERATION_STORE_DIR", ".local/generated_images"),
+            ),
+            model=config.get("IMAGE_GENERATION_MODEL", "dall-e-3"),
+            max_concurrency=config.get("IMAGE_GENERATION_MAX_CONCURRENCY", 4),
+            response_format=config.get("IMAGE_GENERATION_RESPONSE_FORMAT", "url"),
+        )
+
+    def submit(
+        self,
+        prompt: str,
+        size: str = "1024x1024",
+        quality: str = "standard",
+        style: str = None,
+        variant: int = 0,
+    ) -> "asyncio.Task[GeneratedImage]":
+        """
+        Start a job (in the running event loop), returning it as a task. `variant` tells apart
+        requests for several images of the same prompt (each cached on its own).
+        """
+        if size not in IMAGE_SIZES:
+            raise ValueError(f"Unknown image size: {size}. Expected one of {IMAGE_SIZES}")
+        if quality not in IMAGE_QUALITIES:
+            raise ValueError(f"Unknown image quality: {quality}. Expected one of {IMAGE_QUALITIES}")
+        request = {
+            "model": self.model,
+            "prompt": prompt,
+            "size": size,
+            "quality": quality,
+            "style": style,
+            "variant": variant,
+        }
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+        job = self._jobs.get(key)
+        if job is not None:
+            self.metrics["joined"] += 1
+            return job
+        job = asyncio.ensure_future(self._run(key=key, request=request))
+        self._jobs[key] = job
+        job.add_done_callback(lambda _: self._jobs.pop(key, None))
+        return job
+
+    async def generate(
+        self,
+        prompt: str,
+        size: str = "1024x1024",
+        quality: str = "standard",
+        style: str = None,
+        variant: int = 0,
+    ) -> GeneratedImage:
+        """Generate an image (or return the stored one of an identical earlier request)."""
+        # Shielded, so a caller giving up does not cancel a job other callers may share
+        return await asyncio.shield(
+            self.submit(prompt=prompt, size=size, quality=quality, style=style, variant=variant)
+        )
+
+    async def generate_variants(
+        self,
+        prompt: str,
+        num_variants: int = 1,
+        size: str = "1024x1024",
+        quality: str = "standard",
+        style: str = None,
+    ) -> List[GeneratedImage]:
+        """Generate several images of a prompt, concurrently (one call each, as dall-e-3 needs)."""
+        return list(
+            await asyncio.gather(
+                *(
+                    self.generate(
+                        prompt=prompt, size=size, quality=quality, style=style, variant=variant
+                    )
+                    for variant in range(num_variants)
+                )
+            )
+        )
+
+    def stats(self) -> Dict[str, float]:
+        return dict(self.metrics, in_flight=len(self._jobs))
+
+    async def aclose(self) -> None:
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+    async def _run(self, key: str, request: Dict) -> GeneratedImage:
+        stored = self._lookup(key=key, request=request)
+        if stored is not None:
+            self.metrics["hits"] += 1
+            return stored
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            async with self._semaphore:
+                with get_metrics().span("image_generation", model=request["model"]):
+                    image = await self._generate(request=request)
+                    content_hash = await self._save(image)
+        except Exception:
+            self.metrics["errors"] += 1
+            get_metrics().inc("image_generations", model=request["model"], outcome="error")
+            raise
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+                (key, content_hash, json.dumps(request), image.revised_prompt, time.time()),
+            )
+        cost = IMAGE_PRICES.get(f"{request['model']}/{request['quality']}/{request['size']}", 0.0)
+        self.metrics["generated"] += 1
+        self.metrics["cost"] += cost
+        get_metrics().inc("image_generations", model=request["model"], outcome="ok")
+        get_metrics().inc("image_generation_cost_usd", value=cost, model=request["model"])
+        return self._to_generated_image(
+            request=request,
+            content_hash=content_hash,
+            revised_prompt=image.revised_prompt,
+            cached=False,
+        )
+
+    def _lookup(self, key: str, request: Dict) -> Optional[GeneratedImage]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT content_hash, revised_prompt FROM images WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or not exists(self._path(row[0])):
+            return None
+        return self._to_generated_image(
+            request=request, content_hash=row[0], revised_prompt=row[1], cached=True
+        )
+
+    async def _generate(self, request: Dict):
+        """Call the API once the rate limiter allows, retrying 429s and transient errors."""
+        rate_limiter = self.oai_client.get_rate_limiter(model=request["model"])
+        # The client's own retries are off, as retries go through the shared rate limiter
+        client = self.oai_client.client.with_options(max_retries=0)
+        params = {
+            "model": request["model"],
+            "prompt": request["prompt"],
+            "size": request["size"],
+            "n": 1,
+            "response_format": self.response_format,
+        }
+        if request["model"] == "dall-e-3":
+            params["quality"] = request["quality"]
+            if request["style"] is not None:
+                params["style"] = request["style"]
+        for attempt in range(self.oai_client.RATE_LIMIT_MAX_RETRIES + 1):
+            get_metrics().observe(
+                "rate_limit_wait", await rate_limiter.aacquire(lane="image_generation")
+            )
+            try:
+                raw_response = await client.images.with_raw_response.generate(**params)
+            except RateLimitError as e:
+                rate_limiter.penalize(headers=e.response.headers)
+                if attempt == self.oai_client.RATE_LIMIT_MAX_RETRIES:
+                    raise
+            except (APIConnectionError, InternalServerError):
+                if attempt == self.oai_client.RATE_LIMIT_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(backoff_s(attempt=attempt))
+            else:
+                rate_limiter.update_from_headers(headers=raw_response.headers)
+                return raw_response.parse().data[0]
+
+    async def _save(self, image) -> str:
+        """Store an image (downloaded from its URL, unless inlined), returning its content hash."""
+        if image.b64_json is not None:
+            content = b64decode(image.b64_json)
+        else:
+            if self._http_client is None:
+                self._http_client = httpx.AsyncClient(
+                    timeout=self.download_timeout_s, follow_redirects=True
+                )
+            response = await self._http_client.get(image.url)
+            response.raise_for_status()
+            content = response.content
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._path(content_hash)
+        if not exists(path):
+            await asyncio.to_thread(self._write, path, content)
+        return content_hash
+
+    @staticmethod
+    def _write(path: str, content: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written then renamed, so the store never holds a partial image
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as image_file:
+            image_file.write(content)
+        os.replace(tmp_path, path)
+
+    def _path(self, content_hash: str) -> str:
+        return join(self.store_dir, content_hash[:2], f"{content_hash}.png")
+
+    def _to_generated_image(
+        self, request: Dict, content_hash: str, revised_prompt: Optional[str], cached: bool
+    ) -> GeneratedImage:
+        return GeneratedImage(
+            path=self._path(content_hash),
+            prompt=request["prompt"],
+            revised_prompt=revised_prompt,
+            model=request["model"],
+            size=request["size"],
+            quality=request["quality"],
+            variant=request["variant"],
+            content_hash=content_hash,
+            cached=cached,
+        )
+
+
+_IMAGE_GENERATION_SERVICE: ImageGenerationService = None
+_IMAGE_GENERATION_SERVICE_LOCK = Lock()
+
+
+def get_image_generation_service(
+    config: Box = None, oai_client: AsyncOAIClient = None
+) -> ImageGenerationService:
+    """
+    Return the process-wide image generation service (built from config on first use), sending
+    its calls with `oai_client` (by default, a client on the shared transport).
+    """
+    global _IMAGE_GENERATION_SERVICE
+    if _IMAGE_GENERATION_SERVICE is None:
+        with _IMAGE_GENERATION_SERVICE_LOCK:
+            if _IMAGE_GENERATION_SERVICE is None:
+                _IMAGE_GENERATION_SERVICE = ImageGenerationService.from_config(
+                    config=config,
+                    oai_client=oai_client if oai_client is not None else get_session_client(),
+                )
+    return _IMAGE_GENERATION_SERVICE
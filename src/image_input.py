@@ -0,0 +1,211 @@
+"""
+Preprocessing of images sent to vision models (e.g. gpt-4-vision-preview).
+
+A vision model never sees more than its input resolution for the chosen detail level (see
+utils.fit_image_size): up to 512x512 for "low", and 768px on the shortest side for "high". Sending
+a phone photo as is (several MB, base64 encoded) only makes the request larger and slower. Images
+are downscaled to that resolution (JPEG photos are decoded at a reduced scale straight away),
+rotated upright from their EXIF orientation, and re-encoded (JPEG, or PNG for images with
+transparency) as data URLs.
+
+Images are prepared on a thread pool (Pillow releases the GIL while decoding, resizing and
+encoding), and cached by content hash and detail level (LRU), so the same image is only prepared
+once: e.g. when it is prepared on upload and then sent, or sent again by another session.
+
+Usage:
+
+    preprocessor = get_image_preprocessor(config)
+    images = preprocessor.prepare_many(["photo.jpg"], detail="high")
+    message = build_image_message("What's in this photo?", images)
+"""
+
+import hashlib
+import os
+from base64 import b64encode
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from box.box import Box
+
+from utils import IMAGE_DETAILS, estimate_image_tokens, fit_image_size
+
+
+class PreparedImage(NamedTuple):
+    """An image ready to send, with its size as sent and its estimated input tokens."""
+
+    data_url: str
+    width: int
+    height: int
+    detail: str
+    num_tokens: int
+    content_hash: str
+
+
+def hash_image_file(path: str, block_size: int = 1 << 20) -> str:
+    """Return the sha256 of a file's content (read in blocks)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as image_file:
+        for block in iter(lambda: image_file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_image_message(text: str, images: Sequence[PreparedImage]) -> Dict:
+    """Return a user message with a text and images (as content parts)."""
+    return {
+        "role": "user",
+        "content": [{"type": "text", "text": text}]
+        + [
+            {"type": "image_url", "image_url": {"url": image.data_url, "detail": image.detail}}
+            for image in images
+        ],
+    }
+
+
+class ImagePreprocessor:
+    """Downscales and encodes images for vision models, on a thread pool, with an LRU cache."""
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        jpeg_quality: int = 85,
+        max_cache_entries: int = 256,
+        max_cache_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        self.jpeg_quality = jpeg_quality
+        self.max_cache_entries = max_cache_entries
+        self.max_cache_bytes = max_cache_bytes
+        self.metrics: Dict[str, int] = {"hits": 0, "misses": 0, "errors": 0}
+        self._cache: "OrderedDict[Tuple[str, str], PreparedImage]" = OrderedDict()
+        self._cache_bytes = 0
+        # Content hashes of files by (path, size, mtime), so an unchanged file is only read once
+        self._hashes: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+        # Images being prepared, so concurrent requests for one are only prepared once
+        self._pending: Dict[Tuple[str, str], Future] = dict()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image")
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "ImagePreprocessor":
+        """Build preprocessor from the `IMAGE_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            max_workers=config.get("IMAGE_WORKERS", 4),
+            jpeg_quality=config.get("IMAGE_JPEG_QUALITY", 85),
+            max_cache_entries=config.get("IMAGE_CACHE_MAX_ENTRIES", 256),
+            max_cache_bytes=config.get("IMAGE_CACHE_MAX_MB", 64) * 1024 * 1024,
+        )
+
+    def prepare(self, path: str, detail: str = "high") -> PreparedImage:
+        """Return an image prepared for a detail level (from the cache, if it was prepared)."""
+        return self.submit([path], detail=detail)[0].result()
+
+    def prepare_many(self, paths: Sequence[str], detail: str = "high") -> List[PreparedImage]:
+        """Prepare images in parallel."""
+        return [future.result() for future in self.submit(paths, detail=detail)]
+
+    def submit(self, paths: Sequence[str], detail: str = "high") -> List[Future]:
+        """Queue images, returning a future of each prepared image (e.g. to prepare on upload)."""
+        if detail not in IMAGE_DETAILS:
+            raise ValueError(f"Unknown detail level: {detail}. Expected one of {IMAGE_DETAILS}")
+        return [self._executor.submit(self._get_or_prepare, path, detail) for path in paths]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.metrics, entries=len(self._cache), bytes=self._cache_bytes)
+
+    def _hash(self, path: str) -> str:
+        stat = os.stat(path)
+        file_key = (path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            content_hash = self._hashes.get(file_key)
+        if content_hash is None:
+            content_hash = hash_image_file(path)
+            with self._lock:
+                self._hashes[file_key] = content_hash
+                if len(self._hashes) > self.max_cache_entries:
+                    self._hashes.popitem(last=False)
+        return content_hash
+
+    def _get_or_prepare(self, path: str, detail: str) -> PreparedImage:
+        key = (self._hash(path), detail)
+        with self._lock:
+            image = self._cache.get(key)
+            if image is not None:
+                self._cache.move_to_end(key)
+                self.metrics["hits"] += 1
+                return image
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+                self.metrics["misses"] += 1
+        if not owner:
+            return future.result()
+        try:
+            image = self._prepare(path, content_hash=key[0], detail=detail)
+        except Exception as e:
+            with self._lock:
+                self.metrics["errors"] += 1
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._cache[key] = image
+            self._cache_bytes += len(image.data_url)
+            while self._cache and (
+                len(self._cache) > self.max_cache_entries
+                or self._cache_bytes > self.max_cache_bytes
+            ):
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted.data_url)
+            del self._pending[key]
+        future.set_result(image)
+        return image
+
+    def _prepare(self, path: str, content_hash: str, detail: str) -> PreparedImage:
+        # Imported here, as it is only needed once images are used
+        from PIL import Image, ImageOps
+
+        with Image.open(path) as image:
+            # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale, much faster than in full
+            image.draft("RGB", fit_image_size(*image.size, detail=detail))
+            image = ImageOps.exif_transpose(image)
+            size = fit_image_size(*image.size, detail=detail)
+            if size != image.size:
+                image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            buffer = BytesIO()
+            if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+                image.save(buffer, format="PNG")
+                mime_type = "image/png"
+            else:
+                image.convert("RGB").save(
+                    buffer, format="JPEG", quality=self.jpeg_quality, optimize=True
+                )
+                mime_type = "image/jpeg"
+        encoded = b64encode(buffer.getvalue()).decode("ascii")
+        return PreparedImage(
+            data_url=f"data:{mime_type};base64,{encoded}",
+            width=size[0],
+            height=size[1],
+            detail=detail,
+            num_tokens=estimate_image_tokens(*size, detail=detail),
+            content_hash=content_hash,
+        )
+
+
+_IMAGE_PREPROCESSOR: ImagePreprocessor = None
+_IMAGE_PREPROCESSOR_LOCK = Lock()
+
+
+def get_image_preprocessor(config: Box = None) -> ImagePreprocessor:
+    """Return the process-wide image preprocessor (built from config on first use)."""
+    global _IMAGE_PREPROCESSOR
+    if _IMAGE_PREPROCESSOR is None:
+        with _IMAGE_PREPROCESSOR_LOCK:
+            if _IMAGE_PREPROCESSOR is None:
+                _IMAGE_PREPROCESSOR = ImagePreprocessor.from_config(config=config)
+    return _IMAGE_PREPROCESSOR
@@ -0,0 +1,183 @@
+"""
+Load test for the chatbot app.
+
+Simulates N concurrent users chatting through the `demo` Blocks queue (via gradio_client), and
+reports p50/p95/p99 time to first token (TTFT), inter-update latency and total latency, plus
+throughput. By default the app is launched in-process on the mock backend (see mock_backend.py,
+and the MOCK_* keys of config.yaml), so no API calls are made.
+
+Note: the app coalesces streamed chunks before sending them to the UI, so inter-update latency is
+measured between UI updates, not between individual tokens.
+
+Usage:
+
+    python src/load_test.py --users 50 --turns 3
+    python src/load_test.py --users 50 --turns 3 --url http://127.0.0.1:7860/  # running app
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+from gradio_client import Client
+
+API_NAME = "/bot_response"
+# Outputs of the endpoint, as returned to API clients (without gr.State outputs): the accrued cost
+# table, the chatbot, the session id and the voice answer
+CHATBOT_OUTPUT_IDX = 1
+SESSION_ID_OUTPUT_IDX = 2
+
+
+class TurnTiming:
+    __slots__ = ("ttft_s", "update_gaps_s", "total_s", "num_chars", "error")
+
+    def __init__(self) -> None:
+        self.ttft_s = None
+        self.update_gaps_s: List[float] = []
+        self.total_s = None
+        self.num_chars = 0
+        self.error = None
+
+
+def _get_last_answer(chatbot_value) -> str:
+    """Return the last bot message of a Chatbot output (a list, or a JSON file of one)."""
+    if isinstance(chatbot_value, str):
+        with open(chatbot_value, "r") as file:
+            chatbot_value = json.load(file)
+    if not chatbot_value:
+        return ""
+    return chatbot_value[-1][1] or ""
+
+
+def run_user(
+    url: str,
+    user_idx: int,
+    num_turns: int,
+    system_prompt: str,
+    results: List[TurnTiming],
+    results_lock: threading.Lock,
+    poll_interval_s: float = 0.005,
+) -> None:
+    """Simulate one user chatting for a number of turns, recording timings of each turn."""
+    client = Client(url, verbose=False)
+    chat_history = []
+    # Assigned by the app on the first turn, and sent back with the next ones (as a browser would)
+    session_id = ""
+    for turn_idx in range(num_turns):
+        chat_history = chat_history + [[f"User {user_idx}, question {turn_idx}: hello!", None]]
+        timing = TurnTiming()
+        started_at = time.perf_counter()
+        last_update_at = None
+        num_outputs_seen = 0
+        job = client.submit(
+            system_prompt,  # System prompt
+            chat_history,  # Chatbot
+            False,  # Answer from the documents (RAG)
+            session_id,  # Session id
+            False,  # Read answers aloud
+            api_name=API_NAME,
+        )
+        while True:
+            done = job.done()
+            outputs = job.outputs()
+            if len(outputs) > num_outputs_seen:
+                now = time.perf_counter()
+                num_outputs_seen = len(outputs)
+                answer = _get_last_answer(outputs[-1][CHATBOT_OUTPUT_IDX])
+                if answer and timing.ttft_s is None:
+                    timing.ttft_s = now - started_at
+                elif answer and last_update_at is not None:
+                    timing.update_gaps_s.append(now - last_update_at)
+                if answer:
+                    last_update_at = now
+                    timing.num_chars = len(answer)
+                    chat_history[-1][1] = answer
+            if done:
+                break
+            time.sleep(poll_interval_s)
+        timing.total_s = time.perf_counter() - started_at
+        if job.exception() is not None:
+            timing.error = repr(job.exception())
+        elif outputs:
+            session_id = outputs[-1][SESSION_ID_OUTPUT_IDX] or session_id
+        with results_lock:
+            results.append(timing)
+        if timing.error is not None:
+            return
+
+
+def summarize(results: List[TurnTiming], wall_time_s: float) -> Dict:
+    """Return latency percentiles and throughput of a load test."""
+
+    def percentiles(values: List[float]) -> Dict[str, float]:
+        if not values:
+            return {"p50": None, "p95": None, "p99": None}
+        p50, p95, p99 = np.percentile(np.asarray(values), [50, 95, 99])
+        return {"p50": round(p50, 4), "p95": round(p95, 4), "p99": round(p99, 4)}
+
+    succeeded = [timing for timing in results if timing.error is None]
+    return {
+        "turns": len(results),
+        "errors": len(results) - len(succeeded),
+        "wall_time_s": round(wall_time_s, 2),
+        "ttft_s": percentiles([t.ttft_s for t in succeeded if t.ttft_s is not None]),
+        "inter_update_s": percentiles([gap for t in succeeded for gap in t.update_gaps_s]),
+        "total_s": percentiles([t.total_s for t in succeeded]),
+        "throughput_turns_per_s": round(len(succeeded) / wall_time_s, 2),
+        "throughput_chars_per_s": round(sum(t.num_chars for t in succeeded) / wall_time_s, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10, help="Number of concurrent users")
+    parser.add_argument("--turns", type=int, default=3, help="Chat turns per user")
+    parser.add_argument("--url", default=None, help="URL of a running app (default: launch one)")
+    parser.add_argument("--port", type=int, default=7861, help="Port when launching the app")
+    parser.add_argument("--system-prompt", default="", help="System prompt sent by users")
+    parser.add_argument(
+        "--live", action="store_true", help="Use the real API instead of the mock backend"
+    )
+    args = parser.parse_args()
+
+    url = args.url
+    if url is None:
+        # Read when the app is imported (its warm-up builds the client right away)
+        os.environ["CHATBOT_MOCK_PREDICT"] = "0" if args.live else "1"
+        import app_chatterbot
+
+        _, url, _ = app_chatterbot.demo.launch(
+            prevent_thread_lock=True, server_port=args.port, quiet=True
+        )
+
+    results: List[TurnTiming] = []
+    results_lock = threading.Lock()
+    threads = [
+        threading.Thread(
+            target=run_user,
+            kwargs=dict(
+                url=url,
+                user_idx=user_idx,
+                num_turns=args.turns,
+                system_prompt=args.system_prompt,
+                results=results,
+                results_lock=results_lock,
+            ),
+            daemon=True,
+        )
+        for user_idx in range(args.users)
+    ]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps(summarize(results, wall_time_s=time.perf_counter() - started_at), indent=2))
+
+
+if __name__ == "__main__":
+    main()
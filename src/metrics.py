@@ -0,0 +1,253 @@
+"""
+Low overhead timing metrics of the request hot path, exposed in Prometheus text format.
+
+Durations are recorded into fixed-bucket histograms (one per span, e.g. `ttft`, `inter_chunk`,
+`ui_yield`), counters count requests, tokens, etc. A RequestTrace collects the spans of one
+request and, if `METRICS_TRACE_LOG` is set, appends them to a JSONL trace log when it finishes.
+
+If `METRICS_PORT` is set, `start_metrics_server` serves the metrics at http://<host>:<port>/metrics
+from a background thread.
+
+Usage:
+
+    trace = RequestTrace(metrics=get_metrics(), session=session_id)
+    with trace.span("request_send"):
+        ...
+    trace.finish()
+"""
+
+import json
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import makedirs
+from os.path import dirname, join
+from threading import Lock, Thread
+from typing import Dict, Iterator, Optional, Tuple
+
+from box.box import Box
+
+from utils import get_root_dir_path
+
+# Histogram bucket upper bounds, in seconds (1ms to 2min)
+DEFAULT_BUCKETS_S = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0
+)
+METRIC_PREFIX = "chatbot"
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Fixed-bucket histogram (observing is a bisect and three additions)."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS_S) -> None:
+        self.buckets = buckets
+        # Last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Registry of span histograms and counters, with an optional JSONL trace log."""
+
+    def __init__(
+        self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS_S, trace_log_path: str = None
+    ) -> None:
+        self.buckets = buckets
+        self.trace_log_path = trace_log_path
+        self._lock = Lock()
+        self._spans: Dict[LabelsKey, Histogram] = dict()
+        self._counters: Dict[Tuple[str, LabelsKey], float] = dict()
+        self._trace_log = None
+        if trace_log_path is not None:
+            makedirs(dirname(trace_log_path) or ".", exist_ok=True)
+            self._trace_log = open(trace_log_path, "a", buffering=1)
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "Metrics":
+        """Build metrics from the `METRICS_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        trace_log_path = config.get("METRICS_TRACE_LOG", None)
+        return cls(
+            trace_log_path=join(get_root_dir_path(), trace_log_path) if trace_log_path else None
+        )
+
+    def observe(self, span: str, seconds: float, **labels: str) -> None:
+        """Record the duration of a span."""
+        key = (("span", span),) + tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._spans.get(key)
+            if histogram is None:
+                histogram = self._spans[key] = Histogram(buckets=self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, span: str, **labels: str) -> Iterator[None]:
+        """Time the body of a `with` block as a span."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(span, time.perf_counter() - started_at, **labels)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Increment counter `<prefix>_<name>_total`."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def write_trace(self, record: Dict) -> None:
+        """Append a record to the trace log (if enabled)."""
+        if self._trace_log is None:
+            return
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._trace_log.write(line)
+
+    def render_prometheus(self) -> str:
+        """Return all metrics in Prometheus text exposition format."""
+        with self._lock:
+            spans = [
+                (key, list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in self._spans.items()
+            ]
+            counters = list(self._counters.items())
+
+        lines = []
+        name = f"{METRIC_PREFIX}_span_seconds"
+        lines += [f"# HELP {name} Duration of request lifecycle spans.", f"# TYPE {name} histogram"]
+        for key, counts, total, count in sorted(spans):
+            labels = _format_labels(key)
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{labels} {total}")
+            lines.append(f"{name}_count{labels} {count}")
+
+        names_seen = set()
+        for (counter, key), value in sorted(counters):
+            name = f"{METRIC_PREFIX}_{counter}_total"
+            if name not in names_seen:
+                names_seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key: LabelsKey) -> str:
+    if not key:
+        return ""
+    escaped = (
+        (label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in key
+    )
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+class RequestTrace:
+    """
+    Spans of one request. Each span is recorded into the metrics' histograms as it is added, and
+    the per-request totals are written to the trace log on `finish`.
+    """
+
+    def __init__(self, metrics: Metrics, **attributes) -> None:
+        self.metrics = metrics
+        self.attributes = attributes
+        self.started_at = time.perf_counter()
+        self.spans_s: Dict[str, float] = dict()
+        self.span_counts: Dict[str, int] = dict()
+        self._finished = False
+
+    def add(self, span: str, seconds: float) -> None:
+        self.metrics.observe(span, seconds)
+        self.spans_s[span] = self.spans_s.get(span, 0.0) + seconds
+        self.span_counts[span] = self.span_counts.get(span, 0) + 1
+
+    @contextmanager
+    def span(self, span: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(span, time.perf_counter() - started_at)
+
+    def finish(self, outcome: str = "ok", **attributes) -> None:
+        """Record the request's total duration and outcome (once)."""
+        if self._finished:
+            return
+        self._finished = True
+        self.add("total", time.perf_counter() - self.started_at)
+        self.metrics.inc("requests", outcome=outcome)
+        self.metrics.write_trace(
+            {
+                "timestamp": time.time(),
+                "outcome": outcome,
+                **self.attributes,
+                **attributes,
+                "spans_s": {span: round(seconds, 6) for span, seconds in self.spans_s.items()},
+                "span_counts": self.span_counts,
+            }
+        )
+
+
+_METRICS: Metrics = None
+_METRICS_LOCK = Lock()
+_METRICS_SERVER: ThreadingHTTPServer = None
+
+
+def get_metrics(config: Box = None) -> Metrics:
+    """Return the process-wide metrics (built from config on first use)."""
+    global _METRICS
+    if _METRICS is None:
+        with _METRICS_LOCK:
+            if _METRICS is None:
+                _METRICS = Metrics.from_config(config=config)
+    return _METRICS
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = get_metrics().render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # Scrapes are frequent, so keep them out of the app's logs
+        pass
+
+
+def start_metrics_server(config: Box = None) -> Optional[ThreadingHTTPServer]:
+    """Serve the metrics on `METRICS_PORT` (if set) from a daemon thread, once per process."""
+    global _METRICS_SERVER
+    get_metrics(config=config)
+    port = config.get("METRICS_PORT", None) if config is not None else None
+    with _METRICS_LOCK:
+        if port is None or _METRICS_SERVER is not None:
+            return _METRICS_SERVER
+        try:
+            _METRICS_SERVER = ThreadingHTTPServer(
+                (config.get("METRICS_HOST", "127.0.0.1"), port), _MetricsRequestHandler
+            )
+        except OSError as e:
+            print(f"Warning: Could not start metrics server on port {port} ({e}).")
+            return None
+        Thread(target=_METRICS_SERVER.serve_forever, daemon=True).start()
+    return _METRICS_SERVER
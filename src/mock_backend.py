@@ -0,0 +1,281 @@
+"""
+Local stand-in for the OpenAI chat completions (and embeddings, speech) API, for load testing
+without spending API money.
+
+The backend runs in-process as an httpx transport, so an OpenAI/AsyncOpenAI client (and so an
+OAIClient) can be pointed at it through its `http_client`. Latency (time to first token, tokens per
+second), error rates and 429 rate limiting are configurable.
+
+Usage:
+
+    backend = MockChatBackend(ttft_s=0.3, tokens_per_s=50)
+    client = build_mock_openai_client(backend=backend, async_client=True)
+    oai_client = AsyncOAIClient(client=client)
+"""
+
+import asyncio
+import json
+import random
+import time
+import zlib
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+from uuid import uuid4
+
+import httpx
+import numpy as np
+from box.box import Box
+from openai import AsyncOpenAI, OpenAI
+
+MOCK_BASE_URL = "http://mock-openai.local/v1"
+
+
+class MockChatBackend:
+    """Generates (streamed) chat completion responses, with configurable latency and faults."""
+
+    def __init__(
+        self,
+        ttft_s: float = 0.3,
+        tokens_per_s: float = 50.0,
+        response_tokens: int = 60,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after_s: float = 1.0,
+        embedding_latency_s: float = 0.05,
+        embedding_dim: int = 1536,
+        speech_latency_s: float = 0.2,
+        seed: int = None,
+    ) -> None:
+        self.ttft_s = ttft_s
+        self.tokens_per_s = tokens_per_s
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_s = retry_after_s
+        self.embedding_latency_s = embedding_latency_s
+        self.embedding_dim = embedding_dim
+        self.speech_latency_s = speech_latency_s
+        self._random = random.Random(seed)
+        self.metrics: Dict[str, int] = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "MockChatBackend":
+        """Build backend from the `MOCK_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            ttft_s=config.get("MOCK_TTFT_S", 0.3),
+            tokens_per_s=config.get("MOCK_TOKENS_PER_S", 50.0),
+            response_tokens=config.get("MOCK_RESPONSE_TOKENS", 60),
+            error_rate=config.get("MOCK_ERROR_RATE", 0.0),
+            rate_limit_rate=config.get("MOCK_RATE_LIMIT_RATE", 0.0),
+            embedding_latency_s=config.get("MOCK_EMBEDDING_LATENCY_S", 0.05),
+            speech_latency_s=config.get("MOCK_SPEECH_LATENCY_S", 0.2),
+        )
+
+    def handle(self, request: httpx.Request) -> Union[httpx.Response, Tuple[str, List]]:
+        """
+        Return an error response, or the plan of a successful one as its content type and a list
+        of (delay in seconds, bytes) parts.
+        """
+        self.metrics["requests"] += 1
+        if request.url.path.endswith("/models"):
+            # Used for health checks (see endpoint_router.py)
+            return httpx.Response(
+                200, json={"object": "list", "data": [{"id": "mock", "object": "model"}]}
+            )
+        if not request.url.path.endswith(("/chat/completions", "/embeddings", "/audio/speech")):
+            return self._error(404, f"Mock backend does not implement {request.url.path}")
+        roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            self.metrics["rate_limited"] += 1
+            return self._error(
+                429,
+                "Rate limit reached (mock).",
+                headers={
+                    "retry-after": str(self.retry_after_s),
+                    "x-ratelimit-remaining-requests": "0",
+                    "x-ratelimit-reset-requests": f"{self.retry_after_s}s",
+                },
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.metrics["errors"] += 1
+            return self._error(500, "Internal server error (mock).")
+
+        body = json.loads(request.content)
+        if request.url.path.endswith("/embeddings"):
+            return self._plan_embeddings(body=body)
+        if request.url.path.endswith("/audio/speech"):
+            return self._plan_speech(body=body)
+        words = self._make_words(body)
+        if body.get("stream"):
+            return self._plan_stream(body=body, words=words)
+        return self._plan_completion(body=body, words=words)
+
+    def _plan_stream(self, body: Dict, words: List[str]) -> Tuple[str, List]:
+        completion_id, created = f"chatcmpl-mock-{uuid4().hex}", int(time.time())
+        token_interval_s = 1.0 / self.tokens_per_s if self.tokens_per_s else 0.0
+
+        def event(delta: Dict = None, finish_reason: str = None, usage: Dict = None) -> bytes:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model", "mock"),
+                "choices": (
+                    [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                    if delta is not None
+                    else []
+                ),
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        parts = [(self.ttft_s, event({"role": "assistant", "content": ""}))]
+        parts += [
+            (0.0 if idx == 0 else token_interval_s, event({"content": word}))
+            for idx, word in enumerate(words)
+        ]
+        parts += [(0.0, event({}, finish_reason="stop"))]
+        if (body.get("stream_options") or {}).get("include_usage"):
+            # As the API does: a last chunk without choices, carrying the usage of the call
+            parts += [(0.0, event(usage=self._make_usage(body=body, words=words)))]
+        parts += [(0.0, b"data: [DONE]\n\n")]
+        return "text/event-stream", parts
+
+    def _plan_completion(self, body: Dict, words: List[str]) -> Tuple[str, List]:
+        delay_s = self.ttft_s + (len(words) / self.tokens_per_s if self.tokens_per_s else 0.0)
+        completion = {
+            "id": f"chatcmpl-mock-{uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": self._make_usage(body=body, words=words),
+        }
+        return "application/json", [(delay_s, json.dumps(completion).encode("utf-8"))]
+
+    def _plan_embeddings(self, body: Dict) -> Tuple[str, List]:
+        """Deterministic (seeded by the text), unit length random embeddings."""
+        texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+        data = []
+        for idx, text in enumerate(texts):
+            seed = zlib.crc32(str(text).encode("utf-8"))
+            embedding = np.random.default_rng(seed).standard_normal(self.embedding_dim)
+            embedding /= np.linalg.norm(embedding)
+            data.append({"object": "embedding", "index": idx, "embedding": embedding.tolist()})
+        num_tokens = sum(len(str(text).split()) for text in texts)
+        response = {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "mock"),
+            "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens},
+        }
+        return "application/json", [
+            (self.embedding_latency_s, json.dumps(response).encode("utf-8"))
+        ]
+
+    def _plan_speech(self, body: Dict) -> Tuple[str, List]:
+        """Placeholder audio (not playable): the input text, tagged with the voice."""
+        audio = f"[{body.get('voice', 'alloy')}] {body['input']}".encode("utf-8")
+        return "application/octet-stream", [(self.speech_latency_s, audio)]
+
+    @staticmethod
+    def _make_usage(body: Dict, words: List[str]) -> Dict[str, int]:
+        prompt_tokens = sum(
+            len(str(message.get("content", "")).split()) + 3 for message in body["messages"]
+        )
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": prompt_tokens + len(words),
+        }
+
+    def _make_words(self, body: Dict) -> List[str]:
+        num_words = self.response_tokens
+        if body.get("max_tokens"):
+            num_words = min(num_words, body["max_tokens"])
+        return [f"mock{idx} " for idx in range(num_words)]
+
+    @staticmethod
+    def _error(status_code: int, message: str, headers: Dict[str, str] = None) -> httpx.Response:
+        return httpx.Response(
+            status_code,
+            headers=headers,
+            json={"error": {"message": message, "type": "mock_error", "code": status_code}},
+        )
+
+
+class _SyncPlannedStream(httpx.SyncByteStream):
+    def __init__(self, parts: List) -> None:
+        self._parts = parts
+
+    def __iter__(self) -> Iterator[bytes]:
+        for delay_s, data in self._parts:
+            if delay_s:
+                time.sleep(delay_s)
+            yield data
+
+
+class _AsyncPlannedStream(httpx.AsyncByteStream):
+    def __init__(self, parts: List) -> None:
+        self._parts = parts
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for delay_s, data in self._parts:
+            if delay_s:
+                await asyncio.sleep(delay_s)
+            yield data
+
+
+class MockTransport(httpx.BaseTransport):
+    """Sync httpx transport serving requests from a MockChatBackend."""
+
+    def __init__(self, backend: MockChatBackend) -> None:
+        self.backend = backend
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        plan = self.backend.handle(request)
+        if isinstance(plan, httpx.Response):
+            return plan
+        content_type, parts = plan
+        return httpx.Response(
+            200, headers={"content-type": content_type}, stream=_SyncPlannedStream(parts)
+        )
+
+
+class AsyncMockTransport(httpx.AsyncBaseTransport):
+    """Async httpx transport serving requests from a MockChatBackend."""
+
+    def __init__(self, backend: MockChatBackend) -> None:
+        self.backend = backend
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        plan = self.backend.handle(request)
+        if isinstance(plan, httpx.Response):
+            return plan
+        content_type, parts = plan
+        return httpx.Response(
+            200, headers={"content-type": content_type}, stream=_AsyncPlannedStream(parts)
+        )
+
+
+def build_mock_openai_client(
+    backend: MockChatBackend = None, async_client: bool = True, **kwargs
+) -> Union[OpenAI, AsyncOpenAI]:
+    """Build an OpenAI/AsyncOpenAI client whose requests are served by a mock backend."""
+    backend = backend if backend is not None else MockChatBackend()
+    if async_client:
+        http_client = httpx.AsyncClient(transport=AsyncMockTransport(backend=backend))
+        return AsyncOpenAI(
+            api_key="mock", base_url=MOCK_BASE_URL, http_client=http_client, **kwargs
+        )
+    http_client = httpx.Client(transport=MockTransport(backend=backend))
+    return OpenAI(api_key="mock", base_url=MOCK_BASE_URL, http_client=http_client, **kwargs)
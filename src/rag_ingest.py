@@ -0,0 +1,351 @@
+"""
+Incremental, parallel ingestion of documents into a persistent chromadb collection (for RAG).
+
+Files are hashed, parsed and chunked on a process pool (see document_parsing.py), while this
+process embeds finished chunks in batches and writes them to the collection. A manifest of each
+file's content hash (by full path) is kept next to the collection, so files that did not change
+since they were last ingested are skipped without being parsed, and changed files have their old
+chunks replaced.
+
+Workers are started from a fork server that preloads document_parsing only, so they neither share
+the state of this (threaded) process nor re-import the app's main module.
+
+Usage:
+
+    ingestor = get_document_ingestor(config)
+    for progress in ingestor.ingest(paths):
+        print(progress.files_done, progress.files_total)
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import context, forkserver, spawn, util
+from os.path import abspath, basename, join
+from threading import Lock
+from typing import AbstractSet, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+from box.box import Box
+from openai import OpenAI
+
+from document_parsing import ParsedDocument, process_file
+from embeddings import get_embedding_function
+from utils import get_root_dir_path
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+class IngestProgress(NamedTuple):
+    """Progress of an `ingest` run (yielded after every file, and once at the end)."""
+
+    files_done: int
+    files_total: int
+    indexed: int
+    skipped: int
+    failed: int
+    chunks_added: int
+    current: Optional[str]
+    elapsed_s: float
+    errors: List[str]
+
+
+class DocumentIngestor:
+    """
+    Ingests files into a chromadb collection. Chunks are stored with their `source` (file name),
+    `path`, `content_hash`, `chunk_index` and `num_tokens` as metadata. Files are told apart by
+    their full path, so files with the same name (e.g. uploads from different sessions) do not
+    replace each other. `version` changes whenever the collection does (see retrieval.py).
+    """
+
+    COLLECTION_NAME: str = "documents"
+
+    def __init__(
+        self,
+        persist_dir: str,
+        embedding_function: Callable[[List[str]], List[List[float]]],
+        collection_name: str = COLLECTION_NAME,
+        chunk_tokens: int = 400,
+        chunk_overlap_tokens: int = 50,
+        embedding_batch_size: int = 128,
+        max_workers: int = None,
+    ) -> None:
+        self.persist_dir = persist_dir
+        self.embedding_function = embedding_function
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.embedding_batch_size = embedding_batch_size
+        self.max_workers = max_workers or os.cpu_count() or 1
+        os.makedirs(persist_dir, exist_ok=True)
+        # Imported here, as it is slow to import and only needed once documents are used
+        import chromadb
+
+        # Embeddings are always computed here (in batches), never by chromadb
+        self.collection = chromadb.PersistentClient(path=persist_dir).get_or_create_collection(
+            name=collection_name,
+            embedding_function=None,
+            metadata={"hnsw:space": "cosine"},
+        )
+        self._manifest_path = join(persist_dir, MANIFEST_FILE_NAME)
+        self._manifest: Dict[str, Dict] = self._read_manifest()
+        # One ingestion at a time (they share the manifest and the pool)
+        self._lock = Lock()
+        self._executor: ProcessPoolExecutor = None
+        self.version = 0
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[Box], openai_client_factory: Callable[[], OpenAI] = None
+    ) -> "DocumentIngestor":
+        """Build ingestor from the `RAG_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        embedding_function = get_embedding_function(
+            config=config,
+            embedder=config.get("RAG_EMBEDDER", "hashing"),
+            model=config.get("RAG_EMBEDDING_MODEL", "text-embedding-ada-002"),
+            openai_client_factory=openai_client_factory,
+        )
+        return cls(
+            persist_dir=join(get_root_dir_path(), config.get("RAG_PERSIST_DIR", ".local/rag")),
+            embedding_function=embedding_function,
+            chunk_tokens=config.get("RAG_CHUNK_TOKENS", 400),
+            chunk_overlap_tokens=config.get("RAG_CHUNK_OVERLAP_TOKENS", 50),
+            embedding_batch_size=config.get("RAG_EMBEDDING_BATCH_SIZE", 128),
+            max_workers=config.get("RAG_INGEST_WORKERS", None),
+        )
+
+    def ingest(
+        self, paths: Sequence[str], sources: Sequence[str] = None
+    ) -> Iterator[IngestProgress]:
+        """
+        Ingest files (`sources` name them in citations, defaulting to their file names).
+        Yields progress as files finish; chunks are written in embedding batches, so a run that is
+        interrupted keeps what it wrote, and the next run only redoes the unfinished files.
+        """
+        sources = list(sources) if sources is not None else [basename(path) for path in paths]
+        started_at = time.perf_counter()
+        counts = {"files_done": 0, "indexed": 0, "skipped": 0, "failed": 0, "chunks_added": 0}
+        errors: List[str] = []
+        progress = lambda current: IngestProgress(
+            files_total=len(paths),
+            current=current,
+            elapsed_s=time.perf_counter() - started_at,
+            errors=errors,
+            **counts,
+        )
+
+        with self._lock:
+            executor = self._get_executor()
+            pending: Dict[Future, str] = dict()
+            jobs = iter(zip(map(abspath, paths), sources))
+            buffer: List[ParsedDocument] = []
+            hashes = {entry["hash"]: path for path, entry in self._manifest.items()}
+            while True:
+                # Keep the pool busy, without parsed chunks piling up ahead of the embedder
+                for path, source in jobs:
+                    future = executor.submit(
+                        process_file,
+                        path=path,
+                        source=source,
+                        known_hash=self._manifest.get(path, dict()).get("hash"),
+                        chunk_tokens=self.chunk_tokens,
+                        overlap_tokens=self.chunk_overlap_tokens,
+                    )
+                    pending[future] = source
+                    if len(pending) >= 2 * self.max_workers:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source = pending.pop(future)
+                    counts["files_done"] += 1
+                    try:
+                        document = future.result()
+                    except Exception as e:
+                        counts["failed"] += 1
+                        errors.append(f"{source}: {e}")
+                        document = None
+                    if document is not None and document.unchanged:
+                        counts["skipped"] += 1
+                    elif document is not None and document.content_hash in hashes:
+                        # The same content is already indexed from another file: not indexed
+                        # again, but recorded, so the file's older chunks (if any) are removed
+                        self._record_duplicate(document, duplicate_of=hashes[document.content_hash])
+                        counts["skipped"] += 1
+                    elif document is not None:
+                        hashes[document.content_hash] = document.path
+                        buffer.append(document)
+                        if sum(len(doc.chunks) for doc in buffer) >= self.embedding_batch_size:
+                            self._write(buffer, counts=counts, errors=errors)
+                            buffer = []
+                    yield progress(current=source)
+            if buffer:
+                self._write(buffer, counts=counts, errors=errors)
+        yield progress(current=None)
+
+    def stats(self) -> Dict:
+        return {"documents": len(self._manifest), "chunks": self.collection.count()}
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Forking this process directly is unsafe (its other threads may hold locks), and
+            # spawned workers would re-import the app's main module (and build its UI)
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = _ParsingContext()
+                mp_context.set_forkserver_preload(["document_parsing"])
+            else:
+                mp_context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=mp_context
+            )
+        return self._executor
+
+    def _write(
+        self, documents: List[ParsedDocument], counts: Dict[str, int], errors: List[str]
+    ) -> None:
+        """Embed and store the chunks of documents (replacing older versions of them)."""
+        ids, texts, metadatas = [], [], []
+        for document in documents:
+            for chunk_index, (chunk, num_tokens) in enumerate(
+                zip(document.chunks, document.chunk_tokens)
+            ):
+                ids.append(f"{document.content_hash[:16]}-{chunk_index}")
+                texts.append(chunk)
+                metadatas.append(
+                    {
+                        "source": document.source,
+                        "path": document.path,
+                        "content_hash": document.content_hash,
+                        "chunk_index": chunk_index,
+                        "num_tokens": num_tokens,
+                    }
+                )
+        try:
+            for start in range(0, len(texts), self.embedding_batch_size):
+                end = start + self.embedding_batch_size
+                self.collection.upsert(
+                    ids=ids[start:end],
+                    embeddings=self.embedding_function(texts[start:end]),
+                    documents=texts[start:end],
+                    metadatas=metadatas[start:end],
+                )
+        except Exception as e:
+            # Not recorded in the manifest, so the next run retries these documents
+            counts["failed"] += len(documents)
+            errors.append(f"Could not embed {[doc.source for doc in documents]}: {e}")
+            return
+        # Older versions of the documents are only deleted once the new ones are stored, so a
+        # failed write leaves them searchable
+        new_ids = set(ids)
+        for document in documents:
+            if document.path in self._manifest:
+                self._delete_chunks(path=document.path, keep_ids=new_ids)
+        self.version += 1
+        for document in documents:
+            self._manifest[document.path] = {
+                "source": document.source,
+                "hash": document.content_hash,
+                "num_chunks": len(document.chunks),
+            }
+        self._write_manifest()
+        counts["indexed"] += len(documents)
+        counts["chunks_added"] += len(texts)
+
+    def _record_duplicate(self, document: ParsedDocument, duplicate_of: str) -> None:
+        if document.path in self._manifest:
+            self._delete_chunks(path=document.path)
+            self.version += 1
+        self._manifest[document.path] = {
+            "source": document.source,
+            "hash": document.content_hash,
+            "num_chunks": 0,
+            "duplicate_of": duplicate_of,
+        }
+        self._write_manifest()
+
+    def _delete_chunks(self, path: str, keep_ids: AbstractSet[str] = frozenset()) -> None:
+        """Delete the chunks of a file from the collection, except `keep_ids`."""
+        old_ids = self.collection.get(where={"path": path}, include=[])["ids"]
+        stale_ids = [chunk_id for chunk_id in old_ids if chunk_id not in keep_ids]
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+
+    def _read_manifest(self) -> Dict[str, Dict]:
+        try:
+            with open(self._manifest_path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return dict()
+
+    def _write_manifest(self) -> None:
+        # Atomic, so an interrupted write cannot lose the manifest
+        tmp_path = f"{self._manifest_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._manifest, file)
+        os.replace(tmp_path, self._manifest_path)
+
+
+# Not available on Windows, where workers are spawned instead
+if "forkserver" in multiprocessing.get_all_start_methods():
+    from multiprocessing import popen_forkserver
+
+    class _ParsingPopen(popen_forkserver.Popen):
+        """
+        Starts a worker from the fork server like `popen_forkserver.Popen`, but without telling it
+        to re-run the parent's main module: workers only need document_parsing (preloaded by the
+        fork server), while re-running the app's main module would build its UI in every worker.
+        """
+
+        def _launch(self, process_obj):
+            prep_data = spawn.get_preparation_data(process_obj._name)
+            prep_data.pop("init_main_from_name", None)
+            prep_data.pop("init_main_from_path", None)
+            buf = io.BytesIO()
+            context.set_spawning_popen(self)
+            try:
+                context.reduction.dump(prep_data, buf)
+                context.reduction.dump(process_obj, buf)
+            finally:
+                context.set_spawning_popen(None)
+
+            self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+            # Duplicate of the write end, closed with the sentinel (as in popen_forkserver.Popen)
+            _parent_w = os.dup(w)
+            self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+            with open(w, "wb", closefd=True) as file:
+                file.write(buf.getbuffer())
+            self.pid = forkserver.read_signed(self.sentinel)
+
+    class _ParsingProcess(context.ForkServerProcess):
+        @staticmethod
+        def _Popen(process_obj):
+            return _ParsingPopen(process_obj)
+
+    class _ParsingContext(context.ForkServerContext):
+        Process = _ParsingProcess
+
+
+_DOCUMENT_INGESTOR: DocumentIngestor = None
+_DOCUMENT_INGESTOR_LOCK = Lock()
+
+
+def get_document_ingestor(
+    config: Box = None, openai_client_factory: Callable[[], OpenAI] = None
+) -> DocumentIngestor:
+    """Return the process-wide document ingestor (built from config on first use)."""
+    global _DOCUMENT_INGESTOR
+    if _DOCUMENT_INGESTOR is None:
+        with _DOCUMENT_INGESTOR_LOCK:
+            if _DOCUMENT_INGESTOR is None:
+                _DOCUMENT_INGESTOR = DocumentIngestor.from_config(
+                    config=config, openai_client_factory=openai_client_factory
+                )
+    return _DOCUMENT_INGESTOR
@@ -0,0 +1,268 @@
+"""
+Process-wide rate limiting of chat completion calls, shared by all sessions (and batch jobs).
+
+Limits are per process: separate processes (e.g. the app, and a batch_runner.py run) each spend
+their configured RPM/TPM, so several processes on one quota should each be given their share. The
+API's `x-ratelimit-*` headers and 429s (see below) still slow every process down as the shared
+quota runs out.
+
+Each model/deployment gets one RateLimiter: token buckets for requests per minute (RPM) and tokens
+per minute (TPM), refilled continuously. Callers estimate the tokens of a request up front and
+wait their turn: callers are served first-in first-out within a lane (e.g. "interactive",
+"batch"), and lanes take turns, so a large batch job cannot starve interactive sessions (nor the
+other way around).
+
+The buckets adapt to what the API reports: `x-ratelimit-*` headers cap (or, if no limits are
+configured, set) the buckets, and a 429 blocks all callers for its `retry-after` and halves the
+refill rate, which then recovers with every successful call.
+"""
+
+import asyncio
+import random
+import re
+import time
+from collections import deque
+from itertools import count
+from threading import Lock
+from typing import Deque, Dict, List, Mapping, Optional
+
+from box.box import Box
+
+# Longest a waiting caller sleeps before checking again whether it is its turn
+MAX_POLL_INTERVAL_S = 0.05
+# Wait after a 429 without a usable retry-after header
+DEFAULT_RETRY_AFTER_S = 1.0
+# Floor of the refill rate scale after repeated 429s
+MIN_RATE_SCALE = 0.1
+RATE_SCALE_RECOVERY = 0.05
+
+_DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS_S = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration_s(value: str) -> Optional[float]:
+    """Parse a rate limit reset duration (e.g. "20ms", "1s", "6m0s") or plain seconds."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS_S[unit] for amount, unit in parts)
+
+
+def backoff_s(attempt: int, base_s: float = 0.5, max_s: float = 8.0) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(max_s, base_s * 2**attempt))
+
+
+class _Bucket:
+    """Token bucket holding up to `capacity`, refilled at `capacity` per minute."""
+
+    __slots__ = ("capacity", "level", "updated_at")
+
+    def __init__(self, capacity: float) -> None:
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float, rate_scale: float = 1.0) -> None:
+        elapsed_s = now - self.updated_at
+        self.level = min(self.capacity, self.level + elapsed_s * self.capacity / 60 * rate_scale)
+        self.updated_at = now
+
+    def wait_s(self, amount: float, rate_scale: float = 1.0) -> float:
+        """Return how long until `amount` is available (0 if it is now)."""
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / (self.capacity / 60 * rate_scale)
+
+
+class RateLimiter:
+    """
+    RPM/TPM limiter of one model/deployment. `rpm` and `tpm` can be None (unlimited, unless the
+    API reports limits in its headers).
+    """
+
+    def __init__(self, rpm: int = None, tpm: int = None) -> None:
+        self._requests = _Bucket(rpm) if rpm else None
+        self._tokens = _Bucket(tpm) if tpm else None
+        self._lock = Lock()
+        self._tickets = count()
+        self._lanes: Dict[str, Deque[int]] = dict()
+        self._lane_order: List[str] = []
+        self._next_lane_idx = 0
+        self._blocked_until = 0.0
+        self._rate_scale = 1.0
+        self.metrics: Dict[str, float] = {"acquired": 0, "rate_limited": 0, "wait_s": 0.0}
+
+    @classmethod
+    def from_config(cls, config: Optional[Box], key: str) -> "RateLimiter":
+        """Build limiter from the `RATE_LIMITS` of a config file (entry `key`, else `DEFAULT`)."""
+        rate_limits = (config if config is not None else Box()).get("RATE_LIMITS", None) or dict()
+        limits = rate_limits.get(key, rate_limits.get("DEFAULT", None)) or dict()
+        return cls(rpm=limits.get("RPM", None), tpm=limits.get("TPM", None))
+
+    def acquire(self, tokens: int = 0, lane: str = "interactive") -> float:
+        """Block until a request of `tokens` tokens may be sent. Returns the time waited."""
+        started_at = time.monotonic()
+        ticket = self._enqueue(lane=lane)
+        granted = False
+        try:
+            while True:
+                wait_s = self._try_acquire(ticket=ticket, lane=lane, tokens=tokens)
+                if wait_s == 0:
+                    granted = True
+                    return self._record_wait(started_at=started_at)
+                time.sleep(min(wait_s, MAX_POLL_INTERVAL_S))
+        finally:
+            if not granted:
+                self._dequeue(ticket=ticket, lane=lane)
+
+    async def aacquire(self, tokens: int = 0, lane: str = "interactive") -> float:
+        """Wait (without blocking the event loop) until a request may be sent."""
+        started_at = time.monotonic()
+        ticket = self._enqueue(lane=lane)
+        granted = False
+        try:
+            while True:
+                wait_s = self._try_acquire(ticket=ticket, lane=lane, tokens=tokens)
+                if wait_s == 0:
+                    granted = True
+                    return self._record_wait(started_at=started_at)
+                await asyncio.sleep(min(wait_s, MAX_POLL_INTERVAL_S))
+        finally:
+            # Also runs if the waiting task is cancelled, so it does not block its lane
+            if not granted:
+                self._dequeue(ticket=ticket, lane=lane)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Sync the buckets with the `x-ratelimit-*` headers of a successful response."""
+        with self._lock:
+            self._rate_scale = min(1.0, self._rate_scale + RATE_SCALE_RECOVERY)
+            self._requests = self._sync_bucket(self._requests, headers=headers, kind="requests")
+            self._tokens = self._sync_bucket(self._tokens, headers=headers, kind="tokens")
+
+    def penalize(self, headers: Mapping[str, str] = None) -> float:
+        """
+        Back off after a 429: block all callers for the response's retry-after, and halve the
+        refill rate. Returns the time callers are blocked for.
+        """
+        headers = headers if headers is not None else dict()
+        retry_after_s = None
+        if headers.get("retry-after-ms") is not None:
+            retry_after_s = (parse_duration_s(headers["retry-after-ms"]) or 0) / 1000
+        if not retry_after_s:
+            retry_after_s = parse_duration_s(headers.get("retry-after", None))
+        if not retry_after_s or retry_after_s < 0:
+            retry_after_s = DEFAULT_RETRY_AFTER_S
+        with self._lock:
+            self.metrics["rate_limited"] += 1
+            self._rate_scale = max(MIN_RATE_SCALE, self._rate_scale / 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after_s)
+        return retry_after_s
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self.metrics,
+                "rate_scale": self._rate_scale,
+                "waiting": {lane: len(queue) for lane, queue in self._lanes.items()},
+            }
+
+    def _enqueue(self, lane: str) -> int:
+        ticket = next(self._tickets)
+        with self._lock:
+            if lane not in self._lanes:
+                self._lanes[lane] = deque()
+                self._lane_order.append(lane)
+            self._lanes[lane].append(ticket)
+        return ticket
+
+    def _dequeue(self, ticket: int, lane: str) -> None:
+        with self._lock:
+            try:
+                self._lanes[lane].remove(ticket)
+            except ValueError:
+                pass
+
+    def _try_acquire(self, ticket: int, lane: str, tokens: int) -> float:
+        """Take capacity for a ticket if it is its turn. Returns 0, or how long to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self._lanes[lane][0] != ticket or self._get_turn_lane() != lane:
+                return MAX_POLL_INTERVAL_S
+            wait_s = 0.0
+            if self._requests is not None:
+                self._requests.refill(now=now, rate_scale=self._rate_scale)
+                wait_s = max(wait_s, self._requests.wait_s(1, rate_scale=self._rate_scale))
+            if self._tokens is not None:
+                # Requests larger than the bucket would never fit, so they wait for a full one
+                tokens = min(tokens, self._tokens.capacity)
+                self._tokens.refill(now=now, rate_scale=self._rate_scale)
+                wait_s = max(wait_s, self._tokens.wait_s(tokens, rate_scale=self._rate_scale))
+            if wait_s > 0:
+                return wait_s
+            if self._requests is not None:
+                self._requests.level -= 1
+            if self._tokens is not None:
+                self._tokens.level -= tokens
+            self._lanes[lane].popleft()
+            self._next_lane_idx = (self._lane_order.index(lane) + 1) % len(self._lane_order)
+            return 0.0
+
+    def _get_turn_lane(self) -> Optional[str]:
+        """Return the first lane with waiting callers, starting from the lane whose turn it is."""
+        num_lanes = len(self._lane_order)
+        for offset in range(num_lanes):
+            lane = self._lane_order[(self._next_lane_idx + offset) % num_lanes]
+            if self._lanes[lane]:
+                return lane
+        return None
+
+    def _record_wait(self, started_at: float) -> float:
+        waited_s = time.monotonic() - started_at
+        with self._lock:
+            self.metrics["acquired"] += 1
+            self.metrics["wait_s"] += waited_s
+        return waited_s
+
+    def _sync_bucket(
+        self, bucket: Optional[_Bucket], headers: Mapping[str, str], kind: str
+    ) -> Optional[_Bucket]:
+        limit = headers.get(f"x-ratelimit-limit-{kind}", None)
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}", None)
+        if bucket is None and limit is not None:
+            # No configured limit, so adopt the one the API reports
+            bucket = _Bucket(capacity=float(limit))
+        if bucket is None or remaining is None:
+            return bucket
+        bucket.refill(now=time.monotonic(), rate_scale=self._rate_scale)
+        bucket.level = min(bucket.level, float(remaining))
+        if float(remaining) <= 0:
+            reset_s = parse_duration_s(headers.get(f"x-ratelimit-reset-{kind}", None))
+            if reset_s:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + reset_s)
+        return bucket
+
+
+# One limiter per model/deployment, shared by every OAIClient of the process
+_RATE_LIMITERS: Dict[str, RateLimiter] = dict()
+_RATE_LIMITERS_LOCK = Lock()
+
+
+def get_rate_limiter(key: str, config: Box = None) -> RateLimiter:
+    """Return the process-wide rate limiter of a model/deployment (built on first use)."""
+    rate_limiter = _RATE_LIMITERS.get(key)
+    if rate_limiter is None:
+        with _RATE_LIMITERS_LOCK:
+            rate_limiter = _RATE_LIMITERS.get(key)
+            if rate_limiter is None:
+                rate_limiter = RateLimiter.from_config(config=config, key=key)
+                _RATE_LIMITERS[key] = rate_limiter
+    return rate_limiter
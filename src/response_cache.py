@@ -0,0 +1,283 @@
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from os import makedirs
+from os.path import dirname, join
+from threading import Lock
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from box.box import Box
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
+
+from utils import get_root_dir_path
+
+# Request params that make up a cache key. Requests with any other params (tools, n, logit_bias,
+# ...) are not cached.
+CACHE_KEY_PARAMS: Tuple[str, ...] = (
+    "messages",
+    "model",
+    "temperature",
+    "seed",
+    "top_p",
+    "max_tokens",
+)
+_IGNORED_PARAMS: Tuple[str, ...] = ("stream", "stream_options")
+# Replayed answers are split into word-sized chunks, similar to what the API streams
+_REPLAY_CHUNK_PATTERN = re.compile(r"\S+\s*|\s+")
+
+
+def make_cache_key(request: Dict) -> Optional[str]:
+    """Return the cache key of a chat completion request, or None if it is not cacheable."""
+    if any(
+        value is not None
+        for key, value in request.items()
+        if key not in CACHE_KEY_PARAMS and key not in _IGNORED_PARAMS
+    ):
+        return None
+    payload = json.dumps(
+        [request.get(key) for key in CACHE_KEY_PARAMS],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two tier cache of chat completion answers: an in-memory LRU in front of a SQLite table.
+
+    Entries expire after `ttl_s` seconds. Each tier is capped in size, evicting the least recently
+    used entries (the SQLite tier every `DB_EVICT_INTERVAL_PUTS` puts, so it may briefly hold up to
+    that many entries more). Hit/miss counts are kept in `metrics`.
+    """
+
+    DB_EVICT_INTERVAL_PUTS: int = 100
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_s: float = 24 * 60 * 60,
+        db_path: str = None,
+        max_db_entries: int = 100_000,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_db_entries = max_db_entries
+        self.metrics: Dict[str, int] = {
+            "hits_memory": 0,
+            "hits_disk": 0,
+            "misses": 0,
+            "puts": 0,
+            "evictions_memory": 0,
+            "evictions_disk": 0,
+        }
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = Lock()
+        self._db = self._init_db(db_path) if db_path is not None else None
+        self._puts_since_db_eviction = 0
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "ResponseCache":
+        """Build cache from the `RESPONSE_CACHE_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        db_path = config.get("RESPONSE_CACHE_DB_PATH", None)
+        return cls(
+            max_entries=config.get("RESPONSE_CACHE_MAX_ENTRIES", 1024),
+            ttl_s=config.get("RESPONSE_CACHE_TTL_S", 24 * 60 * 60),
+            db_path=join(get_root_dir_path(), db_path) if db_path else None,
+            max_db_entries=config.get("RESPONSE_CACHE_MAX_DB_ENTRIES", 100_000),
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached answer for a key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, content = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.metrics["hits_memory"] += 1
+                    return content
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT content, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    content, expires_at = row
+                    self._db.execute(
+                        "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+                    )
+                    self._put_memory(key=key, content=content, expires_at=expires_at)
+                    self.metrics["hits_disk"] += 1
+                    return content
+
+            self.metrics["misses"] += 1
+            return None
+
+    def put(self, key: str, content: str) -> None:
+        """Cache an answer."""
+        now = time.time()
+        expires_at = now + self.ttl_s
+        with self._lock:
+            self._put_memory(key=key, content=content, expires_at=expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, content, expires_at, last_access) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, content, expires_at, now),
+                )
+                self._puts_since_db_eviction += 1
+                if self._puts_since_db_eviction >= self.DB_EVICT_INTERVAL_PUTS:
+                    self._evict_db(now=now)
+            self.metrics["puts"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss metrics and the current hit rate."""
+        with self._lock:
+            stats = dict(self.metrics)
+        hits = stats["hits_memory"] + stats["hits_disk"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        stats["entries_memory"] = len(self._memory)
+        return stats
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+
+    def _put_memory(self, key: str, content: str, expires_at: float) -> None:
+        self._memory[key] = (expires_at, content)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.metrics["evictions_memory"] += 1
+
+    def _evict_db(self, now: float) -> None:
+        self._puts_since_db_eviction = 0
+        evicted = self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        (num_entries,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if num_entries > self.max_db_entries:
+            evicted += self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (num_entries - self.max_db_entries,),
+            ).rowcount
+        self.metrics["evictions_disk"] += evicted
+
+    @staticmethod
+    def _init_db(db_path: str) -> sqlite3.Connection:
+        if dirname(db_path):
+            makedirs(dirname(db_path), exist_ok=True)
+        # Autocommit; all access is serialized by the cache's lock
+        db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS idx_responses_expires_at ON responses(expires_at)")
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)"
+        )
+        return db
+
+
+class ReplayStream:
+    """
+    Replays a cached answer as a synthetic chat completion stream, so callers can consume a cache
+    hit exactly like a live stream (with `for` or `async for`).
+    """
+
+    finish_reason: str = "stop"
+
+    def __init__(self, content: str, model: str) -> None:
+        self.content = content
+        self.model = model
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+        self._closed = False
+
+    def __iter__(self) -> Iterator[ChatCompletionChunk]:
+        for chunk in self._iter_chunks():
+            if self._closed:
+                return
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        for chunk in self._iter_chunks():
+            if self._closed:
+                return
+            yield chunk
+
+    def close(self) -> None:
+        self._closed = True
+
+    async def aclose(self) -> None:
+        self._closed = True
+
+    def _iter_chunks(self) -> Iterator[ChatCompletionChunk]:
+        completion_id, created = f"chatcmpl-cached-{uuid4().hex}", int(time.time())
+        pieces: List[Optional[str]] = _REPLAY_CHUNK_PATTERN.findall(self.content)
+        for piece, finish_reason in zip(pieces + [None], [None] * len(pieces) + ["stop"]):
+            yield ChatCompletionChunk(
+                id=completion_id,
+                created=created,
+                model=self.model,
+                object="chat.completion.chunk",
+                choices=[
+                    ChunkChoice(
+                        index=0,
+                        delta=ChoiceDelta(
+                            role="assistant" if piece is not None else None, content=piece
+                        ),
+                        finish_reason=finish_reason,
+                    )
+                ],
+            )
+
+
+def build_cached_completion(content: str, model: str) -> ChatCompletion:
+    """Build a (non-streamed) chat completion object from a cached answer."""
+    return ChatCompletion(
+        id=f"chatcmpl-cached-{uuid4().hex}",
+        created=int(time.time()),
+        model=model,
+        object="chat.completion",
+        choices=[
+            Choice(
+                index=0,
+                finish_reason="stop",
+                message=ChatCompletionMessage(role="assistant", content=content),
+            )
+        ],
+    )
+
+
+_RESPONSE_CACHE: ResponseCache = None
+_RESPONSE_CACHE_LOCK = Lock()
+
+
+def get_response_cache(config: Box = None) -> ResponseCache:
+    """Return the process-wide response cache (built from config on first use)."""
+    global _RESPONSE_CACHE
+    if _RESPONSE_CACHE is None:
+        with _RESPONSE_CACHE_LOCK:
+            if _RESPONSE_CACHE is None:
+                _RESPONSE_CACHE = ResponseCache.from_config(config=config)
+    return _RESPONSE_CACHE
@@ -0,0 +1,371 @@
+"""
+Hybrid retrieval over the RAG collection (see rag_ingest.py), for grounding chat answers.
+
+A query is matched both by vector search (chromadb's HNSW index) and by BM25 keyword search over
+an in-memory inverted index, and the two rankings are fused with (weighted) reciprocal rank fusion.
+The retrieved chunks are then packed into a context message under a token budget.
+
+Retrieval sits in front of every RAG answer (so adds to its time to first token), so the query path
+avoids Python loops over the corpus: BM25 postings are kept as flat NumPy arrays (CSR layout) with
+the per-posting term-frequency part of the score precomputed, scores are accumulated with one
+scatter-add per query term, and top-k selection uses argpartition instead of a full sort. Very
+common terms (in more than `bm25_max_df` of chunks) are skipped, as they barely change the ranking
+but have the longest postings. Recent results are cached per (normalized) query.
+
+The BM25 index is rebuilt in the background whenever the ingestor's collection changes; queries
+keep using the previous index (and vector search, which is always up to date) meanwhile.
+"""
+
+import re
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock, Thread
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from box.box import Box
+
+from rag_ingest import DocumentIngestor
+from utils import FALLBACK_ENCODING_NAME, get_encoding_by_name
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+RAG_CONTEXT_PREFIX = (
+    "Answer using the document excerpts below where relevant, and cite their sources. If they do "
+    "not contain the answer, say so.\n\n"
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_PATTERN.findall(text.lower())
+
+
+class RetrievedChunk(NamedTuple):
+    id: str
+    source: str
+    text: str
+    score: float
+    num_tokens: int
+
+
+class BM25Index:
+    """
+    Immutable BM25 index of chunks. Postings of term `t` are `docs[offsets[t]:offsets[t + 1]]`,
+    with the precomputed term-frequency part of their score in `weights`.
+    """
+
+    K1: float = 1.2
+    B: float = 0.75
+    # Terms are only ever skipped for being too common if they are in more chunks than this
+    MIN_SKIPPED_DF: int = 1000
+
+    def __init__(self, ids: List[str], texts: List[str]) -> None:
+        self.ids = ids
+        self.positions: Dict[str, int] = {chunk_id: idx for idx, chunk_id in enumerate(ids)}
+        # Term id of every token of every chunk (the only per-token Python work), then postings
+        # are built by sorting (term, doc) keys. New terms get the next id on first lookup.
+        vocabulary: Dict[str, int] = defaultdict()
+        vocabulary.default_factory = vocabulary.__len__
+        token_term_ids: List[int] = []
+        doc_lengths = np.zeros(len(ids), dtype=np.int64)
+        for idx, text in enumerate(texts):
+            terms = tokenize(text or "")
+            doc_lengths[idx] = len(terms)
+            token_term_ids += map(vocabulary.__getitem__, terms)
+        self.vocabulary = dict(vocabulary)
+        token_docs = np.repeat(np.arange(len(ids), dtype=np.int64), doc_lengths)
+        keys, tfs = np.unique(
+            np.asarray(token_term_ids, dtype=np.int64) * max(len(ids), 1) + token_docs,
+            return_counts=True,
+        )
+        # Sorted by term, then doc
+        term_ids = keys // max(len(ids), 1)
+        self.docs = (keys % max(len(ids), 1)).astype(np.int32)
+        df = np.bincount(term_ids, minlength=len(self.vocabulary))
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(df, out=self.offsets[1:])
+        avg_length = float(doc_lengths.mean()) if len(ids) else 1.0
+        norms = self.K1 * (1 - self.B + self.B * doc_lengths / max(avg_length, 1.0))
+        tfs = tfs.astype(np.float32)
+        self.weights = (tfs * (self.K1 + 1) / (tfs + norms[self.docs])).astype(np.float32)
+        self.df = df
+        self.idf = np.log1p((len(ids) - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int, max_df: float = 1.0) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the positions and scores of the (up to) `k` best chunks, best first."""
+        max_df_count = max(max_df * len(self.ids), self.MIN_SKIPPED_DF)
+        term_ids = {
+            self.vocabulary[term]
+            for term in tokenize(query)
+            if term in self.vocabulary and self.df[self.vocabulary[term]] <= max_df_count
+        }
+        if not term_ids or k <= 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        postings = []
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # A term's postings have distinct docs, so a plain fancy-index add is a scatter-add
+            scores[self.docs[start:end]] += self.idf[term_id] * self.weights[start:end]
+            postings.append(self.docs[start:end])
+        candidates = np.concatenate(postings)
+        # A doc occurs at most once per term, so the top k distinct docs are within the top
+        # k * len(term_ids) candidates
+        num_top = min(len(candidates), k * len(term_ids))
+        candidate_scores = scores[candidates]
+        if num_top < len(candidates):
+            top = np.argpartition(-candidate_scores, num_top - 1)[:num_top]
+            candidates, candidate_scores = candidates[top], candidate_scores[top]
+        positions, first = np.unique(candidates, return_index=True)
+        positions_scores = candidate_scores[first]
+        top = _top_k(positions_scores, k=k)
+        return positions[top], positions_scores[top]
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the `k` highest scores, highest first."""
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class HybridRetriever:
+    """Retrieves chunks of an ingestor's collection by fused BM25 and vector search."""
+
+    # Page size when reading the collection to build the BM25 index
+    BUILD_PAGE_SIZE: int = 10_000
+
+    def __init__(
+        self,
+        ingestor: DocumentIngestor,
+        top_k: int = 5,
+        num_candidates: int = 50,
+        bm25_weight: float = 1.0,
+        vector_weight: float = 1.0,
+        rrf_k: int = 60,
+        bm25_max_df: float = 0.2,
+        cache_size: int = 1024,
+    ) -> None:
+        self.ingestor = ingestor
+        self.collection = ingestor.collection
+        self.top_k = top_k
+        self.num_candidates = num_candidates
+        self.bm25_weight = bm25_weight
+        self.vector_weight = vector_weight
+        self.rrf_k = rrf_k
+        self.bm25_max_df = bm25_max_df
+        self.cache_size = cache_size
+        self.metrics: Dict[str, float] = {
+            "queries": 0,
+            "cache_hits": 0,
+            "index_builds": 0,
+            "index_build_s": 0.0,
+        }
+        self._index: Optional[BM25Index] = None
+        self._index_version = None
+        self._building = False
+        self._lock = Lock()
+        self._cache: "OrderedDict[Tuple, List[RetrievedChunk]]" = OrderedDict()
+        # Collection size as of an ingestor version (counting takes a query of its own)
+        self._count_of_version: Tuple[int, int] = (None, 0)
+
+    @classmethod
+    def from_config(cls, config: Optional[Box], ingestor: DocumentIngestor) -> "HybridRetriever":
+        """Build retriever from the `RAG_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            ingestor=ingestor,
+            top_k=config.get("RAG_TOP_K", 5),
+            num_candidates=config.get("RAG_NUM_CANDIDATES", 50),
+            bm25_weight=config.get("RAG_BM25_WEIGHT", 1.0),
+            vector_weight=config.get("RAG_VECTOR_WEIGHT", 1.0),
+            bm25_max_df=config.get("RAG_BM25_MAX_DF", 0.2),
+            cache_size=config.get("RAG_QUERY_CACHE_SIZE", 1024),
+        )
+
+    def retrieve(self, query: str, top_k: int = None) -> List[RetrievedChunk]:
+        """Return the best chunks for a query, best first."""
+        top_k = top_k if top_k is not None else self.top_k
+        index = self._get_index()
+        # Results depend on the collection (vector search) and on the BM25 index built from it
+        cache_key = (" ".join(tokenize(query)), top_k, self.ingestor.version, id(index))
+        with self._lock:
+            self.metrics["queries"] += 1
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                self.metrics["cache_hits"] += 1
+                return cached
+        num_chunks = self._count()
+        if num_chunks == 0:
+            return []
+
+        # Candidate keys are BM25 index positions; chunks not indexed yet get positions after
+        # the index's, so both rankings can be fused on integer arrays
+        bm25_positions, _ = (
+            index.search(query, k=self.num_candidates, max_df=self.bm25_max_df)
+            if index is not None
+            else (np.empty(0, dtype=np.int32), None)
+        )
+        num_indexed = len(index) if index is not None else 0
+        vector_ids = self.collection.query(
+            query_embeddings=self.ingestor.embedding_function([query]),
+            n_results=min(self.num_candidates, num_chunks),
+            include=[],
+        )["ids"][0]
+        unindexed_ids: List[str] = []
+        vector_positions = np.empty(len(vector_ids), dtype=np.int64)
+        for rank, chunk_id in enumerate(vector_ids):
+            position = index.positions.get(chunk_id) if index is not None else None
+            if position is None:
+                position = num_indexed + len(unindexed_ids)
+                unindexed_ids.append(chunk_id)
+            vector_positions[rank] = position
+
+        # Weighted reciprocal rank fusion
+        positions = np.concatenate([bm25_positions.astype(np.int64), vector_positions])
+        contributions = np.concatenate(
+            [
+                self.bm25_weight / (self.rrf_k + np.arange(1, len(bm25_positions) + 1)),
+                self.vector_weight / (self.rrf_k + np.arange(1, len(vector_positions) + 1)),
+            ]
+        )
+        unique_positions, inverse = np.unique(positions, return_inverse=True)
+        fused = np.bincount(inverse, weights=contributions)
+        top = _top_k(fused, k=top_k)
+        top_ids = [
+            index.ids[position] if position < num_indexed else unindexed_ids[position - num_indexed]
+            for position in unique_positions[top].tolist()
+        ]
+
+        found = self.collection.get(ids=top_ids, include=["documents", "metadatas"])
+        chunks_by_id = dict(zip(found["ids"], zip(found["documents"], found["metadatas"])))
+        results = []
+        for chunk_id, score in zip(top_ids, fused[top].tolist()):
+            if chunk_id not in chunks_by_id:
+                # Deleted since the index was built
+                continue
+            text, metadata = chunks_by_id[chunk_id]
+            num_tokens = metadata.get("num_tokens")
+            if num_tokens is None:
+                num_tokens = len(get_encoding_by_name(FALLBACK_ENCODING_NAME).encode(text))
+            results.append(
+                RetrievedChunk(
+                    id=chunk_id,
+                    source=metadata.get("source", ""),
+                    text=text,
+                    score=score,
+                    num_tokens=num_tokens,
+                )
+            )
+
+        with self._lock:
+            self._cache[cache_key] = results
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return results
+
+    def build_index(self) -> BM25Index:
+        """(Re)build the BM25 index from the collection (blocking)."""
+        version = self.ingestor.version
+        started_at = time.perf_counter()
+        ids, texts = [], []
+        total = self.collection.count()
+        for offset in range(0, total, self.BUILD_PAGE_SIZE):
+            page = self.collection.get(
+                limit=self.BUILD_PAGE_SIZE, offset=offset, include=["documents"]
+            )
+            ids += page["ids"]
+            texts += page["documents"]
+        index = BM25Index(ids=ids, texts=texts)
+        with self._lock:
+            self._index, self._index_version = index, version
+            self.metrics["index_builds"] += 1
+            self.metrics["index_build_s"] += time.perf_counter() - started_at
+        return index
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self.metrics,
+                "indexed_chunks": len(self._index) if self._index is not None else 0,
+                "cached_queries": len(self._cache),
+            }
+
+    def _count(self) -> int:
+        version, count = self._count_of_version
+        if version != self.ingestor.version:
+            version = self.ingestor.version
+            count = self.collection.count()
+            self._count_of_version = (version, count)
+        return count
+
+    def _get_index(self) -> Optional[BM25Index]:
+        """Return the current index, starting a background rebuild if the collection changed."""
+        if self._index is None:
+            # First query: nothing to serve from yet, so build it now
+            with self._lock:
+                first = not self._building
+                self._building = True
+            if first:
+                try:
+                    self.build_index()
+                finally:
+                    self._building = False
+            return self._index
+        if self._index_version != self.ingestor.version:
+            with self._lock:
+                start = not self._building
+                self._building = True
+            if start:
+                Thread(target=self._rebuild_in_background, daemon=True).start()
+        return self._index
+
+    def _rebuild_in_background(self) -> None:
+        try:
+            self.build_index()
+        except Exception as e:
+            print(f"Warning: Could not rebuild the BM25 index ({e}).")
+        finally:
+            self._building = False
+
+
+def pack_context(chunks: List[RetrievedChunk], max_tokens: int) -> Optional[str]:
+    """
+    Return the text of a context message with the best chunks that fit `max_tokens` (in order),
+    or None if none fit.
+    """
+    encoding = get_encoding_by_name(FALLBACK_ENCODING_NAME)
+    budget = max_tokens - len(encoding.encode(RAG_CONTEXT_PREFIX))
+    excerpts = []
+    for chunk in chunks:
+        excerpt = f"[{len(excerpts) + 1}] Source: {chunk.source}\n{chunk.text}"
+        # Chunk plus (about) its header
+        num_tokens = chunk.num_tokens + 8
+        if num_tokens > budget:
+            continue
+        budget -= num_tokens
+        excerpts.append(excerpt)
+    if not excerpts:
+        return None
+    return RAG_CONTEXT_PREFIX + "\n\n".join(excerpts)
+
+
+_RETRIEVER: HybridRetriever = None
+_RETRIEVER_LOCK = Lock()
+
+
+def get_retriever(config: Box = None, ingestor: DocumentIngestor = None) -> HybridRetriever:
+    """Return the process-wide retriever (built from config on first use)."""
+    global _RETRIEVER
+    if _RETRIEVER is None:
+        with _RETRIEVER_LOCK:
+            if _RETRIEVER is None:
+                _RETRIEVER = HybridRetriever.from_config(config=config, ingestor=ingestor)
+    return _RETRIEVER
@@ -0,0 +1,147 @@
+import hashlib
+import time
+from os.path import join
+from threading import Lock
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from box.box import Box
+from openai import OpenAI
+
+from embeddings import get_embedding_function
+from utils import get_root_dir_path
+
+
+class SemanticCacheProbe(NamedTuple):
+    """What a request is looked up (and later stored) under in the semantic cache."""
+
+    fingerprint: str
+    text: str
+    embedding: List[float]
+
+
+class SemanticCache:
+    """
+    Cache of answers for near-duplicate questions, stored in a chromadb collection.
+
+    Requests are embedded on their last user turn, and only match stored answers that were given
+    with the same system prompt and model (the "fingerprint") and whose cosine similarity is at
+    least `similarity_threshold`. By default only first-turn questions are cached, as follow-ups
+    depend on the rest of the conversation.
+    """
+
+    COLLECTION_NAME: str = "semantic_cache"
+
+    def __init__(
+        self,
+        embedding_function: Callable[[List[str]], List[List[float]]],
+        similarity_threshold: float = 0.95,
+        persist_dir: str = None,
+        first_turn_only: bool = True,
+        collection_name: str = COLLECTION_NAME,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        self.first_turn_only = first_turn_only
+        self.metrics: Dict[str, int] = {"hits": 0, "misses": 0, "puts": 0}
+        # Imported here, as it is slow to import and only needed if the cache is on
+        import chromadb
+
+        chroma_client = (
+            chromadb.PersistentClient(path=persist_dir)
+            if persist_dir is not None
+            else chromadb.EphemeralClient()
+        )
+        # Embeddings are always computed here (see `probe`), never by chromadb
+        self.collection = chroma_client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=None,
+            metadata={"hnsw:space": "cosine"},
+        )
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[Box], openai_client_factory: Callable[[], OpenAI] = None
+    ) -> "SemanticCache":
+        """Build cache from the `SEMANTIC_CACHE_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        embedding_function = get_embedding_function(
+            config=config,
+            embedder=config.get("SEMANTIC_CACHE_EMBEDDER", "hashing"),
+            model=config.get("SEMANTIC_CACHE_EMBEDDING_MODEL", "text-embedding-ada-002"),
+            openai_client_factory=openai_client_factory,
+        )
+        persist_dir = config.get("SEMANTIC_CACHE_PERSIST_DIR", None)
+        return cls(
+            embedding_function=embedding_function,
+            similarity_threshold=config.get("SEMANTIC_CACHE_THRESHOLD", 0.95),
+            persist_dir=join(get_root_dir_path(), persist_dir) if persist_dir else None,
+            first_turn_only=config.get("SEMANTIC_CACHE_FIRST_TURN_ONLY", True),
+        )
+
+    def probe(self, messages: List[Dict[str, str]], model: str) -> Optional[SemanticCacheProbe]:
+        """Embed a request's last user turn. Returns None if the request is not cacheable."""
+        if not messages or messages[-1].get("role") != "user":
+            return None
+        if not isinstance(messages[-1].get("content"), str):
+            return None
+        if self.first_turn_only and any(m.get("role") == "assistant" for m in messages):
+            return None
+        system_prompt = "\n".join(
+            m["content"] for m in messages if m.get("role") == "system" and m.get("content")
+        )
+        fingerprint = hashlib.sha256(f"{model}\n{system_prompt}".encode("utf-8")).hexdigest()
+        text = messages[-1]["content"]
+        return SemanticCacheProbe(
+            fingerprint=fingerprint, text=text, embedding=self.embedding_function([text])[0]
+        )
+
+    def lookup(self, probe: SemanticCacheProbe) -> Optional[str]:
+        """Return the stored answer of the nearest similar enough question, or None."""
+        if self.collection.count() == 0:
+            self.metrics["misses"] += 1
+            return None
+        result = self.collection.query(
+            query_embeddings=[probe.embedding],
+            n_results=1,
+            where={"fingerprint": probe.fingerprint},
+            include=["metadatas", "distances"],
+        )
+        if result["ids"][0]:
+            # Cosine distance, so similarity = 1 - distance
+            similarity = 1.0 - result["distances"][0][0]
+            if similarity >= self.similarity_threshold:
+                self.metrics["hits"] += 1
+                return result["metadatas"][0][0]["answer"]
+        self.metrics["misses"] += 1
+        return None
+
+    def store(self, probe: SemanticCacheProbe, answer: str) -> None:
+        """Store the answer to a question."""
+        entry_id = hashlib.sha256(f"{probe.fingerprint}\n{probe.text}".encode("utf-8")).hexdigest()
+        self.collection.upsert(
+            ids=[entry_id],
+            embeddings=[probe.embedding],
+            documents=[probe.text],
+            metadatas=[
+                {"fingerprint": probe.fingerprint, "answer": answer, "created_at": time.time()}
+            ],
+        )
+        self.metrics["puts"] += 1
+
+
+_SEMANTIC_CACHE: SemanticCache = None
+_SEMANTIC_CACHE_LOCK = Lock()
+
+
+def get_semantic_cache(
+    config: Box = None, openai_client_factory: Callable[[], OpenAI] = None
+) -> SemanticCache:
+    """Return the process-wide semantic cache (built from config on first use)."""
+    global _SEMANTIC_CACHE
+    if _SEMANTIC_CACHE is None:
+        with _SEMANTIC_CACHE_LOCK:
+            if _SEMANTIC_CACHE is None:
+                _SEMANTIC_CACHE = SemanticCache.from_config(
+                    config=config, openai_client_factory=openai_client_factory
+                )
+    return _SEMANTIC_CACHE
@@ -0,0 +1,215 @@
+"""
+Session state (conversation and usage counters) kept outside the app process, keyed by session.
+
+The app keeps each session's OAIClient and conversation in `gr.State`, which only lives in the
+process that created it. With a shared session store, any app process (e.g. several behind a load
+balancer, on one or more hosts) can pick up a session: state is loaded by session id the first
+time a process sees the session, and saved after every turn.
+
+Backends (`SESSION_STORE` in the config):
+- "memory": in-process (sessions are not shared between processes). The default, with which the
+  app keeps sessions in `gr.State` only.
+- "sqlite": a SQLite file, shared by the processes of a host (WAL mode, so readers do not block).
+- "redis": a Redis (or Redis-compatible, e.g. Valkey, KeyDB) server, shared across hosts. Requires
+  `redis` (pip install redis).
+"""
+
+import json
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from importlib.util import find_spec
+from os import makedirs
+from os.path import dirname, join
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from box.box import Box
+
+from conversation import Conversation
+from utils import get_root_dir_path
+
+SESSION_STORES = ("memory", "sqlite", "redis")
+# OAIClient attributes saved with a session
+USAGE_COUNTER_FIELDS = ("input_tokens_used", "output_tokens_used", "pricing_cost")
+
+
+class SessionStore(ABC):
+    """Store of session states (JSON serializable dicts), expiring `ttl_s` after their last save."""
+
+    def __init__(self, ttl_s: float = 7 * 24 * 60 * 60) -> None:
+        self.ttl_s = ttl_s
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def put(self, session_id: str, state: Dict) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        ...
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store, keeping up to `max_sessions` (least recently used are dropped first)."""
+
+    def __init__(self, ttl_s: float = 7 * 24 * 60 * 60, max_sessions: int = 10_000) -> None:
+        super().__init__(ttl_s=ttl_s)
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, state = entry
+            if expires_at <= time.time():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+        # Stored serialized, so callers never share (and mutate) the stored state
+        return json.loads(state)
+
+    def put(self, session_id: str, state: Dict) -> None:
+        serialized = json.dumps(state)
+        with self._lock:
+            self._sessions[session_id] = (time.time() + self.ttl_s, serialized)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store in a SQLite file, which every process on the host can open."""
+
+    def __init__(self, db_path: str, ttl_s: float = 7 * 24 * 60 * 60) -> None:
+        super().__init__(ttl_s=ttl_s)
+        self.db_path = db_path
+        if dirname(db_path):
+            makedirs(dirname(db_path), exist_ok=True)
+        # Autocommit (each statement is its own transaction), so no process holds the write lock
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Wait for other processes' writes instead of failing with "database is locked"
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS session_state "
+            "(session TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_state_expires_at ON session_state(expires_at)"
+        )
+        self._lock = Lock()
+        self._num_puts = 0
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM session_state WHERE session = ? AND expires_at > ?",
+                (session_id, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, session_id: str, state: Dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO session_state (session, state, expires_at) "
+                "VALUES (?, ?, ?)",
+                (session_id, json.dumps(state), now + self.ttl_s),
+            )
+            self._num_puts += 1
+            # Expired sessions are cleaned up now and then, rather than on every save
+            if self._num_puts % 1000 == 0:
+                self._db.execute("DELETE FROM session_state WHERE expires_at <= ?", (now,))
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM session_state WHERE session = ?", (session_id,))
+
+
+class RedisSessionStore(SessionStore):
+    """Store in a Redis (compatible) server, shared across hosts."""
+
+    KEY_PREFIX: str = "chatbot:session:"
+
+    def __init__(
+        self, url: str = "redis://localhost:6379/0", ttl_s: float = 7 * 24 * 60 * 60
+    ) -> None:
+        super().__init__(ttl_s=ttl_s)
+        if find_spec("redis") is None:
+            raise ValueError("The redis session store requires `redis` (pip install redis).")
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        state = self._redis.get(self.KEY_PREFIX + session_id)
+        return json.loads(state) if state is not None else None
+
+    def put(self, session_id: str, state: Dict) -> None:
+        self._redis.set(self.KEY_PREFIX + session_id, json.dumps(state), ex=int(self.ttl_s))
+
+    def delete(self, session_id: str) -> None:
+        self._redis.delete(self.KEY_PREFIX + session_id)
+
+
+def build_session_store(config: Box = None) -> SessionStore:
+    """Build the session store selected by the `SESSION_STORE*` keys of a config file (if any)."""
+    config = config if config is not None else Box()
+    backend = config.get("SESSION_STORE", "memory")
+    ttl_s = config.get("SESSION_STORE_TTL_S", 7 * 24 * 60 * 60)
+    if backend == "memory":
+        return MemorySessionStore(ttl_s=ttl_s)
+    if backend == "sqlite":
+        db_path = config.get("SESSION_STORE_DB_PATH", ".local/sessions.sqlite3")
+        return SQLiteSessionStore(db_path=join(get_root_dir_path(), db_path), ttl_s=ttl_s)
+    if backend == "redis":
+        return RedisSessionStore(
+            url=config.get("SESSION_STORE_REDIS_URL", "redis://localhost:6379/0"), ttl_s=ttl_s
+        )
+    raise ValueError(f"Unknown session store: {backend}. Expected one of {SESSION_STORES}")
+
+
+def snapshot_session(oai_client, conversation: Conversation) -> Dict:
+    """Return the state of a session to save: its conversation and its client's counters."""
+    return {
+        "conversation": conversation.to_state(),
+        "usage": {field: getattr(oai_client, field) for field in USAGE_COUNTER_FIELDS},
+        "saved_at": time.time(),
+    }
+
+
+def restore_session(oai_client, state: Dict) -> Optional[Conversation]:
+    """Restore a client's usage counters from a saved state. Returns the saved conversation."""
+    for field, value in state.get("usage", dict()).items():
+        if field in USAGE_COUNTER_FIELDS:
+            setattr(oai_client, field, value)
+    if "conversation" in state:
+        return Conversation.from_state(state["conversation"])
+    return None
+
+
+_SESSION_STORE: SessionStore = None
+_SESSION_STORE_LOCK = Lock()
+
+
+def get_session_store(config: Box = None) -> SessionStore:
+    """Return the process-wide session store (built from config on first use)."""
+    global _SESSION_STORE
+    if _SESSION_STORE is None:
+        with _SESSION_STORE_LOCK:
+            if _SESSION_STORE is None:
+                _SESSION_STORE = build_session_store(config=config)
+    return _SESSION_STORE
@@ -0,0 +1,226 @@
+"""
+Text-to-speech of streamed responses, sentence by sentence.
+
+Synthesizing a response only once it is complete means the user waits for the whole text, then for
+the whole audio. Instead, SpeechPipeline is fed the response's text deltas as they stream in, cuts
+them at sentence boundaries (see SentenceSplitter), and sends each sentence to the speech API as
+soon as it is complete. Sentences are synthesized concurrently (up to `max_concurrency` calls at a
+time, through the shared rate limiter) but their audio is handed out in order, so the first
+sentence can play while the next ones (and the rest of the text) are still being generated.
+
+Usage:
+
+    speech = SpeechPipeline.from_config(config, oai_client=oai_client)
+    async for chunk in stream:
+        speech.feed(chunk.choices[0].delta.content or "")
+        audio = speech.pop_ready()  # Audio of the sentences synthesized so far (in order), if any
+    async for audio in speech.remaining():  # Flushes the last sentence, waits for the rest
+        ...
+"""
+
+import asyncio
+import re
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from box.box import Box
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from api_client import AsyncOAIClient
+from metrics import get_metrics
+from rate_limiter import backoff_s
+
+TTS_VOICES = ("alloy", "echo", "fable", "onyx", "nova", "shimmer")
+TTS_RESPONSE_FORMATS = ("mp3", "opus", "aac", "flac")
+# Cost (USD) per 1000 characters synthesized, by model
+TTS_PRICES: Dict[str, float] = {"tts-1": 0.015, "tts-1-hd": 0.030}
+
+# End of a sentence: terminal punctuation (and closing quotes/brackets) followed by whitespace, or a
+# line break (paragraphs, list items)
+_SENTENCE_END = re.compile(r"[.!?;:…。！？]+[\"'”’)\]]*\s+|\n+")
+# Markdown markup, which would otherwise be read aloud
+_MARKDOWN_LINK = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+_MARKDOWN_MARKUP = re.compile(r"[*_`#>|~]+")
+
+
+def clean_text_for_speech(text: str) -> str:
+    """Strip markdown markup (emphasis, headings, code ticks, links' URLs) from text."""
+    text = _MARKDOWN_LINK.sub(r"\1", text)
+    return " ".join(_MARKDOWN_MARKUP.sub(" ", text).split())
+
+
+class SentenceSplitter:
+    """Cuts a stream of text deltas into sentences."""
+
+    def __init__(self, min_chars: int = 12, max_chars: int = 300) -> None:
+        # Shorter sentences are joined with the next one (fewer, more natural sounding calls),
+        # and longer ones are cut at a space (so a run-on sentence does not delay the audio)
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def push(self, text: str) -> List[str]:
+        """Add a text delta, returning the sentences it completed (if any)."""
+        self._buffer += text
+        sentences, start = [], 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            if match.end() - start >= self.min_chars:
+                sentences.append(self._buffer[start : match.end()])
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        while len(self._buffer) > self.max_chars:
+            cut = self._buffer.rfind(" ", 0, self.max_chars) + 1 or self.max_chars
+            sentences.append(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+        return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+    def flush(self) -> List[str]:
+        """Return the remaining text (the end of the last sentence), if any."""
+        text, self._buffer = self._buffer.strip(), ""
+        return [text] if text else []
+
+
+class SpeechPipeline:
+    """Synthesizes the sentences of a streamed text concurrently, handing out audio in order."""
+
+    def __init__(
+        self,
+        oai_client: AsyncOAIClient,
+        model: str = "tts-1",
+        voice: str = "alloy",
+        response_format: str = "mp3",
+        max_concurrency: int = 3,
+        min_sentence_chars: int = 12,
+    ) -> None:
+        if voice not in TTS_VOICES:
+            raise ValueError(f"Unknown voice: {voice}. Expected one of {TTS_VOICES}")
+        if response_format not in TTS_RESPONSE_FORMATS:
+            raise ValueError(
+                f"Unknown response format: {response_format}. "
+                f"Expected one of {TTS_RESPONSE_FORMATS}"
+            )
+        self.oai_client = oai_client
+        self.model = model
+        self.voice = voice
+        self.response_format = response_format
+        self.metrics: Dict[str, float] = {"sentences": 0, "chars": 0, "errors": 0, "cost": 0.0}
+        # Time from the first text fed to the first audio ready
+        self.first_audio_s: Optional[float] = None
+        self._splitter = SentenceSplitter(min_chars=min_sentence_chars)
+        # Synthesis of each sentence, in the order of the text. asyncio.Semaphore wakes waiters
+        # in order, so earlier sentences are also sent first.
+        self._tasks: Deque["asyncio.Task[Optional[bytes]]"] = deque()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._started_at: Optional[float] = None
+
+    @classmethod
+    def from_config(cls, config: Optional[Box], oai_client: AsyncOAIClient) -> "SpeechPipeline":
+        """Build pipeline from the `TTS_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            oai_client=oai_client,
+            model=config.get("TTS_MODEL", "tts-1"),
+            voice=config.get("TTS_VOICE", "alloy"),
+            response_format=config.get("TTS_RESPONSE_FORMAT", "mp3"),
+            max_concurrency=config.get("TTS_MAX_CONCURRENCY", 3),
+            min_sentence_chars=config.get("TTS_MIN_SENTENCE_CHARS", 12),
+        )
+
+    def feed(self, text: str) -> None:
+        """Add a text delta, starting the synthesis of the sentences it completes."""
+        if self._started_at is None:
+            self._started_at = time.perf_counter()
+        for sentence in self._splitter.push(text):
+            self._start(sentence)
+
+    def pop_ready(self) -> Optional[bytes]:
+        """Return the audio of the next sentences that are synthesized (in order), if any."""
+        chunks = []
+        while self._tasks and self._tasks[0].done():
+            audio = self._result(self._tasks.popleft())
+            if audio:
+                chunks.append(audio)
+        return b"".join(chunks) or None
+
+    async def remaining(self) -> AsyncIterator[bytes]:
+        """Synthesize the end of the text, and yield the audio of each sentence left, in order."""
+        for sentence in self._splitter.flush():
+            self._start(sentence)
+        try:
+            while self._tasks:
+                await asyncio.wait([self._tasks[0]])
+                audio = self.pop_ready()
+                if audio:
+                    yield audio
+        finally:
+            # e.g. the response was stopped: sentences not played yet are not synthesized either
+            self.cancel()
+
+    def cancel(self) -> None:
+        """Cancel the synthesis of all sentences not handed out yet."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    def _start(self, sentence: str) -> None:
+        text = clean_text_for_speech(sentence)
+        if text:
+            self._tasks.append(asyncio.ensure_future(self._synthesize(text)))
+
+    def _result(self, task: "asyncio.Task[Optional[bytes]]") -> Optional[bytes]:
+        if task.cancelled():
+            return None
+        if task.exception() is not None:
+            # Speech is best effort: a failed sentence is skipped, the text is still shown
+            e = task.exception()
+            print(f"Warning: Speech synthesis failed ({type(e).__name__}: {e}).")
+            return None
+        return task.result()
+
+    async def _synthesize(self, text: str) -> bytes:
+        async with self._semaphore:
+            try:
+                with get_metrics().span("tts", model=self.model):
+                    audio = await self._create_speech(text)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.metrics["errors"] += 1
+                get_metrics().inc("tts_sentences", model=self.model, outcome="error")
+                raise
+        if self.first_audio_s is None:
+            self.first_audio_s = time.perf_counter() - self._started_at
+        cost = TTS_PRICES.get(self.model, 0.0) * len(text) / 1000
+        self.metrics["sentences"] += 1
+        self.metrics["chars"] += len(text)
+        self.metrics["cost"] += cost
+        get_metrics().inc("tts_sentences", model=self.model, outcome="ok")
+        get_metrics().inc("tts_cost_usd", value=cost, model=self.model)
+        return audio
+
+    async def _create_speech(self, text: str) -> bytes:
+        """Call the API once the rate limiter allows, retrying 429s and transient errors."""
+        rate_limiter = self.oai_client.get_rate_limiter(model=self.model)
+        # The client's own retries are off, as retries go through the shared rate limiter
+        client = self.oai_client.client.with_options(max_retries=0)
+        for attempt in range(self.oai_client.RATE_LIMIT_MAX_RETRIES + 1):
+            get_metrics().observe("rate_limit_wait", await rate_limiter.aacquire(lane="speech"))
+            try:
+                raw_response = await client.audio.speech.with_raw_response.create(
+                    model=self.model,
+                    voice=self.voice,
+                    input=text,
+                    response_format=self.response_format,
+                )
+            except RateLimitError as e:
+                rate_limiter.penalize(headers=e.response.headers)
+                if attempt == self.oai_client.RATE_LIMIT_MAX_RETRIES:
+                    raise
+            except (APIConnectionError, InternalServerError):
+                if attempt == self.oai_client.RATE_LIMIT_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(backoff_s(attempt=attempt))
+            else:
+                rate_limiter.update_from_headers(headers=raw_response.headers)
+                return raw_response.parse().content
@@ -0,0 +1,46 @@
+from time import monotonic
+
+
+class CoalescingEmitter:
+    """
+    Decides when the UI is due a refresh while text streams in (the text itself is buffered
+    elsewhere, e.g. in a conversation.Turn).
+
+    A flush is due once `flush_interval_s` has passed since the last one, or `flush_chars` new
+    characters were counted, whichever comes first.
+    """
+
+    def __init__(self, flush_interval_s: float = 0.05, flush_chars: int = 64) -> None:
+        self.flush_interval_s = flush_interval_s
+        self.flush_chars = flush_chars
+        self._num_pending_chars = 0
+        self._last_flush_at = monotonic()
+
+    def count(self, num_chars: int) -> bool:
+        """Count a streamed chunk of `num_chars` characters. Returns whether a flush is due."""
+        self._num_pending_chars += num_chars
+        return (
+            self._num_pending_chars >= self.flush_chars
+            or monotonic() - self._last_flush_at >= self.flush_interval_s
+        )
+
+    def mark_flushed(self) -> None:
+        """Reset the flush cadence (once the counted text was shown)."""
+        self._num_pending_chars = 0
+        self._last_flush_at = monotonic()
+
+
+class Ticker:
+    """Rate limits a periodic action (e.g. refreshing a table) to once every `interval_s`."""
+
+    def __init__(self, interval_s: float = 1.0) -> None:
+        self.interval_s = interval_s
+        self._last_tick_at = None
+
+    def due(self) -> bool:
+        """Return whether the action is due, and if so start the next interval."""
+        now = monotonic()
+        if self._last_tick_at is None or now - self._last_tick_at >= self.interval_s:
+            self._last_tick_at = now
+            return True
+        return False
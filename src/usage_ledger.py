@@ -0,0 +1,325 @@
+import time
+from threading import Lock
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+from box.box import Box
+
+
+class PriceTable:
+    """
+    Cost of model calls (per 1000 tokens) as (input, output) costs.
+
+    Prices can be overridden/extended from the config file under a `PRICING` key, e.g.:
+
+        PRICING:
+          gpt-3.5-turbo-1106: [0.0010, 0.0020]
+          DEFAULT: [0.0010, 0.0020]  # Used for any model not listed
+
+    Models pricing: https://openai.com/pricing
+    """
+
+    DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+        "gpt-3.5-turbo-1106": (0.0010, 0.0020),
+        "gpt-3.5-turbo-0613": (0.0015, 0.0020),
+        "gpt-3.5-turbo-16k-0613": (0.0030, 0.0040),
+    }
+    DEFAULT_KEY: str = "DEFAULT"
+
+    def __init__(
+        self,
+        prices: Mapping[str, Tuple[float, float]] = None,
+        default_price: Tuple[float, float] = (0.0, 0.0),
+    ) -> None:
+        self.prices = dict(self.DEFAULT_PRICES)
+        if prices is not None:
+            self.prices.update({model: tuple(price) for model, price in prices.items()})
+        self.default_price = tuple(self.prices.pop(self.DEFAULT_KEY, default_price))
+        self._warned_models = set()
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "PriceTable":
+        """Build price table from the `PRICING` section of a config file (if any)."""
+        prices = config.get("PRICING") if config is not None else None
+        return cls(prices=prices)
+
+    def get(self, model: str) -> Tuple[float, float]:
+        """Return (input, output) cost per 1000 tokens for a model."""
+        price = self.prices.get(model)
+        if price is None:
+            if model not in self._warned_models:
+                print(f"Warning: no pricing for model {model}. Using {self.default_price}.")
+                self._warned_models.add(model)
+            price = self.default_price
+        return price
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        """Return cost of a single call."""
+        input_token_cost, output_token_cost = self.get(model)
+        return input_token_cost * (input_tokens / 1000) + output_token_cost * (output_tokens / 1000)
+
+    def price_arrays(self, models: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (input, output) cost per 1000 tokens arrays, indexed like `models`."""
+        prices = np.array([self.get(model) for model in models], dtype=np.float64).reshape(-1, 2)
+        return prices[:, 0], prices[:, 1]
+
+
+class UsageTotals:
+    __slots__ = ("num_calls", "input_tokens", "output_tokens", "cost")
+
+    def __init__(self) -> None:
+        self.num_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+
+    def add(self, input_tokens: int, output_tokens: int, cost: float) -> None:
+        self.num_calls += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cost += cost
+
+    def to_dict(self) -> Dict[str, float]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class UsageLedger:
+    """
+    Ledger of model calls, one row per call.
+
+    Rows are stored column-wise in preallocated numpy arrays (grown by doubling), with model and
+    session names interned to integer ids. Running totals per session and per model are updated on
+    every `record`, so reading them is O(1); grouped/windowed aggregations are vectorized over the
+    columns.
+
+    The ledger keeps at most `max_rows` rows: once full, its oldest half is dropped (so
+    aggregations only cover the calls kept), and sessions without calls left are forgotten, their
+    totals included. Overall and per-model totals still cover every call.
+    """
+
+    COLUMNS: Tuple[str, ...] = (
+        "timestamp",
+        "session",
+        "model",
+        "input_tokens",
+        "output_tokens",
+        "latency_s",
+        "cost",
+    )
+    # Attributes holding the columns above
+    _COLUMN_ATTRS: Tuple[str, ...] = (
+        "_timestamp",
+        "_session_id",
+        "_model_id",
+        "_input_tokens",
+        "_output_tokens",
+        "_latency_s",
+        "_cost",
+    )
+
+    def __init__(self, initial_capacity: int = 1024, max_rows: int = 500_000) -> None:
+        self.max_rows = max_rows
+        initial_capacity = max(1, min(initial_capacity, max_rows))
+        self._lock = Lock()
+        self._size = 0
+        self._timestamp = np.empty(initial_capacity, dtype=np.float64)
+        self._session_id = np.empty(initial_capacity, dtype=np.int32)
+        self._model_id = np.empty(initial_capacity, dtype=np.int32)
+        self._input_tokens = np.empty(initial_capacity, dtype=np.int64)
+        self._output_tokens = np.empty(initial_capacity, dtype=np.int64)
+        self._latency_s = np.empty(initial_capacity, dtype=np.float32)
+        self._cost = np.empty(initial_capacity, dtype=np.float64)
+        self._session_ids: Dict[str, int] = dict()
+        self._sessions: List[str] = []
+        self._model_ids: Dict[str, int] = dict()
+        self._models: List[str] = []
+        self._totals = UsageTotals()
+        self._totals_by_session: List[UsageTotals] = []
+        self._totals_by_model: List[UsageTotals] = []
+
+    @classmethod
+    def from_config(cls, config: Optional[Box]) -> "UsageLedger":
+        """Build ledger from the `USAGE_LEDGER_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(max_rows=config.get("USAGE_LEDGER_MAX_ROWS", 500_000))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def record(
+        self,
+        model: str,
+        input_tokens: int,
+        output_tokens: int,
+        cost: float,
+        latency_s: float = 0.0,
+        session: str = "default",
+    ) -> None:
+        """Append a call to the ledger."""
+        with self._lock:
+            if self._size == self.max_rows:
+                self._drop_oldest(num_rows=self._size - self.max_rows // 2)
+            if self._size == len(self._timestamp):
+                self._grow()
+            idx = self._size
+            # Timestamps are kept monotonic so time windows can be found by binary search
+            now = time.time()
+            self._timestamp[idx] = max(now, self._timestamp[idx - 1]) if idx else now
+            self._session_id[idx] = self._intern(session, self._session_ids, self._sessions)
+            self._model_id[idx] = self._intern(model, self._model_ids, self._models)
+            self._input_tokens[idx] = input_tokens
+            self._output_tokens[idx] = output_tokens
+            self._latency_s[idx] = latency_s
+            self._cost[idx] = cost
+            self._size += 1
+
+            if len(self._totals_by_session) < len(self._sessions):
+                self._totals_by_session.append(UsageTotals())
+            if len(self._totals_by_model) < len(self._models):
+                self._totals_by_model.append(UsageTotals())
+            for totals in (
+                self._totals,
+                self._totals_by_session[self._session_id[idx]],
+                self._totals_by_model[self._model_id[idx]],
+            ):
+                totals.add(input_tokens=input_tokens, output_tokens=output_tokens, cost=cost)
+
+    def totals(self, session: str = None, model: str = None) -> UsageTotals:
+        """Return running totals (overall, or for a session/model) in O(1)."""
+        if session is not None and model is not None:
+            raise ValueError("At most one of session or model can be specified.")
+        with self._lock:
+            if session is not None:
+                idx = self._session_ids.get(session)
+                return self._totals_by_session[idx] if idx is not None else UsageTotals()
+            if model is not None:
+                idx = self._model_ids.get(model)
+                return self._totals_by_model[idx] if idx is not None else UsageTotals()
+            return self._totals
+
+    def aggregate(
+        self,
+        by: str = "model",
+        start: float = None,
+        end: float = None,
+        price_table: PriceTable = None,
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        Aggregate calls by "model" or "session", optionally within a [start, end) time window
+        (unix timestamps). If a price table is given, costs are recomputed with its prices instead
+        of the prices recorded at call time.
+        """
+        if by not in ("model", "session"):
+            raise ValueError(f"Cannot aggregate by {by}. Expected 'model' or 'session'.")
+        # Rows and names are read together, as dropping rows renumbers the sessions
+        with self._lock:
+            columns = self._columns_in_window(start=start, end=end)
+            names = self._models if by == "model" else self._sessions
+            group_ids = columns["model"] if by == "model" else columns["session"]
+            num_groups = len(names)
+
+            if price_table is not None:
+                input_prices, output_prices = price_table.price_arrays(self._models)
+                cost = (
+                    input_prices[columns["model"]] * columns["input_tokens"]
+                    + output_prices[columns["model"]] * columns["output_tokens"]
+                ) / 1000
+            else:
+                cost = columns["cost"]
+
+            num_calls = np.bincount(group_ids, minlength=num_groups)
+            sums = {
+                "input_tokens": np.bincount(
+                    group_ids, weights=columns["input_tokens"], minlength=num_groups
+                ),
+                "output_tokens": np.bincount(
+                    group_ids, weights=columns["output_tokens"], minlength=num_groups
+                ),
+                "latency_s": np.bincount(
+                    group_ids, weights=columns["latency_s"], minlength=num_groups
+                ),
+                "cost": np.bincount(group_ids, weights=cost, minlength=num_groups),
+            }
+            return {
+                names[idx]: {
+                    "num_calls": int(num_calls[idx]),
+                    "input_tokens": int(sums["input_tokens"][idx]),
+                    "output_tokens": int(sums["output_tokens"][idx]),
+                    "mean_latency_s": float(sums["latency_s"][idx] / num_calls[idx]),
+                    "cost": float(sums["cost"][idx]),
+                }
+                for idx in np.flatnonzero(num_calls)
+            }
+
+    def to_dataframe(self, start: float = None, end: float = None):
+        """Return ledger rows (optionally within a time window) as a pandas DataFrame."""
+        from pandas import DataFrame
+
+        with self._lock:
+            columns = self._columns_in_window(start=start, end=end)
+            columns["session"] = np.array(self._sessions, dtype=object)[columns["session"]]
+            columns["model"] = np.array(self._models, dtype=object)[columns["model"]]
+        return DataFrame({column: columns[column] for column in self.COLUMNS})
+
+    def _columns_in_window(self, start: float = None, end: float = None) -> Dict[str, np.ndarray]:
+        """Return copies of the rows within a time window (called with the lock held)."""
+        size = self._size
+        timestamp = self._timestamp[:size]
+        lo = 0 if start is None else int(np.searchsorted(timestamp, start, side="left"))
+        hi = size if end is None else int(np.searchsorted(timestamp, end, side="left"))
+        return {
+            "timestamp": timestamp[lo:hi].copy(),
+            "session": self._session_id[lo:hi].copy(),
+            "model": self._model_id[lo:hi].copy(),
+            "input_tokens": self._input_tokens[lo:hi].copy(),
+            "output_tokens": self._output_tokens[lo:hi].copy(),
+            "latency_s": self._latency_s[lo:hi].copy(),
+            "cost": self._cost[lo:hi].copy(),
+        }
+
+    def _grow(self) -> None:
+        capacity = min(2 * len(self._timestamp), self.max_rows)
+        for name in self._COLUMN_ATTRS:
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            setattr(self, name, grown)
+
+    def _drop_oldest(self, num_rows: int) -> None:
+        """Drop the oldest rows, and the sessions that have no rows left (with the lock held)."""
+        size = self._size - num_rows
+        for name in self._COLUMN_ATTRS:
+            column = getattr(self, name)
+            column[:size] = column[num_rows : self._size]
+        self._size = size
+
+        kept_ids = np.unique(self._session_id[:size])
+        new_ids = np.full(len(self._sessions), -1, dtype=np.int32)
+        new_ids[kept_ids] = np.arange(len(kept_ids), dtype=np.int32)
+        self._session_id[:size] = new_ids[self._session_id[:size]]
+        self._sessions = [self._sessions[idx] for idx in kept_ids]
+        self._session_ids = {session: idx for idx, session in enumerate(self._sessions)}
+        self._totals_by_session = [self._totals_by_session[idx] for idx in kept_ids]
+
+    @staticmethod
+    def _intern(name: str, ids: Dict[str, int], names: List[str]) -> int:
+        idx = ids.get(name)
+        if idx is None:
+            idx = len(names)
+            ids[name] = idx
+            names.append(name)
+        return idx
+
+
+_USAGE_LEDGER: UsageLedger = None
+_USAGE_LEDGER_LOCK = Lock()
+
+
+def get_usage_ledger(config: Box = None) -> UsageLedger:
+    """Return the process-wide usage ledger (built from config on first use)."""
+    global _USAGE_LEDGER
+    if _USAGE_LEDGER is None:
+        with _USAGE_LEDGER_LOCK:
+            if _USAGE_LEDGER is None:
+                _USAGE_LEDGER = UsageLedger.from_config(config=config)
+    return _USAGE_LEDGER
@@ -1,10 +1,49 @@
+from base64 import b64decode
+from functools import lru_cache
+from io import BytesIO
+from os import environ
 from os.path import exists, join
 from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 
 import yaml
 from box import Box
 from box.box import Box
-from tiktoken import encoding_for_model, get_encoding
+from dotenv import load_dotenv
+from tiktoken import Encoding, get_encoding
+
+try:
+    from tiktoken.model import encoding_name_for_model
+except ImportError:  # tiktoken < 0.6
+    from tiktoken.model import MODEL_PREFIX_TO_ENCODING, MODEL_TO_ENCODING
+
+    def encoding_name_for_model(model_name: str) -> str:
+        """Returns the name of the encoding used by a model (KeyError if not recognised)."""
+        if model_name in MODEL_TO_ENCODING:
+            return MODEL_TO_ENCODING[model_name]
+        for model_prefix, encoding_name in MODEL_PREFIX_TO_ENCODING.items():
+            if model_name.startswith(model_prefix):
+                return encoding_name
+        raise KeyError(model_name)
+
+
+FALLBACK_ENCODING_NAME = "cl100k_base"
+
+# Image inputs of vision models (see https://platform.openai.com/docs/guides/vision): a "low" detail
+# image is seen at up to 512x512, a "high" detail one is scaled to fit 2048x2048, then down to 768px
+# on its shortest side, and costs 85 tokens plus 170 per 512px tile
+IMAGE_DETAILS = ("low", "high", "auto")
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+# Estimate for images whose size is unknown (e.g. given by URL): a 1024x1024 image, high detail
+IMAGE_DEFAULT_TOKENS = IMAGE_BASE_TOKENS + 4 * IMAGE_TILE_TOKENS
+
+# Process-wide tokenizer registry. tiktoken encodings are immutable and safe to share between
+# threads once built, so each one is only loaded (and its BPE ranks parsed) a single time.
+_ENCODINGS_BY_NAME: Dict[str, Encoding] = {}
+_ENCODING_NAMES_BY_MODEL: Dict[str, str] = {}
+_ENCODINGS_LOCK = Lock()
 
 
 def detect_is_work_device() -> bool:
@@ -37,6 +76,55 @@ def read_yaml(input_path: str) -> Box:
             return None
 
 
+@lru_cache(maxsize=None)
+def read_yaml_cached(input_path: str) -> Box:
+    """Read YAML file from input path once per process (the returned Box is shared)."""
+    return read_yaml(input_path=input_path)
+
+
+@lru_cache(maxsize=None)
+def load_dotenv_once() -> bool:
+    """Load .env file into the environment once per process."""
+    return load_dotenv()
+
+
+def set_tiktoken_cache_dir(cache_dir: str) -> None:
+    """
+    Have tiktoken read (and save) its BPE tables in a local directory, so they are only downloaded
+    if missing there. The TIKTOKEN_CACHE_DIR environment variable, if set, takes precedence.
+    """
+    environ.setdefault("TIKTOKEN_CACHE_DIR", str(cache_dir))
+
+
+def get_encoding_by_name(encoding_name: str) -> Encoding:
+    """Returns the shared tiktoken encoding with the given name, loading it on first use."""
+    encoding = _ENCODINGS_BY_NAME.get(encoding_name)
+    if encoding is None:
+        with _ENCODINGS_LOCK:
+            encoding = _ENCODINGS_BY_NAME.get(encoding_name)
+            if encoding is None:
+                encoding = get_encoding(encoding_name)
+                _ENCODINGS_BY_NAME[encoding_name] = encoding
+    return encoding
+
+
+def get_encoding_for_model(model: str) -> Encoding:
+    """
+    Returns the shared tiktoken encoding for a model.
+    Unknown models (e.g. Azure deployment names) fall back to the cl100k_base encoding.
+    """
+    encoding_name = _ENCODING_NAMES_BY_MODEL.get(model)
+    if encoding_name is None:
+        try:
+            # Only the name: the encoding itself is loaded (once) by get_encoding_by_name
+            encoding_name = encoding_name_for_model(model)
+        except KeyError:
+            print(f"Warning: model {model} not found. Using {FALLBACK_ENCODING_NAME} encoding.")
+            encoding_name = FALLBACK_ENCODING_NAME
+        _ENCODING_NAMES_BY_MODEL[model] = encoding_name
+    return get_encoding_by_name(encoding_name)
+
+
 def num_tokens_from_string(
     string: str, model: str = None, encoding_name: str = None
 ) -> int:
@@ -44,23 +132,18 @@ def num_tokens_from_string(
     if sum([model is None, encoding_name is None]) != 1:
         raise ValueError("Exactly one of model or encoding_name must be specified.")
     if model is not None:
-        encoding = encoding_for_model(model)
+        encoding = get_encoding_for_model(model)
     else:
-        encoding = get_encoding(encoding_name)
+        encoding = get_encoding_by_name(encoding_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
+def get_message_token_overheads(model: str) -> Tuple[int, int]:
     """
-    Return the number of tokens used by a list of messages.
+    Return (tokens_per_message, tokens_per_name) for a model.
     Taken from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     """
-    try:
-        encoding = encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = get_encoding("cl100k_base")
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -69,27 +152,28 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
         "gpt-4-0613",
         "gpt-4-32k-0613",
     }:
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return 3, 1
     elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = (
-            4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        )
-        tokens_per_name = -1  # if there's a name, the role is omitted
+        # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        # if there's a name, the role is omitted
+        return 4, -1
     elif "gpt-3.5-turbo" in model:
-        print(
-            "Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613."
-        )
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        return get_message_token_overheads(model="gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
-        print(
-            "Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613."
-        )
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return get_message_token_overheads(model="gpt-4-0613")
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
+
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
+    """
+    Return the number of tokens used by a list of messages.
+    Taken from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    """
+    encoding = get_encoding_for_model(model)
+    tokens_per_message, tokens_per_name = get_message_token_overheads(model=model)
     num_tokens = 0
     for message in messages:
         num_tokens += tokens_per_message
@@ -99,3 +183,133 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
                 num_tokens += tokens_per_name
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
+
+
+def fit_image_size(width: int, height: int, detail: str = "high") -> Tuple[int, int]:
+    """Return the size a vision model sees an image at, for a detail level ("auto" as "high")."""
+    max_side, max_short_side = (512, 512) if detail == "low" else (2048, 768)
+    scale = min(1.0, max_side / max(width, height))
+    scale *= min(1.0, max_short_side / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Return the input tokens of an image of a given size at a detail level ("auto" as "high")."""
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+    width, height = fit_image_size(width=width, height=height, detail=detail)
+    num_tiles = -(-width // 512) * -(-height // 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * num_tiles
+
+
+def get_data_url_image_size(url: str) -> Optional[Tuple[int, int]]:
+    """Return the size of a (base64 data URL) image from its header, or None if unknown."""
+    if not url.startswith("data:image/"):
+        return None
+    try:
+        from PIL import Image
+
+        # The size is in the first bytes of the encoded image, so only those are decoded
+        encoded = url[url.index(",") + 1 :][:65536]
+        with Image.open(BytesIO(b64decode(encoded[: len(encoded) // 4 * 4]))) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+def estimate_image_part_tokens(image_url: Dict) -> int:
+    """Return the input tokens of the `image_url` of an image content part of a message."""
+    detail = image_url.get("detail", "auto")
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+    size = get_data_url_image_size(image_url.get("url", ""))
+    if size is None:
+        return IMAGE_DEFAULT_TOKENS
+    return estimate_image_tokens(width=size[0], height=size[1], detail=detail)
+
+
+def _content_part_key(part: Dict) -> Tuple:
+    if part.get("type") == "image_url":
+        return ("image_url", part["image_url"].get("url"), part["image_url"].get("detail"))
+    return (part.get("type"), part.get("text"))
+
+
+class TokenLedger:
+    """
+    Per-conversation token counter.
+
+    Caches the token count of every message it has seen, keyed on the message content (role, name
+    and text), so re-counting a growing conversation only tokenizes messages that are new or have
+    changed since the last count.
+    """
+
+    # Chat models whose per-message overheads are unknown (e.g. Azure deployment names) are
+    # counted using gpt-3.5-turbo-0613's overheads.
+    FALLBACK_MODEL: str = "gpt-3.5-turbo-0613"
+
+    def __init__(self, model: str, max_cached_messages: int = 4096) -> None:
+        self.model = model
+        self.max_cached_messages = max_cached_messages
+        self._encoding = get_encoding_for_model(model)
+        try:
+            self._tokens_per_message, self._tokens_per_name = get_message_token_overheads(model)
+        except NotImplementedError:
+            self._tokens_per_message, self._tokens_per_name = get_message_token_overheads(
+                self.FALLBACK_MODEL
+            )
+        self._message_tokens: Dict[Tuple[Tuple[str, str], ...], int] = {}
+
+    def count_string(self, string: str) -> int:
+        """Return the number of tokens in a text string (not cached)."""
+        return len(self._encoding.encode(string))
+
+    def count_message(self, message: Dict[str, str], cache: bool = True) -> int:
+        """
+        Return the number of tokens used by a single message, including its overheads.
+        Content may also be a list of parts (text and images, whose tokens are estimated).
+        With `cache=False`, the count is neither looked up nor kept (e.g. for messages that cache
+        their own count, see conversation.Turn).
+        """
+        key = (
+            tuple(
+                (field, tuple(_content_part_key(part) for part in value))
+                if isinstance(value, list)
+                else (field, value)
+                for field, value in message.items()
+            )
+            if cache
+            else None
+        )
+        num_tokens = self._message_tokens.get(key) if cache else None
+        if num_tokens is None:
+            num_tokens = self._tokens_per_message
+            for field, value in message.items():
+                if value is None:
+                    continue
+                if isinstance(value, list):
+                    num_tokens += self._count_content_parts(value)
+                    continue
+                num_tokens += len(self._encoding.encode(value))
+                if field == "name":
+                    num_tokens += self._tokens_per_name
+            if not cache:
+                return num_tokens
+            if len(self._message_tokens) >= self.max_cached_messages:
+                self._message_tokens.clear()
+            self._message_tokens[key] = num_tokens
+        return num_tokens
+
+    def _count_content_parts(self, parts: List[Dict]) -> int:
+        num_tokens = 0
+        for part in parts:
+            if part.get("type") == "image_url":
+                num_tokens += estimate_image_part_tokens(part["image_url"])
+            elif part.get("type") == "text":
+                num_tokens += len(self._encoding.encode(part["text"]))
+        return num_tokens
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        """Return the number of tokens used by a list of messages (see num_tokens_from_messages)."""
+        num_tokens = sum(self.count_message(message) for message in messages)
+        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        return num_tokens
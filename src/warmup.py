@@ -0,0 +1,199 @@
+"""
+Startup phase timings, and warm-up of what the first request of a new process would wait for.
+
+A new app process (e.g. a replica just started by an autoscaler) pays for its imports and for
+building the UI before it serves anything. Without warm-up, its first chat request then also pays
+for loading the tokenizer's BPE tables (downloaded, unless found in TIKTOKEN_CACHE_DIR), building
+the shared OpenAI client (and the rate limiter, usage ledger and caches behind it), and opening
+connections (TCP + TLS handshakes) to the API. WarmUp does that at startup: the first part in a
+background thread while the UI is built, and the connections once the server's event loop runs
+(connections of async clients belong to the event loop that opened them).
+
+Each phase is timed. The breakdown is exported as the `startup` span of the metrics (see metrics.py),
+labelled by phase, and written to their trace log (see StartupTimer.log).
+"""
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from os.path import join
+from threading import Lock, Thread
+from typing import Dict, Iterator, List, Optional, Union
+
+import httpx
+from box.box import Box
+from openai import AsyncOpenAI, OpenAI
+
+from client_pool import DEFAULT_CONFIG_FILE_PATH, get_session_client
+from metrics import get_metrics
+from utils import get_root_dir_path, read_yaml_cached, set_tiktoken_cache_dir
+
+
+def get_process_uptime_s() -> Optional[float]:
+    """Return the seconds since this process started (Linux only, else None)."""
+    try:
+        with open("/proc/self/stat") as stat_file:
+            stat = stat_file.read()
+        # starttime (field 22, in clock ticks since boot) comes 20 fields after the command name
+        start_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (AttributeError, IndexError, OSError, ValueError):
+        return None
+
+
+class StartupTimer:
+    """Durations of the startup phases of the process (in the order they finished)."""
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = dict()
+        self._lock = Lock()
+        # Interpreter start and imports, up to the creation of the timer
+        uptime_s = get_process_uptime_s()
+        if uptime_s is not None:
+            self.add("imports", uptime_s)
+        self._last_mark_at = time.perf_counter()
+
+    def add(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase] = seconds
+        get_metrics().observe("startup", seconds, phase=phase)
+
+    def mark(self, phase: str) -> None:
+        """Record the time since the previous mark (or the creation of the timer) as a phase."""
+        now = time.perf_counter()
+        self.add(phase, now - self._last_mark_at)
+        self._last_mark_at = now
+
+    @contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        """Time the body of a `with` block as a phase."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - started_at)
+
+    def log(self) -> None:
+        """Write the phases so far (and the process uptime) to the metrics' trace log."""
+        with self._lock:
+            phases_s = {phase: round(seconds, 6) for phase, seconds in self.phases.items()}
+        get_metrics().write_trace(
+            {
+                "timestamp": time.time(),
+                "event": "startup",
+                "phases_s": phases_s,
+                "uptime_s": get_process_uptime_s(),
+            }
+        )
+
+
+class WarmUp:
+    """Warms up the tokenizer, the shared OpenAI client(s) and their connections."""
+
+    # Connections opened to each endpoint (a single one is enough with HTTP/2)
+    NUM_CONNECTIONS: int = 2
+    CONNECT_TIMEOUT_S: float = 5.0
+
+    def __init__(
+        self,
+        config_file: str = DEFAULT_CONFIG_FILE_PATH,
+        mock: bool = False,
+        num_connections: int = None,
+        timer: StartupTimer = None,
+    ) -> None:
+        self.config_file = config_file
+        self.mock = mock
+        self.num_connections = (
+            num_connections if num_connections is not None else self.NUM_CONNECTIONS
+        )
+        self.timer = timer if timer is not None else StartupTimer()
+        self.clients: List[Union[OpenAI, AsyncOpenAI]] = []
+        self._thread: Thread = None
+        self._connections_opened = False
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Optional[Box],
+        config_file: str = DEFAULT_CONFIG_FILE_PATH,
+        mock: bool = False,
+        timer: StartupTimer = None,
+    ) -> "WarmUp":
+        """Build warm-up from the `WARMUP_*` keys of a config file (if any)."""
+        config = config if config is not None else Box()
+        return cls(
+            config_file=config_file,
+            mock=mock,
+            num_connections=config.get("WARMUP_CONNECTIONS", cls.NUM_CONNECTIONS),
+            timer=timer,
+        )
+
+    def start(self) -> Thread:
+        """Run the warm-up in a daemon thread (once)."""
+        if self._thread is None:
+            self._thread = Thread(target=self.run, name="warm-up", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def run(self) -> None:
+        started_at = time.perf_counter()
+        try:
+            with self.timer.phase("config"):
+                read_yaml_cached(input_path=self.config_file)
+            with self.timer.phase("client"):
+                # Throwaway session: builds the shared client, and the process-wide state behind it
+                oai_client = get_session_client(config_file=self.config_file, mock=self.mock)
+            with self.timer.phase("tokenizer"):
+                oai_client.get_token_ledger()
+            if not self.mock:
+                self.clients = (
+                    [endpoint.client for endpoint in oai_client.router.endpoints]
+                    if oai_client.router is not None
+                    else [oai_client.client]
+                )
+        except Exception as e:
+            # The first request will try again (and report the error to its user)
+            print(f"Warning: Warm-up failed ({type(e).__name__}: {e}).")
+        finally:
+            self.timer.add("warm_up", time.perf_counter() - started_at)
+
+    async def open_connections(self) -> None:
+        """
+        Open connections to the API endpoints (once), from the event loop that will use them.
+        Waits for the warm-up thread if it is still running.
+        """
+        if self._connections_opened or self._thread is None:
+            return
+        self._connections_opened = True
+        await asyncio.to_thread(self._thread.join)
+        if not self.clients or self.num_connections <= 0:
+            return
+        with self.timer.phase("connections"):
+            # Concurrent requests, so that each opens its own connection (without HTTP/2). Any
+            # response will do: the connection is then kept alive in the client's pool.
+            await asyncio.gather(
+                *(
+                    self._ping(client)
+                    for client in self.clients
+                    if isinstance(client, AsyncOpenAI)
+                    for _ in range(self.num_connections)
+                )
+            )
+        self.timer.log()
+
+    async def _ping(self, client: AsyncOpenAI) -> None:
+        try:
+            await client.with_options(max_retries=0, timeout=self.CONNECT_TIMEOUT_S).get(
+                "models", cast_to=httpx.Response
+            )
+        except Exception:
+            # e.g. a 401/404 from the endpoint, the connection is open all the same
+            pass
+
+
+def set_app_tiktoken_cache_dir(config: Optional[Box]) -> None:
+    """Point tiktoken at `TIKTOKEN_CACHE_DIR` of a config file (relative to repo root), if set."""
+    cache_dir = config.get("TIKTOKEN_CACHE_DIR", None) if config is not None else None
+    if cache_dir:
+        set_tiktoken_cache_dir(join(get_root_dir_path(), cache_dir))
@@ -1,24 +1,37 @@
-from os.path import join
-from openai import AzureOpenAI
-from api_client import OAIClient
-from utils import get_src_dir_path
-from dotenv import load_dotenv
-from os import getenv
+import asyncio
+import time
 
-load_dotenv()
+from client_pool import get_session_client
+from speech import SpeechPipeline
 
-MODEL = ""
+# https://platform.openai.com/docs/guides/text-to-speech
+# The text is fed to the pipeline in small deltas (as a streamed chat answer would be). Each
+# sentence is synthesized as soon as it is complete, and its audio appended to the file in order.
 
-client = AzureOpenAI(
-    api_key=getenv("OPENAI_API_KEY"),
-    azure_endpoint=getenv("OPENAI_AZURE_ENDPOINT"),
-    api_version=getenv("OPENAI_API_VERSION"),
+TEXT = (
+    "Hello world! This is a streaming test. "
+    "Each sentence is sent to the speech API as soon as it is complete, "
+    "so the first one can play while the next ones are still being written."
 )
 
-response = client.audio.speech.create(
-    model="tts-1",
-    voice="alloy",
-    input="Hello world! This is a streaming test.",
-)
 
-response.stream_to_file("output.mp3")
+async def main(output_path: str = "output.mp3", delta_chars: int = 4):
+    oai_client = get_session_client()
+    speech = SpeechPipeline.from_config(config=oai_client.config, oai_client=oai_client)
+    started_at = time.perf_counter()
+    with open(output_path, "wb") as audio_file:
+        for idx in range(0, len(TEXT), delta_chars):
+            speech.feed(TEXT[idx : idx + delta_chars])
+            audio = speech.pop_ready()
+            if audio:
+                audio_file.write(audio)
+            await asyncio.sleep(0.02)  # ~50 tokens/s
+        async for audio in speech.remaining():
+            audio_file.write(audio)
+    print(f"First audio after {speech.first_audio_s:.2f}s")
+    print(f"Done after {time.perf_counter() - started_at:.2f}s")
+    print(speech.metrics)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
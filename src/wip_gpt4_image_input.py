@@ -13,9 +13,6 @@ Example:
     OPENAI_API_KEY=xxx python3 gpt4v.py photo.png "What's in this photo?"
 """
 
-import base64
-import json
-import mimetypes
 import os
 import sys
 from pprint import pprint
@@ -23,50 +20,26 @@ from pprint import pprint
 import requests
 from dotenv import load_dotenv
 
+from image_input import PreparedImage, build_image_message, get_image_preprocessor
+
 load_dotenv()
 
 api_key = os.getenv("OPENAI_API_KEY")
 
 
-def encode_image(image_path: str):
-    """Encodes an image to base64 and determines the correct MIME type."""
-    mime_type, _ = mimetypes.guess_type(image_path)
-    if mime_type is None:
-        raise ValueError(f"Cannot determine MIME type for {image_path}")
-
-    with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"data:{mime_type};base64,{encoded_string}"
+def encode_image(image_path: str, detail: str = "high") -> PreparedImage:
+    """Downscales an image to the resolution of the detail level, and encodes it as a data URL."""
+    return get_image_preprocessor().prepare(image_path, detail=detail)
 
 
 def create_payload(
     images: list[str], prompt: str, model="gpt-4-vision-preview", max_tokens=100, detail="high"
 ):
     """Creates the payload for the API request."""
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": prompt,
-                },
-            ],
-        },
-    ]
-
-    for image in images:
-        base64_image = encode_image(image)
-        messages[0]["content"].append(
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": base64_image,
-                    "detail": detail,
-                },
-            }
-        )
-
+    prepared_images = get_image_preprocessor().prepare_many(images, detail=detail)
+    for image_path, image in zip(images, prepared_images):
+        print(f"{image_path}: {image.width}x{image.height}, ~{image.num_tokens} tokens")
+    messages = [build_image_message(prompt, prepared_images)]
     return {"model": model, "messages": messages, "max_tokens": max_tokens}
 
 
@@ -1,5 +1,6 @@
-from openai import OpenAI
-from dotenv import load_dotenv
+import asyncio
+
+from image_generation import get_image_generation_service
 
 # https://platform.openai.com/docs/guides/images
 # Useful FAQs for DALL-E api: https://help.openai.com/en/collections/3698342-dall-e-api
@@ -12,21 +13,23 @@ IMAGE_SIZE_LRG_WIDE = "1792x1024"
 
 PROMPT = "a wooden king chess piece wearing sunglasses"
 
-load_dotenv()
-client = OpenAI()
-
-# num of outputs (n) has to be =1 for dall-e-3
-response = client.images.generate(
-    model="dall-e-3",
-    prompt=PROMPT,
-    size=IMAGE_SIZE_STD,
-    quality="standard",
-    n=1,
-)
-
-image_url, revised_prompt = response.data[0].url, response.data[0].revised_prompt
-print(image_url)
-print(revised_prompt)
+
+async def main(num_variants: int = 2):
+    # num of outputs (n) has to be =1 for dall-e-3, so variants are generated by concurrent calls.
+    # Images are downloaded to .local/generated_images, and a repeated prompt is served from there.
+    service = get_image_generation_service()
+    images = await service.generate_variants(
+        PROMPT, num_variants=num_variants, size=IMAGE_SIZE_STD, quality="standard"
+    )
+    for image in images:
+        print(image.path, "(cached)" if image.cached else "")
+        print(image.revised_prompt)
+    print(service.stats())
+    await service.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
 
 # RESPONSE EXAMPLE
 # ===
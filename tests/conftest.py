@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# Modules of src/ import each other by name (as when the app is run from src/)
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import rate_limiter  # noqa: E402
+import utils  # noqa: E402
+from mock_backend import MockChatBackend, build_mock_openai_client  # noqa: E402
+
+
+class WhitespaceEncoding:
+    """Stands in for a tiktoken encoding (whose BPE ranks would be downloaded): one token a word."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def encode(self, text: str, **kwargs):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def whitespace_encoding(monkeypatch):
+    monkeypatch.setattr(utils, "get_encoding", WhitespaceEncoding)
+    monkeypatch.setattr(utils, "_ENCODINGS_BY_NAME", {})
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limiters(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "_RATE_LIMITERS", {})
+
+
+@pytest.fixture
+def mock_backend():
+    return MockChatBackend(ttft_s=0.0, tokens_per_s=0.0, response_tokens=5, seed=0)
+
+
+@pytest.fixture
+def mock_client(mock_backend):
+    return build_mock_openai_client(backend=mock_backend, async_client=False)
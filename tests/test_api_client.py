@@ -0,0 +1,61 @@
+import pytest
+
+from api_client import OAIClient, TrackedStream
+from usage_ledger import UsageLedger
+
+MESSAGES = [{"role": "user", "content": "How are you doing today?"}]
+
+
+@pytest.fixture
+def oai_client(mock_client):
+    return OAIClient(client=mock_client, usage_ledger=UsageLedger())
+
+
+def test_stream_records_usage_once_on_finish_reason(oai_client):
+    stream = oai_client.query(messages=MESSAGES, stream=True)
+    assert isinstance(stream, TrackedStream)
+    answer = "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+
+    assert stream.finish_reason == "stop"
+    assert stream.output_tokens == len(answer.split()) == 5
+    assert len(oai_client.usage_ledger) == 1
+    stream.close()
+    assert len(oai_client.usage_ledger) == 1
+    assert oai_client.output_tokens_used == 5
+    assert oai_client.input_tokens_used == stream.input_tokens
+
+
+def test_stream_records_server_usage_once_on_usage_chunk(oai_client):
+    oai_client._STREAM_INCLUDE_USAGE = True
+    stream = oai_client.query(messages=MESSAGES, stream=True)
+    counted_input_tokens = stream.input_tokens
+    chunks = list(stream)
+
+    assert chunks[-1].choices == [] and chunks[-1].usage is not None
+    # The mock backend counts the words of the messages plus 3 tokens each
+    assert stream.input_tokens == len(MESSAGES[0]["content"].split()) + 3 != counted_input_tokens
+    assert len(oai_client.usage_ledger) == 1
+    assert oai_client.input_tokens_used == stream.input_tokens
+    assert oai_client.output_tokens_used == 5
+
+
+def test_stream_records_partial_usage_once_when_closed_early(oai_client):
+    stream = oai_client.query(messages=MESSAGES, stream=True)
+    chunks = iter(stream)
+    next(chunks)  # Role only
+    next(chunks)  # First word
+    stream.close()
+    stream.close()
+
+    assert stream.finish_reason is None
+    assert stream.output_tokens == 1
+    assert len(oai_client.usage_ledger) == 1
+    assert oai_client.output_tokens_used == 1
+
+
+def test_completion_records_server_usage(oai_client):
+    answer = oai_client.query(messages=MESSAGES)
+
+    assert len(answer.split()) == 5
+    assert len(oai_client.usage_ledger) == 1
+    assert oai_client.output_tokens_used == 5
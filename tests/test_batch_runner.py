@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import httpx
+from openai import BadRequestError, InternalServerError
+
+from api_client import AsyncOAIClient
+from batch_runner import iter_requests, read_completed_ids, run_batch, run_request
+from mock_backend import build_mock_openai_client
+from usage_ledger import UsageLedger
+
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+
+def read_jsonl(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_resume_runs_failed_and_pending_requests_once(tmp_path, mock_backend):
+    input_path, output_path = tmp_path / "requests.jsonl", tmp_path / "results.jsonl"
+    write_jsonl(input_path, [{"request_id": idx, "prompt": f"Question {idx}"} for idx in range(4)])
+    # A previous run: request 0 succeeded (twice), 1 failed, and it crashed while writing 2
+    write_jsonl(
+        output_path,
+        [
+            {"request_id": "0", "response": "old"},
+            {"request_id": "1", "error": "RateLimitError: ..."},
+            {"request_id": "0", "response": "older"},
+        ],
+    )
+    with open(output_path, "a") as file:
+        file.write('{"request_id": "2", "respo')
+
+    completed = read_completed_ids(output_path=str(output_path), id_field="request_id")
+    assert completed == {"0"}
+    assert read_jsonl(output_path) == [{"request_id": "0", "response": "old"}]
+
+    oai_client = AsyncOAIClient(
+        client=build_mock_openai_client(backend=mock_backend, async_client=True),
+        usage_ledger=UsageLedger(),
+    )
+    requests = iter_requests(
+        input_path=str(input_path),
+        id_field="request_id",
+        prompt_fields=["prompt"],
+        system_prompt="Be brief.",
+        skip_ids=completed,
+    )
+    counts = asyncio.run(
+        run_batch(
+            oai_client=oai_client,
+            requests=requests,
+            output_path=str(output_path),
+            id_field="request_id",
+            concurrency=2,
+            max_retries=1,
+        )
+    )
+
+    assert counts == {"succeeded": 3, "failed": 0}
+    assert mock_backend.metrics["requests"] == 3
+    rows = read_jsonl(output_path)
+    assert sorted(row["request_id"] for row in rows) == ["0", "1", "2", "3"]
+    assert read_completed_ids(output_path=str(output_path), id_field="request_id") == {
+        "0",
+        "1",
+        "2",
+        "3",
+    }
+
+
+class FailingClient:
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+        self.num_calls = 0
+
+    async def query(self, **kwargs):
+        self.num_calls += 1
+        raise self.error
+
+
+def make_error(error_type, status_code: int):
+    response = httpx.Response(status_code, request=httpx.Request("POST", "http://mock.local"))
+    return error_type("mock error", response=response, body=None)
+
+
+def test_invalid_requests_are_not_retried():
+    oai_client = FailingClient(error=make_error(BadRequestError, 400))
+    result = asyncio.run(run_request(oai_client, messages=[], params={}, max_retries=3))
+    assert (oai_client.num_calls, result["attempts"]) == (1, 1)
+    assert result["error"].startswith("BadRequestError")
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr("batch_runner.backoff_s", lambda **kwargs: 0.0)
+    oai_client = FailingClient(error=make_error(InternalServerError, 500))
+    result = asyncio.run(run_request(oai_client, messages=[], params={}, max_retries=2))
+    assert (oai_client.num_calls, result["attempts"]) == (3, 3)
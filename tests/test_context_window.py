@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from context_window import SUMMARY_PREFIX, ContextWindowManager
+from conversation import Conversation
+from utils import TokenLedger
+
+# With the tests' one token a word encoding, each message counts 10 tokens (3 of overhead)
+MESSAGES = [
+    {"role": role, "content": f"{name} two three four five six"}
+    for role, name in [
+        ("system", "sys"),
+        ("user", "u1"),
+        ("assistant", "a1"),
+        ("user", "u2"),
+        ("assistant", "a2"),
+        ("user", "u3"),
+    ]
+]
+
+
+def make_manager(policy: str, max_input_tokens: int, summarizer=None) -> ContextWindowManager:
+    return ContextWindowManager(
+        token_ledger=TokenLedger(model="gpt-3.5-turbo-0613"),
+        max_input_tokens=max_input_tokens,
+        policy=policy,
+        summarizer=summarizer,
+    )
+
+
+def names(messages):
+    return [message["content"].split()[0] for message in messages]
+
+
+def test_sliding_window_keeps_most_recent_messages():
+    manager = make_manager("sliding_window", max_input_tokens=3 + 50)
+    assert names(manager.fit(MESSAGES)) == ["u1", "a1", "u2", "a2", "u3"]
+    assert len(MESSAGES) == 6
+
+
+def test_pinned_system_keeps_system_prompt_and_never_starts_with_an_answer():
+    manager = make_manager("pinned_system", max_input_tokens=3 + 50)
+    assert names(manager.fit(MESSAGES)) == ["sys", "u2", "a2", "u3"]
+    assert names(manager.fit(MESSAGES, reserved_tokens=20)) == ["sys", "u3"]
+
+
+def test_last_message_is_sent_even_if_it_does_not_fit():
+    manager = make_manager("pinned_system", max_input_tokens=15)
+    assert names(manager.fit(MESSAGES)) == ["sys", "u3"]
+
+
+def test_fits_conversation_turns():
+    conversation = Conversation.from_messages(MESSAGES)
+    manager = make_manager("pinned_system", max_input_tokens=3 + 50)
+    fitted = manager.fit(conversation)
+    assert fitted[0] is conversation[0]
+    assert names(fitted) == ["sys", "u2", "a2", "u3"]
+
+
+def test_summarize_replaces_dropped_messages_with_summary():
+    summarized = []
+
+    def summarizer(messages):
+        summarized.append(messages[-1]["content"])
+        return "u1-a1"  # A summary message of 10 tokens, like the others
+
+    manager = make_manager("summarize", max_input_tokens=3 + 50, summarizer=summarizer)
+    assert names(manager.fit(MESSAGES)) == ["sys", "u2", "a2", "u3"]
+    manager._pending_summary.result(timeout=5)
+    assert summarized == [
+        "user: u1 two three four five six\nassistant: a1 two three four five six"
+    ]
+
+    fitted = manager.fit(MESSAGES)
+    assert fitted[1] == {"role": "system", "content": SUMMARY_PREFIX + "u1-a1"}
+    assert names(fitted) == ["sys", "Summary", "u2", "a2", "u3"]
+
+
+def test_summarize_with_async_summarizer():
+    async def summarizer(messages):
+        return "earlier"
+
+    async def main():
+        manager = make_manager("summarize", max_input_tokens=3 + 50, summarizer=summarizer)
+        manager.fit(MESSAGES)
+        await manager._pending_summary
+        return manager.fit(MESSAGES)
+
+    assert asyncio.run(main())[1]["content"] == SUMMARY_PREFIX + "earlier"
+
+
+def test_unknown_policy_and_missing_summarizer_are_rejected():
+    with pytest.raises(ValueError):
+        make_manager("newest_first", max_input_tokens=100)
+    with pytest.raises(ValueError):
+        make_manager("summarize", max_input_tokens=100)
@@ -0,0 +1,99 @@
+import json
+
+from api_client import OAIClient
+from conversation import Conversation, Turn
+from session_store import restore_session, snapshot_session
+from utils import TokenLedger
+
+
+def make_conversation() -> Conversation:
+    conversation = Conversation()
+    conversation.set_system_prompt("Be brief.")
+    conversation.add("user", "What is in this picture?", images=("/tmp/uploads/cat.png",))
+    conversation.add("assistant", "A cat.")
+    conversation.add("user", "And its colour?")
+    return conversation
+
+
+def test_chat_view_shows_images_and_pairs_answers():
+    conversation = make_conversation()
+    assert conversation.chat_view() == [
+        [("/tmp/uploads/cat.png",), None],
+        ["What is in this picture?", "A cat."],
+        ["And its colour?", None],
+    ]
+    assert conversation.messages()[1] == {
+        "role": "user",
+        "content": "What is in this picture?\n[image: cat.png]",
+    }
+
+
+def test_chat_view_rebuilds_only_the_streamed_pair():
+    conversation = make_conversation()
+    chat_view = conversation.chat_view()
+    first_pair = chat_view[1]
+    answer = conversation.add("assistant")
+    for chunk in ["It is ", "ginger", "."]:
+        answer.append(chunk)
+        assert conversation.chat_view() is chat_view
+    answer.close()
+
+    assert chat_view[1] is first_pair
+    assert chat_view[-1] == ["And its colour?", "It is ginger."]
+    conversation.add("user", "Thanks!")
+    assert conversation.chat_view()[-2:] == [
+        ["And its colour?", "It is ginger."],
+        ["Thanks!", None],
+    ]
+
+
+def test_chat_view_after_turns_are_removed():
+    conversation = make_conversation()
+    conversation.add("assistant", "Ginger.")
+    conversation.add("user", "Thanks!")
+    conversation.chat_view()
+    del conversation.turns[2:]
+    assert conversation.chat_view() == [
+        [("/tmp/uploads/cat.png",), None],
+        ["What is in this picture?", None],
+    ]
+
+
+def test_state_round_trips_through_json():
+    conversation = make_conversation()
+    conversation.add("assistant").append("Ginger.")
+    restored = Conversation.from_state(json.loads(json.dumps(conversation.to_state())))
+
+    assert restored.to_state() == conversation.to_state()
+    assert restored.messages() == conversation.messages()
+    assert restored.chat_view() == conversation.chat_view()
+
+
+def test_chat_history_round_trips_through_chat_view():
+    chat_history = [["Hi", "Hello!"], ["How are you?", "Fine."], ["Bye", None]]
+    conversation = Conversation.from_chat_history(chat_history)
+    assert conversation.chat_view() == chat_history
+    assert [turn["role"] for turn in conversation] == ["user", "assistant"] * 2 + ["user"]
+
+
+def test_session_snapshot_restores_conversation_and_usage(mock_client):
+    oai_client = OAIClient(client=mock_client)
+    oai_client.input_tokens_used, oai_client.pricing_cost = 42, 0.5
+    conversation = make_conversation()
+    state = json.loads(json.dumps(snapshot_session(oai_client, conversation)))
+
+    new_client = OAIClient(client=mock_client)
+    restored = restore_session(new_client, state)
+    assert restored.chat_view() == conversation.chat_view()
+    assert (new_client.input_tokens_used, new_client.pricing_cost) == (42, 0.5)
+
+
+def test_turn_token_count_is_cached_until_appended_to():
+    token_ledger = TokenLedger(model="gpt-3.5-turbo-0613")
+    turn = Turn(role="assistant")
+    turn.append("one two")
+    assert turn.count_tokens(token_ledger) == 3 + 1 + 2
+    turn.append(" three")
+    assert turn.count_tokens(token_ledger) == 3 + 1 + 3
+    assert turn.text == "one two three"
+    assert dict(turn) == {"role": "assistant", "content": "one two three"}
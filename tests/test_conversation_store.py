@@ -0,0 +1,100 @@
+import calendar
+
+import pytest
+
+from conversation_store import ConversationStore
+
+DAY1 = calendar.timegm((2024, 1, 1, 12, 0, 0))
+DAY2 = calendar.timegm((2024, 1, 2, 12, 0, 0))
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConversationStore(db_path=str(tmp_path / "conversations.sqlite3"), max_batch_size=4)
+    yield store
+    store.close()
+
+
+def append_turns(store, session, timestamps, model="gpt-4-0613"):
+    for idx, timestamp in enumerate(timestamps):
+        store.append_turn(
+            session=session,
+            model=model,
+            user_message=f"{session} question {idx}",
+            assistant_message=f"{session} answer {idx}",
+            input_tokens=10,
+            output_tokens=5,
+            cost=0.01,
+            timestamp=timestamp,
+        )
+
+
+def paginate(fetch, next_cursor):
+    pages, page = [], fetch(None)
+    while page:
+        pages.append(page)
+        page = fetch(next_cursor(page[-1]))
+    return pages
+
+
+def test_sessions_are_paged_most_recent_first(store):
+    # s1 and s2 were last active at the same time: the session name breaks the tie
+    append_turns(store, "s1", [DAY1, DAY1 + 30])
+    append_turns(store, "s2", [DAY1 + 10, DAY1 + 30])
+    append_turns(store, "s3", [DAY1 + 20])
+    append_turns(store, "s4", [DAY1 + 40])
+    assert store.flush(timeout_s=5)
+
+    pages = paginate(
+        lambda before: store.list_sessions(limit=2, before=before),
+        lambda last: (last["last_at"], last["session"]),
+    )
+    assert [[row["session"] for row in page] for page in pages] == [["s4", "s2"], ["s1", "s3"]]
+    s1 = pages[1][0]
+    assert (s1["turns"], s1["input_tokens"], s1["first_at"]) == (2, 20, DAY1)
+    assert s1["cost"] == pytest.approx(0.02)
+
+
+def test_session_turns_are_paged_oldest_first(store):
+    append_turns(store, "s1", [DAY1 + idx for idx in range(5)])
+    append_turns(store, "s2", [DAY1 + 2])
+    store.flush(timeout_s=5)
+
+    pages = paginate(
+        lambda after_id: store.get_turns("s1", limit=2, after_id=after_id or 0),
+        lambda last: last["id"],
+    )
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [turn["user_message"] for page in pages for turn in page] == [
+        f"s1 question {idx}" for idx in range(5)
+    ]
+    assert store.metrics["turns_written"] == 6
+
+
+def test_recent_turns_are_paged_newest_first_by_model(store):
+    append_turns(store, "s1", [DAY1, DAY1 + 1, DAY1 + 2], model="gpt-4-0613")
+    append_turns(store, "s2", [DAY1 + 3], model="gpt-3.5-turbo-1106")
+    store.flush(timeout_s=5)
+
+    first = store.recent_turns(limit=2, model="gpt-4-0613")
+    rest = store.recent_turns(limit=2, before_id=first[-1]["id"], model="gpt-4-0613")
+    assert [turn["assistant_message"] for turn in first + rest] == [
+        "s1 answer 2",
+        "s1 answer 1",
+        "s1 answer 0",
+    ]
+    assert store.recent_turns(limit=1)[0]["session"] == "s2"
+
+
+def test_usage_totals_by_day_and_model(store):
+    append_turns(store, "s1", [DAY1, DAY2])
+    append_turns(store, "s2", [DAY2], model="gpt-3.5-turbo-1106")
+    store.flush(timeout_s=5)
+
+    by_day = store.usage(by="day")
+    assert [(row["day"], row["turns"]) for row in by_day] == [("2024-01-02", 2), ("2024-01-01", 1)]
+    assert {row["model"]: row["turns"] for row in store.usage(by="model")} == {
+        "gpt-4-0613": 2,
+        "gpt-3.5-turbo-1106": 1,
+    }
+    assert store.usage(by="total", since_day="2024-01-02")[0]["output_tokens"] == 10
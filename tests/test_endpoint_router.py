@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from api_client import AsyncOAIClient, OAIClient
+from endpoint_router import Endpoint, EndpointRouter
+from mock_backend import MockChatBackend, build_mock_openai_client
+from usage_ledger import UsageLedger
+
+MESSAGES = [{"role": "user", "content": "How are you doing today?"}]
+
+
+def make_endpoint(name, backend, async_client=False):
+    client = build_mock_openai_client(backend=backend, async_client=async_client, max_retries=0)
+    return Endpoint(name=name, client=client)
+
+
+def make_router(endpoints, **kwargs):
+    return EndpointRouter(endpoints=endpoints, health_check_interval_s=None, **kwargs)
+
+
+def test_fails_over_to_next_endpoint(mock_backend):
+    failing_backend = MockChatBackend(ttft_s=0.0, tokens_per_s=0.0, error_rate=1.0, seed=0)
+    failing = make_endpoint("failing", failing_backend)
+    healthy = make_endpoint("healthy", mock_backend)
+    router = make_router([failing, healthy])
+    oai_client = OAIClient(router=router, usage_ledger=UsageLedger())
+
+    assert len(oai_client.query(messages=MESSAGES).split()) == 5
+
+    assert failing_backend.metrics["errors"] == 1
+    assert not failing.is_healthy() and failing.metrics["failures"] == 1
+    # Out of rotation for its cooldown, so the next call goes straight to the healthy endpoint
+    assert router.rank() == [healthy, failing]
+    oai_client.query(messages=MESSAGES + [{"role": "user", "content": "And now?"}])
+    assert failing_backend.metrics["requests"] == 1
+    assert healthy.metrics["calls"] == 2 and healthy.in_flight == 0
+
+
+def test_only_streams_update_ttft(mock_backend):
+    endpoint = make_endpoint("mock", mock_backend)
+    oai_client = OAIClient(router=make_router([endpoint]), usage_ledger=UsageLedger())
+
+    oai_client.query(messages=MESSAGES)
+    assert endpoint.ewma_ttft_s is None and endpoint.ewma_latency_s is not None
+
+    stream = oai_client.query(messages=MESSAGES, stream=True)
+    assert endpoint.ewma_ttft_s is not None
+    assert endpoint.in_flight == 1
+    list(stream)
+    stream.close()
+    assert endpoint.in_flight == 0
+
+
+def test_fastest_ranks_by_ewma_ttft_then_latency(mock_backend):
+    slow, fast, unseen = [make_endpoint(name, mock_backend) for name in ("slow", "fast", "unseen")]
+    router = make_router([slow, fast, unseen], ewma_alpha=0.5)
+    router.observe_ttft(endpoint=slow, ttft_s=1.0)
+    router.observe_ttft(endpoint=fast, ttft_s=3.0)
+    router.observe_ttft(endpoint=fast, ttft_s=0.0)
+    router.observe_ttft(endpoint=fast, ttft_s=0.0)
+    # Endpoints without a TTFT yet are tried first, to get one
+    assert fast.ewma_ttft_s == pytest.approx(0.75)
+    assert router.rank() == [unseen, fast, slow]
+
+    router.observe_latency(endpoint=unseen, latency_s=5.0)
+    router.observe_latency(endpoint=slow, latency_s=1.0)
+    slow.ewma_ttft_s = fast.ewma_ttft_s = None
+    assert router.rank() == [fast, slow, unseen]
+    assert router.rank(exclude=[fast]) == [slow, unseen, fast]
+
+
+def run_hedged(primary_backend, hedge_backend):
+    primary = make_endpoint("primary", primary_backend, async_client=True)
+    hedge = make_endpoint("hedge", hedge_backend, async_client=True)
+    router = make_router([primary, hedge], hedge_after_s=0.05, ewma_alpha=1.0)
+    # Ranked first, though its first token will be slow
+    router.observe_ttft(endpoint=primary, ttft_s=0.01)
+    router.observe_ttft(endpoint=hedge, ttft_s=0.02)
+    oai_client = AsyncOAIClient(router=router, usage_ledger=UsageLedger())
+
+    async def main():
+        stream = await oai_client.query(messages=MESSAGES, stream=True)
+        # Nothing of the losing call is left in flight once the stream is handed over
+        in_flight = {endpoint.name: endpoint.in_flight for endpoint in router.endpoints}
+        chunks = [chunk async for chunk in stream]
+        return in_flight, chunks
+
+    in_flight, chunks = asyncio.run(main())
+    return router, primary, hedge, in_flight, chunks
+
+
+def test_hedge_wins_over_slow_endpoint_and_cancels_it():
+    slow_backend = MockChatBackend(ttft_s=1.0, tokens_per_s=0.0, response_tokens=5, seed=0)
+    fast_backend = MockChatBackend(ttft_s=0.0, tokens_per_s=0.0, response_tokens=5, seed=0)
+
+    router, primary, hedge, in_flight, chunks = run_hedged(slow_backend, fast_backend)
+
+    assert router.metrics == {"hedges": 1, "hedges_won": 1}
+    assert in_flight == {"primary": 0, "hedge": 1}
+    assert len([chunk for chunk in chunks if chunk.choices and chunk.choices[0].delta.content]) == 5
+    # The cancelled call took at least the hedge delay, so it no longer ranks first
+    assert primary.ewma_ttft_s >= router.hedge_after_s > hedge.ewma_ttft_s
+    assert router.rank()[0] is hedge
+
+
+def test_fast_endpoint_is_not_hedged(mock_backend):
+    hedge_backend = MockChatBackend(ttft_s=0.0, tokens_per_s=0.0, response_tokens=5, seed=0)
+
+    router, primary, hedge, in_flight, _ = run_hedged(mock_backend, hedge_backend)
+
+    assert router.metrics == {"hedges": 0, "hedges_won": 0}
+    assert in_flight == {"primary": 1, "hedge": 0}
+    assert hedge_backend.metrics["requests"] == 0
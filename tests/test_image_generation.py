@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+from base64 import b64encode
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+from api_client import AsyncOAIClient
+from image_generation import ImageGenerationService
+from usage_ledger import UsageLedger
+
+
+class ImagesBackend:
+    """Serves the images API: each call returns a new (fake) image of its prompt."""
+
+    def __init__(self, latency_s: float = 0.01, status_code: int = 200) -> None:
+        self.latency_s = latency_s
+        self.status_code = status_code
+        self.requests = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append(body)
+        number = len(self.requests)
+        await asyncio.sleep(self.latency_s)
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, json={"error": {"message": "Bad request"}})
+        content = f"{body['prompt']} #{number}".encode("utf-8")
+        return httpx.Response(
+            200,
+            json={
+                "created": 0,
+                "data": [
+                    {
+                        "b64_json": b64encode(content).decode("ascii"),
+                        "revised_prompt": f"A {body['prompt']}",
+                    }
+                ],
+            },
+        )
+
+
+@pytest.fixture
+def backend():
+    return ImagesBackend()
+
+
+def make_service(backend, store_dir):
+    client = AsyncOpenAI(
+        api_key="mock",
+        base_url="http://images.mock/v1",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(backend.handle)),
+    )
+    oai_client = AsyncOAIClient(client=client, usage_ledger=UsageLedger())
+    return ImageGenerationService(
+        oai_client=oai_client, store_dir=str(store_dir), response_format="b64_json"
+    )
+
+
+def test_variants_are_generated_and_stored_by_content(backend, tmp_path):
+    service = make_service(backend, tmp_path)
+
+    images = asyncio.run(service.generate_variants("a chess piece", num_variants=3))
+
+    assert [image.variant for image in images] == [0, 1, 2]
+    assert len(backend.requests) == 3 and all(body["n"] == 1 for body in backend.requests)
+    assert len({image.content_hash for image in images}) == 3
+    for image in images:
+        assert not image.cached and image.revised_prompt == "A a chess piece"
+        assert image.path.endswith(f"{image.content_hash[:2]}/{image.content_hash}.png")
+        with open(image.path, "rb") as image_file:
+            assert image_file.read().startswith(b"a chess piece #")
+    assert service.metrics["cost"] == pytest.approx(3 * 0.04)
+
+
+def test_identical_requests_in_flight_share_one_call(backend, tmp_path):
+    service = make_service(backend, tmp_path)
+
+    async def main():
+        return await asyncio.gather(
+            service.generate("a chess piece"),
+            service.generate("a chess piece"),
+            service.generate("a chess piece", quality="hd"),
+        )
+
+    first, joined, hd = asyncio.run(main())
+
+    assert first == joined and hd.content_hash != first.content_hash
+    assert len(backend.requests) == 2
+    assert service.metrics["joined"] == 1
+    assert service.stats()["in_flight"] == 0
+
+
+def test_stored_images_are_reused_after_a_restart(backend, tmp_path):
+    image = asyncio.run(make_service(backend, tmp_path).generate("a chess piece"))
+
+    # A new service (e.g. after a restart) answers from the index, without a call
+    cached = asyncio.run(make_service(backend, tmp_path).generate("a chess piece"))
+    assert cached == image._replace(cached=True)
+    assert len(backend.requests) == 1
+
+    # Unless the image itself is gone
+    os.remove(image.path)
+    regenerated = asyncio.run(make_service(backend, tmp_path).generate("a chess piece"))
+    assert not regenerated.cached and os.path.exists(regenerated.path)
+    assert len(backend.requests) == 2
+
+
+def test_failed_requests_are_not_stored(tmp_path):
+    backend = ImagesBackend(status_code=400)
+    service = make_service(backend, tmp_path)
+
+    with pytest.raises(Exception):
+        asyncio.run(service.generate("a chess piece"))
+    assert service.metrics["errors"] == 1
+
+    backend.status_code = 200
+    assert not asyncio.run(service.generate("a chess piece")).cached
+    assert len(backend.requests) == 2
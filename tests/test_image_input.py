@@ -0,0 +1,87 @@
+import shutil
+import threading
+
+import pytest
+from PIL import Image
+
+from image_input import ImagePreprocessor
+
+
+def save_image(path, size=(2000, 1000), mode="RGB"):
+    Image.new(mode, size, color=(200, 100, 50, 128)[: len(mode)]).save(path)
+    return str(path)
+
+
+@pytest.fixture
+def preprocessor():
+    return ImagePreprocessor(max_workers=4)
+
+
+def test_images_are_downscaled_to_the_detail_level(preprocessor, tmp_path):
+    path = save_image(tmp_path / "photo.jpg")
+
+    high = preprocessor.prepare(path, detail="high")
+    low = preprocessor.prepare(path, detail="low")
+
+    assert (high.width, high.height) == (1536, 768)
+    assert (low.width, low.height) == (512, 256)
+    assert high.data_url.startswith("data:image/jpeg;base64,")
+    assert preprocessor.metrics == {"hits": 0, "misses": 2, "errors": 0}
+
+
+def test_transparent_images_stay_png(preprocessor, tmp_path):
+    path = save_image(tmp_path / "logo.png", size=(100, 100), mode="RGBA")
+    assert preprocessor.prepare(path, detail="low").data_url.startswith("data:image/png;")
+
+
+def test_images_are_cached_by_content(preprocessor, tmp_path):
+    path = save_image(tmp_path / "photo.jpg")
+    copy = shutil.copy(path, tmp_path / "uploaded_again.jpg")
+
+    first = preprocessor.prepare(path)
+    assert preprocessor.prepare(path) == first
+    assert preprocessor.prepare(copy) == first
+    assert preprocessor.metrics == {"hits": 2, "misses": 1, "errors": 0}
+    assert preprocessor.stats()["entries"] == 1
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    preprocessor = ImagePreprocessor(max_workers=1, max_cache_entries=1)
+    first, second = [save_image(tmp_path / f"{idx}.jpg", size=(10 + idx, 10)) for idx in (1, 2)]
+
+    preprocessor.prepare(first)
+    preprocessor.prepare(second)
+    preprocessor.prepare(first)
+
+    assert preprocessor.metrics["misses"] == 3
+    assert preprocessor.stats()["entries"] == 1
+
+
+def test_concurrent_requests_for_an_image_prepare_it_once(preprocessor, tmp_path, monkeypatch):
+    path = save_image(tmp_path / "photo.jpg")
+    prepare, calls, release = preprocessor._prepare, [], threading.Event()
+
+    def slow_prepare(*args, **kwargs):
+        calls.append(args)
+        # Held until every request is queued, so they overlap
+        release.wait(timeout=5)
+        return prepare(*args, **kwargs)
+
+    monkeypatch.setattr(preprocessor, "_prepare", slow_prepare)
+    futures = preprocessor.submit([path] * 4, detail="low")
+    release.set()
+    images = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert all(image == images[0] for image in images)
+    assert preprocessor.metrics["misses"] == 1
+
+
+def test_failed_images_are_not_cached(preprocessor, tmp_path):
+    path = tmp_path / "broken.jpg"
+    path.write_bytes(b"not an image")
+
+    for _ in range(2):
+        with pytest.raises(Exception):
+            preprocessor.prepare(str(path))
+    assert preprocessor.metrics == {"hits": 0, "misses": 2, "errors": 2}
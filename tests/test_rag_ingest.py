@@ -0,0 +1,103 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from rag_ingest import MANIFEST_FILE_NAME, DocumentIngestor
+
+
+def embed(texts):
+    return [[float(len(text)), 1.0] for text in texts]
+
+
+def make_ingestor(persist_dir, threaded=True):
+    ingestor = DocumentIngestor(
+        persist_dir=str(persist_dir), embedding_function=embed, max_workers=1
+    )
+    if threaded:
+        # Parsed in threads, which see the whitespace encoding of conftest.py
+        ingestor._executor = ThreadPoolExecutor(max_workers=1)
+    return ingestor
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return str(path)
+
+
+def run(ingestor, paths):
+    *_, progress = ingestor.ingest(paths)
+    return progress
+
+
+def chunks_of(ingestor, path):
+    return ingestor.collection.get(where={"path": path}, include=["documents"])["documents"]
+
+
+@pytest.fixture
+def ingestor(tmp_path):
+    ingestor = make_ingestor(tmp_path / "rag")
+    yield ingestor
+    ingestor.close()
+
+
+def test_unchanged_files_are_skipped_and_changed_ones_replaced(ingestor, tmp_path):
+    path = write(tmp_path / "docs" / "notes.txt", "Cats purr.\n\nDogs bark.")
+    assert run(ingestor, [path]).indexed == 1
+    version = ingestor.version
+
+    progress = run(ingestor, [path])
+    assert (progress.indexed, progress.skipped) == (0, 1)
+    assert ingestor.version == version
+
+    write(tmp_path / "docs" / "notes.txt", "Birds sing.")
+    assert run(ingestor, [path]).indexed == 1
+    assert chunks_of(ingestor, path) == ["Birds sing."]
+    assert ingestor.stats() == {"documents": 1, "chunks": 1}
+
+
+def test_same_named_files_do_not_replace_each_other(ingestor, tmp_path):
+    first = write(tmp_path / "session1" / "notes.txt", "Cats purr.")
+    second = write(tmp_path / "session2" / "notes.txt", "Dogs bark.")
+
+    assert run(ingestor, [first]).indexed == 1
+    assert run(ingestor, [second]).indexed == 1
+
+    assert chunks_of(ingestor, first) == ["Cats purr."]
+    assert chunks_of(ingestor, second) == ["Dogs bark."]
+    sources = ingestor.collection.get(include=["metadatas"])["metadatas"]
+    assert {metadata["source"] for metadata in sources} == {"notes.txt"}
+
+
+def test_duplicate_content_is_recorded_not_indexed(ingestor, tmp_path):
+    original = write(tmp_path / "a.txt", "Cats purr.")
+    copy = write(tmp_path / "b.txt", "Dogs bark.")
+    run(ingestor, [original, copy])
+
+    write(tmp_path / "b.txt", "Cats purr.")
+    progress = run(ingestor, [copy])
+
+    assert (progress.indexed, progress.skipped) == (0, 1)
+    # The copy's older chunks are gone, and only the original's remain
+    assert chunks_of(ingestor, copy) == []
+    assert ingestor.stats()["chunks"] == 1
+    with open(tmp_path / "rag" / MANIFEST_FILE_NAME) as file:
+        manifest = json.load(file)
+    assert manifest[copy]["duplicate_of"] == original
+    assert manifest[copy]["num_chunks"] == 0
+
+
+def test_manifest_is_reused_by_worker_processes(tmp_path):
+    path = write(tmp_path / "notes.txt", "Cats purr.")
+    ingestor = make_ingestor(tmp_path / "rag")
+    run(ingestor, [path])
+    ingestor.close()
+
+    # Unchanged files are only hashed (no encoding needed), by workers from the fork server
+    ingestor = make_ingestor(tmp_path / "rag", threaded=False)
+    try:
+        progress = run(ingestor, [path])
+    finally:
+        ingestor.close()
+    assert (progress.indexed, progress.skipped, progress.errors) == (0, 1, [])
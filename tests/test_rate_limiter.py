@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from rate_limiter import DEFAULT_RETRY_AFTER_S, RateLimiter, parse_duration_s
+
+
+def test_parse_duration():
+    assert parse_duration_s("20ms") == pytest.approx(0.02)
+    assert parse_duration_s("6m0s") == 360
+    assert parse_duration_s("1.5") == 1.5
+    assert parse_duration_s("soon") is None
+
+
+def test_lanes_take_turns():
+    rate_limiter = RateLimiter()
+    rate_limiter.penalize(headers={"retry-after-ms": "100"})
+    granted = []
+
+    async def acquire(name, lane):
+        await rate_limiter.aacquire(lane=lane)
+        granted.append(name)
+
+    async def main():
+        tasks = [asyncio.create_task(acquire(f"batch{idx}", "batch")) for idx in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(acquire("chat", "interactive")))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert granted == ["batch0", "chat", "batch1", "batch2"]
+
+
+def test_cancelled_waiter_leaves_its_lane():
+    rate_limiter = RateLimiter()
+    rate_limiter.penalize(headers={"retry-after-ms": "100"})
+
+    async def main():
+        waiter = asyncio.create_task(rate_limiter.aacquire(lane="batch"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await rate_limiter.aacquire(lane="batch")
+
+    asyncio.run(main())
+    assert rate_limiter.stats()["waiting"] == {"batch": 0}
+
+
+def test_penalize_blocks_callers_and_slows_refill():
+    rate_limiter = RateLimiter(rpm=600)
+    assert rate_limiter.penalize(headers={"retry-after": "0.2"}) == 0.2
+    assert rate_limiter.penalize() == DEFAULT_RETRY_AFTER_S
+    assert rate_limiter.stats()["rate_scale"] == 0.25
+
+    rate_limiter = RateLimiter()
+    rate_limiter.penalize(headers={"retry-after-ms": "150"})
+    started_at = time.monotonic()
+    rate_limiter.acquire()
+    assert time.monotonic() - started_at >= 0.14
+    assert rate_limiter.stats()["rate_limited"] == 1
+
+
+def test_token_bucket_waits_for_refill():
+    rate_limiter = RateLimiter(tpm=6000)  # 100 tokens/s
+    assert rate_limiter.acquire(tokens=6000) < 0.05
+    waited_s = rate_limiter.acquire(tokens=10)
+    assert 0.05 < waited_s < 0.5
+
+
+def test_headers_set_limits_and_block_until_reset():
+    rate_limiter = RateLimiter()
+    rate_limiter.update_from_headers(
+        headers={
+            "x-ratelimit-limit-requests": "600",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "150ms",
+        }
+    )
+    started_at = time.monotonic()
+    rate_limiter.acquire()
+    assert time.monotonic() - started_at >= 0.14
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import api_client
+import response_cache
+from api_client import AsyncOAIClient, OAIClient
+from mock_backend import build_mock_openai_client
+from response_cache import ResponseCache, make_cache_key
+from usage_ledger import UsageLedger
+
+REQUEST = dict(
+    messages=[{"role": "user", "content": "Hi"}],
+    model="gpt-3.5-turbo-1106",
+    temperature=0.2,
+    seed=12345,
+    top_p=1.0,
+    max_tokens=None,
+    stream=False,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_cache_key_ignores_streaming_and_skips_uncacheable_requests():
+    assert make_cache_key(REQUEST) == make_cache_key({**REQUEST, "stream": True})
+    assert make_cache_key(REQUEST) != make_cache_key({**REQUEST, "temperature": 0.0})
+    assert make_cache_key({**REQUEST, "tools": [{"type": "function"}]}) is None
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResponseCache(ttl_s=10)
+    cache.put(key="a", content="A")
+    clock[0] += 9
+    assert cache.get(key="a") == "A"
+    clock[0] += 2
+    assert cache.get(key="a") is None
+    assert cache.stats()["entries_memory"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResponseCache(max_entries=2)
+    cache.put(key="a", content="A")
+    cache.put(key="b", content="B")
+    cache.get(key="a")
+    cache.put(key="c", content="C")
+
+    assert cache.get(key="b") is None
+    assert (cache.get(key="a"), cache.get(key="c")) == ("A", "C")
+    assert cache.metrics["evictions_memory"] == 1
+
+
+def test_sqlite_tier_serves_and_promotes_entries(clock, tmp_path):
+    db_path = str(tmp_path / "cache" / "responses.db")
+    ResponseCache(db_path=db_path).put(key="a", content="A")
+
+    cache = ResponseCache(db_path=db_path)
+    assert cache.get(key="a") == "A"
+    assert cache.get(key="a") == "A"
+    assert (cache.metrics["hits_disk"], cache.metrics["hits_memory"]) == (1, 1)
+
+
+def test_sqlite_tier_expires_and_evicts_entries(clock, tmp_path):
+    db_path = str(tmp_path / "responses.db")
+    cache = ResponseCache(max_entries=1, ttl_s=10, db_path=db_path, max_db_entries=2)
+    cache.DB_EVICT_INTERVAL_PUTS = 1
+    cache.put(key="a", content="A")
+    clock[0] += 1
+    cache.put(key="b", content="B")
+    clock[0] += 1
+    cache.get(key="a")  # From disk: "b" is now the least recently used
+    clock[0] += 1
+    cache.put(key="c", content="C")
+
+    assert cache.get(key="b") is None
+    assert cache.get(key="a") == "A"
+    clock[0] += 10
+    assert cache.get(key="c") is None
+    assert cache.stats()["hit_rate"] == pytest.approx(2 / 4)
+
+
+def test_identical_request_is_answered_from_cache(mock_backend, mock_client):
+    oai_client = OAIClient(
+        client=mock_client, usage_ledger=UsageLedger(), response_cache=ResponseCache()
+    )
+    messages = [{"role": "user", "content": "Hi"}]
+    answer = oai_client.query(messages=messages)
+    streamed = "".join(
+        chunk.choices[0].delta.content or "" for chunk in oai_client.query(messages, stream=True)
+    )
+
+    assert streamed == answer
+    assert mock_backend.metrics["requests"] == 1
+    assert oai_client.num_cache_hits == 1
+    assert len(oai_client.usage_ledger) == 1
+
+
+def test_sqlite_tier_is_evicted_every_interval_puts(clock, tmp_path):
+    cache = ResponseCache(max_entries=1, db_path=str(tmp_path / "responses.db"), max_db_entries=2)
+    cache.DB_EVICT_INTERVAL_PUTS = 3
+    for key in "abc":
+        clock[0] += 1
+        cache.put(key=key, content=key.upper())
+    assert cache.metrics["evictions_disk"] == 1
+    assert cache.get(key="a") is None
+
+
+def test_async_client_caches_streamed_answer_off_the_event_loop(mock_backend):
+    oai_client = AsyncOAIClient(
+        client=build_mock_openai_client(backend=mock_backend, async_client=True),
+        usage_ledger=UsageLedger(),
+        response_cache=ResponseCache(),
+    )
+    messages = [{"role": "user", "content": "Hi"}]
+
+    async def main():
+        chunks = [chunk async for chunk in await oai_client.query(messages, stream=True)]
+        # Wait for the cache writer
+        await asyncio.wrap_future(api_client._CACHE_WRITE_EXECUTOR.submit(lambda: None))
+        return len(chunks), await oai_client.query(messages)
+
+    num_chunks, answer = asyncio.run(main())
+    assert len(answer.split()) == 5 < num_chunks
+    assert mock_backend.metrics["requests"] == 1
+    assert oai_client.num_cache_hits == 1
@@ -0,0 +1,73 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from retrieval import BM25Index, tokenize
+
+TEXTS = [
+    "The cat sat on the mat.",
+    "Dogs and cats are pets; the cat purrs.",
+    "Stock markets fell sharply on Monday.",
+    "A cat, a cat, a cat!",
+    "",
+]
+IDS = [f"chunk{idx}" for idx in range(len(TEXTS))]
+
+
+def reference_scores(texts, query, k1=BM25Index.K1, b=BM25Index.B):
+    docs = [tokenize(text) for text in texts]
+    avg_length = max(sum(map(len, docs)) / len(docs), 1.0)
+    scores = []
+    for doc in docs:
+        score = 0.0
+        for term in set(tokenize(query)):
+            df = sum(term in other for other in docs)
+            tf = doc.count(term)
+            if tf:
+                idf = math.log1p((len(docs) - df + 0.5) / (df + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avg_length))
+        scores.append(score)
+    return scores
+
+
+def test_ranks_by_term_frequency_and_length():
+    index = BM25Index(ids=IDS, texts=TEXTS)
+    positions, scores = index.search("cat", k=10)
+
+    assert [IDS[position] for position in positions] == ["chunk3", "chunk0", "chunk1"]
+    assert np.all(np.diff(scores) <= 0)
+    np.testing.assert_allclose(
+        scores, [reference_scores(TEXTS, "cat")[position] for position in positions], rtol=1e-5
+    )
+
+
+def test_scores_match_reference_bm25():
+    rng = random.Random(0)
+    words = [f"w{idx}" for idx in range(30)]
+    texts = [" ".join(rng.choices(words, k=rng.randint(1, 40))) for _ in range(200)]
+    index = BM25Index(ids=[str(idx) for idx in range(len(texts))], texts=texts)
+    for query in ["w1 w2", "w3 w3 w29", "w7 unknown"]:
+        expected = reference_scores(texts, query)
+        positions, scores = index.search(query, k=10)
+        np.testing.assert_allclose(
+            scores, [expected[position] for position in positions], rtol=1e-4
+        )
+        assert sorted(expected, reverse=True)[:10] == pytest.approx(list(scores), rel=1e-4)
+
+
+def test_no_results_for_unknown_terms():
+    index = BM25Index(ids=IDS, texts=TEXTS)
+    positions, scores = index.search("giraffe", k=3)
+    assert len(positions) == len(scores) == 0
+    assert len(index.search("cat", k=0)[0]) == 0
+
+
+def test_common_terms_are_skipped():
+    index = BM25Index(ids=IDS, texts=TEXTS)
+    index.MIN_SKIPPED_DF = 0
+    # "the" is in 2 of 5 chunks, so "monday" alone ranks the results
+    positions, _ = index.search("the monday", k=5, max_df=0.2)
+    assert [IDS[position] for position in positions] == ["chunk2"]
+    assert len(index.search("the monday", k=5)[0]) == 3
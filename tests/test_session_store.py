@@ -0,0 +1,105 @@
+import pytest
+from box.box import Box
+
+import session_store
+from api_client import OAIClient
+from conversation import Conversation
+from session_store import (
+    MemorySessionStore,
+    SessionStore,
+    SQLiteSessionStore,
+    build_session_store,
+    restore_session,
+    snapshot_session,
+)
+from usage_ledger import UsageLedger
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(session_store.time, "time", lambda: clock[0])
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore(ttl_s=60)
+    return SQLiteSessionStore(db_path=str(tmp_path / "sessions.sqlite3"), ttl_s=60)
+
+
+def make_client(mock_client):
+    return OAIClient(client=mock_client, usage_ledger=UsageLedger())
+
+
+def test_snapshot_round_trips_through_store(store, mock_client):
+    oai_client = make_client(mock_client)
+    oai_client.input_tokens_used, oai_client.output_tokens_used = 42, 7
+    conversation = Conversation.from_chat_history([["Hi", "Hello!"], ["How are you?", "Fine."]])
+    store.put("session", snapshot_session(oai_client, conversation))
+
+    new_client = make_client(mock_client)
+    restored = restore_session(new_client, store.get("session"))
+
+    assert restored.chat_view() == conversation.chat_view()
+    assert restored.messages() == conversation.messages()
+    assert (new_client.input_tokens_used, new_client.output_tokens_used) == (42, 7)
+
+
+def test_states_are_not_shared_with_callers(store):
+    state = {"usage": {"pricing_cost": 0.5}}
+    store.put("session", state)
+    state["usage"]["pricing_cost"] = 1.0
+    store.get("session")["usage"]["pricing_cost"] = 2.0
+
+    assert store.get("session") == {"usage": {"pricing_cost": 0.5}}
+
+
+def test_states_expire_and_can_be_deleted(store, clock):
+    store.put("expiring", {"n": 1})
+    store.put("deleted", {"n": 2})
+    store.delete("deleted")
+    assert store.get("deleted") is None
+    assert store.get("unknown") is None
+
+    clock[0] += 59
+    assert store.get("expiring") == {"n": 1}
+    # Saving again extends the expiry
+    store.put("expiring", {"n": 3})
+    clock[0] += 59
+    assert store.get("expiring") == {"n": 3}
+    clock[0] += 1
+    assert store.get("expiring") is None
+
+
+def test_memory_store_drops_least_recently_used():
+    store = MemorySessionStore(max_sessions=2)
+    store.put("a", {})
+    store.put("b", {})
+    store.get("a")
+    store.put("c", {})
+
+    assert store.get("b") is None
+    assert store.get("a") == store.get("c") == {}
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    db_path = str(tmp_path / "sessions.sqlite3")
+    SQLiteSessionStore(db_path=db_path).put("session", {"n": 1})
+    assert SQLiteSessionStore(db_path=db_path).get("session") == {"n": 1}
+
+
+def test_restore_without_conversation_only_restores_usage(mock_client):
+    oai_client = make_client(mock_client)
+    assert restore_session(oai_client, {"usage": {"pricing_cost": 0.5, "unknown": 1}}) is None
+    assert oai_client.pricing_cost == 0.5
+    assert not hasattr(oai_client, "unknown")
+
+
+def test_store_backends():
+    with pytest.raises(TypeError):
+        SessionStore()
+    assert isinstance(build_session_store(Box(SESSION_STORE="memory")), MemorySessionStore)
+    with pytest.raises(ValueError):
+        build_session_store(Box(SESSION_STORE="postgres"))
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from api_client import AsyncOAIClient
+from mock_backend import MockChatBackend, build_mock_openai_client
+from speech import SentenceSplitter, SpeechPipeline, clean_text_for_speech
+from usage_ledger import UsageLedger
+
+TEXT = "Hello there, friend. How are you today?\nFine, thanks! This is the end"
+
+
+def split_deltas(text, size=3):
+    return [text[start : start + size] for start in range(0, len(text), size)]
+
+
+def test_splits_streamed_text_into_sentences():
+    splitter = SentenceSplitter()
+    sentences = [sentence for delta in split_deltas(TEXT) for sentence in splitter.push(delta)]
+
+    assert sentences == ["Hello there, friend.", "How are you today?", "Fine, thanks!"]
+    assert splitter.flush() == ["This is the end"]
+    assert splitter.flush() == []
+
+
+def test_short_sentences_are_joined_and_long_ones_cut():
+    splitter = SentenceSplitter(min_chars=12, max_chars=20)
+
+    assert splitter.push("Hi. Yes. Okay then. ") == ["Hi. Yes. Okay then."]
+    assert splitter.push("one two three four five six") == ["one two three four"]
+    assert splitter.flush() == ["five six"]
+
+
+def test_markdown_is_not_read_aloud():
+    text = "## **Bold** and `code`, see [the docs](https://example.com)."
+    assert clean_text_for_speech(text) == "Bold and code , see the docs."
+
+
+def make_pipeline(backend=None, **kwargs):
+    backend = backend if backend is not None else MockChatBackend(speech_latency_s=0.0)
+    oai_client = AsyncOAIClient(
+        client=build_mock_openai_client(backend=backend, async_client=True),
+        usage_ledger=UsageLedger(),
+    )
+    return SpeechPipeline(oai_client=oai_client, **kwargs)
+
+
+def test_audio_is_handed_out_in_order(monkeypatch):
+    # Earlier sentences take longer, so they finish last
+    delays_s = {"First sentence here.": 0.3, "Second one here.": 0.1, "Third and last": 0.0}
+
+    async def create_speech(text):
+        await asyncio.sleep(delays_s[text])
+        return text.encode("utf-8") + b"|"
+
+    async def main():
+        pipeline = make_pipeline(max_concurrency=3)
+        monkeypatch.setattr(pipeline, "_create_speech", create_speech)
+        for delta in split_deltas(" ".join(delays_s)):
+            pipeline.feed(delta)
+        await asyncio.sleep(0.15)
+        # The later sentences are done, but not the first one, so nothing can be played yet
+        assert pipeline.pop_ready() is None
+        return [audio async for audio in pipeline.remaining()], pipeline
+
+    chunks, pipeline = asyncio.run(main())
+    assert b"".join(chunks) == b"First sentence here.|Second one here.|Third and last|"
+    assert pipeline.metrics["sentences"] == 3
+    assert pipeline.first_audio_s is not None
+
+
+def test_synthesizes_sentences_through_the_speech_api():
+    backend = MockChatBackend(speech_latency_s=0.0)
+
+    async def main():
+        pipeline = make_pipeline(backend=backend, voice="nova")
+        for delta in split_deltas(TEXT):
+            pipeline.feed(delta)
+        return [audio async for audio in pipeline.remaining()], pipeline
+
+    chunks, pipeline = asyncio.run(main())
+    assert b"".join(chunks).decode("utf-8") == (
+        "[nova] Hello there, friend.[nova] How are you today?"
+        "[nova] Fine, thanks![nova] This is the end"
+    )
+    assert backend.metrics["requests"] == 4
+    assert pipeline.metrics["cost"] == pytest.approx(0.015 * pipeline.metrics["chars"] / 1000)
+
+
+def test_failed_sentences_are_skipped(monkeypatch):
+    async def create_speech(text):
+        if text.startswith("Broken"):
+            raise ValueError("no audio")
+        return text.encode("utf-8")
+
+    async def main():
+        pipeline = make_pipeline()
+        monkeypatch.setattr(pipeline, "_create_speech", create_speech)
+        pipeline.feed("Broken sentence here. Fine sentence here.")
+        return [audio async for audio in pipeline.remaining()], pipeline
+
+    chunks, pipeline = asyncio.run(main())
+    assert chunks == [b"Fine sentence here."]
+    assert pipeline.metrics["errors"] == 1
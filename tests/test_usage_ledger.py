@@ -0,0 +1,97 @@
+import pytest
+
+import usage_ledger
+from usage_ledger import PriceTable, UsageLedger
+
+CALLS = [
+    # (model, session, input_tokens, output_tokens, cost, latency_s)
+    ("gpt-a", "s1", 10, 5, 0.01, 1.0),
+    ("gpt-b", "s1", 20, 10, 0.02, 2.0),
+    ("gpt-a", "s2", 30, 15, 0.03, 3.0),
+    ("gpt-a", "s3", 40, 20, 0.04, 4.0),
+]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(usage_ledger.time, "time", lambda: clock[0])
+    return clock
+
+
+def record_calls(ledger, clock, calls=CALLS):
+    for model, session, input_tokens, output_tokens, cost, latency_s in calls:
+        clock[0] += 1
+        ledger.record(
+            model=model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cost=cost,
+            latency_s=latency_s,
+            session=session,
+        )
+
+
+def test_aggregates_by_model_and_session(clock):
+    ledger = UsageLedger(initial_capacity=1)
+    record_calls(ledger, clock)
+
+    by_model = ledger.aggregate(by="model")
+    assert by_model["gpt-a"] == {
+        "num_calls": 3,
+        "input_tokens": 80,
+        "output_tokens": 40,
+        "mean_latency_s": pytest.approx(8 / 3),
+        "cost": pytest.approx(0.08),
+    }
+    assert by_model["gpt-b"]["num_calls"] == 1
+    by_session = ledger.aggregate(by="session")
+    assert {session: row["input_tokens"] for session, row in by_session.items()} == {
+        "s1": 30,
+        "s2": 30,
+        "s3": 40,
+    }
+    assert ledger.totals(session="s1").to_dict() == {
+        "num_calls": 2,
+        "input_tokens": 30,
+        "output_tokens": 15,
+        "cost": pytest.approx(0.03),
+    }
+    with pytest.raises(ValueError):
+        ledger.aggregate(by="day")
+
+
+def test_aggregates_within_time_window_and_with_new_prices(clock):
+    ledger = UsageLedger()
+    record_calls(ledger, clock)
+
+    # Calls are recorded at 1001, 1002, 1003 and 1004
+    window = ledger.aggregate(by="session", start=1002, end=1004)
+    assert {session: row["num_calls"] for session, row in window.items()} == {"s1": 1, "s2": 1}
+
+    prices = PriceTable(prices={"gpt-a": (1.0, 2.0), "gpt-b": (0.0, 0.0)})
+    repriced = ledger.aggregate(by="model", price_table=prices)
+    assert repriced["gpt-a"]["cost"] == pytest.approx((80 * 1.0 + 40 * 2.0) / 1000)
+    assert repriced["gpt-b"]["cost"] == 0.0
+
+
+def test_oldest_half_is_dropped_once_full(clock):
+    ledger = UsageLedger(initial_capacity=1, max_rows=4)
+    record_calls(ledger, clock)
+    record_calls(ledger, clock, calls=[("gpt-b", "s4", 50, 25, 0.05, 5.0)])
+
+    assert len(ledger) == 3
+    by_session = ledger.aggregate(by="session")
+    assert sorted(by_session) == ["s2", "s3", "s4"]
+    assert by_session["s4"]["input_tokens"] == 50
+    # Sessions without calls left are forgotten, overall and model totals still count every call
+    assert ledger.totals(session="s1").num_calls == 0
+    assert ledger.totals(session="s3").num_calls == 1
+    assert ledger.totals().num_calls == 5
+    assert ledger.totals(model="gpt-b").input_tokens == 70
+    assert ledger.aggregate(by="model")["gpt-b"]["input_tokens"] == 50
+
+    # Sessions seen again are interned anew
+    record_calls(ledger, clock, calls=[("gpt-a", "s1", 1, 1, 0.0, 0.0)])
+    assert ledger.aggregate(by="session")["s1"]["num_calls"] == 1
+    assert ledger.totals(session="s1").num_calls == 1